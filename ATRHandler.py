@@ -1,12 +1,14 @@
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler
+import inspect
 import logging
 from urllib.parse import urlparse
 import hmac
 import json
 from jsonschema import validate, ValidationError
 
-from daemon import Daemon
+import eventsub
+import metrics
 
 
 class ATRHandler(BaseHTTPRequestHandler):
@@ -17,8 +19,12 @@ class ATRHandler(BaseHTTPRequestHandler):
             'args': {'type': 'array', 'items': {'type': 'string'}},
         },
     }
-    message = {}
-    ok = False
+
+    def setup(self):
+        super().setup()
+        # response of this request, requests are handled concurrently so nothing is kept on the class
+        self.message = {}
+        self.ok = False
 
     # comment this out when developing :)
     def log_message(self, format, *args):
@@ -51,11 +57,23 @@ class ATRHandler(BaseHTTPRequestHandler):
         self.log_message('body: ' + dump)
         self.wfile.write(dump.encode(encoding='utf_8'))
 
+    def _send_error_json_response(self):
+        self.send_response(HTTPStatus.INTERNAL_SERVER_ERROR)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        dump = json.dumps(self.message)
+        self.log_message('body: ' + dump)
+        self.wfile.write(dump.encode(encoding='utf_8'))
+
     def do_GET(self):
         """Handles GET requests, will send challenge back to twitch to register webhook.
 
            """
-        query = urlparse(self.path).query
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            self.send_metrics()  # not logged, it is scraped every few seconds
+            return
+        query = url.query
         logging.info('GET request,\nPath: %s\nHeaders:\n%s\n', str(self.path), str(self.headers))
         try:
             query_components = dict(qc.split('=') for qc in query.split('&'))
@@ -74,7 +92,8 @@ class ATRHandler(BaseHTTPRequestHandler):
 
     def do_POST(self):
         content_length = int(self.headers['Content-Length'])  # <--- Gets the size of data
-        post_data = self.rfile.read(content_length).decode()  # <--- Gets the data itself
+        body = self.rfile.read(content_length)  # <--- Gets the data itself
+        post_data = body.decode()
         logging.info('POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n',
                      str(self.path), str(self.headers), post_data)
 
@@ -92,6 +111,8 @@ class ATRHandler(BaseHTTPRequestHandler):
             except ValidationError as validationerror:
                 self.message['println'] = 'Could not validate request payload for cmd:\n' + str(validationerror)
                 self._send_bad_json_response()
+        elif eventsub.MESSAGE_TYPE in self.headers:
+            self.handle_eventsub(body)
         else:
             if 'Content-Type' in self.headers:
                 content_type = str(self.headers['Content-Type'])
@@ -103,7 +124,7 @@ class ATRHandler(BaseHTTPRequestHandler):
                 print(hashval)
                 print(algorithm)
                 if post_data and algorithm and hashval:
-                    gg = hmac.new(Daemon.WEBHOOK_SECRET.encode(), post_data, algorithm)
+                    gg = hmac.new(self.server.webhook_secret.encode(), post_data, algorithm)
                     if not hmac.compare_digest(hashval.encode(), gg.hexdigest().encode()):
                         raise ConnectionError('Hash missmatch.')
             else:
@@ -111,6 +132,61 @@ class ATRHandler(BaseHTTPRequestHandler):
             self._set_response()
             self.wfile.write('POST request for {}'.format(self.path).encode('utf-8'))
 
+    def _send_status(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_metrics(self):
+        body = metrics.render().encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-type', metrics.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_eventsub(self, body):
+        """Handles EventSub webhook requests. Only messages signed with the server's `webhook_secret` and sent within
+        the last ten minutes are accepted, redelivered messages are acknowledged without acting on them again.
+
+            Parameters:
+            ----------
+            body (bytes): the raw request body, the signature is computed over it.
+
+           """
+        message_id = self.headers.get(eventsub.MESSAGE_ID)
+        timestamp = self.headers.get(eventsub.MESSAGE_TIMESTAMP)
+        if not eventsub.verify_signature(self.server.webhook_secret, message_id, timestamp, body,
+                                         self.headers.get(eventsub.MESSAGE_SIGNATURE)):
+            self._send_status(HTTPStatus.FORBIDDEN)
+            return
+        try:
+            too_old = eventsub.message_age(timestamp) > eventsub.MAX_MESSAGE_AGE
+            payload = json.loads(body)
+            subscription_type = payload['subscription']['type']
+        except (ValueError, KeyError, TypeError):
+            self._send_status(HTTPStatus.BAD_REQUEST)
+            return
+        if too_old:
+            self._send_status(HTTPStatus.FORBIDDEN)
+            return
+
+        message_type = self.headers[eventsub.MESSAGE_TYPE]
+        if message_type == 'webhook_callback_verification':
+            self._send_status(HTTPStatus.OK, payload['challenge'].encode('utf-8'))
+            return
+        # answered before acting on it, Twitch retries messages that are not acknowledged quickly
+        self._send_status(HTTPStatus.NO_CONTENT)
+        if self.server.eventsub_messages.seen(message_id):
+            return
+        if message_type == 'notification' and subscription_type in eventsub.STREAM_EVENTS:
+            self.server.handle_stream_event(subscription_type, payload['event'])
+        elif message_type == 'revocation':
+            print('EventSub subscription ' + subscription_type + ' was revoked: ' +
+                  str(payload['subscription'].get('status')))
+
     def handle_cmd(self, post_data):
         """Handles POST requests on /cmd/. These contain a single command with optional arguments supplied by the user via GUI or CLI.
 
@@ -129,12 +205,34 @@ class ATRHandler(BaseHTTPRequestHandler):
             'add': self.cmd_add,
             'time': self.cmd_time,
             'download_folder': self.cmd_download_folder,
+            'live_remux': self.cmd_live_remux,
+            'queue': self.cmd_queue,
+            'segment': self.cmd_segment,
+            'eventsub': self.cmd_eventsub,
         }
-        func = cmd_executor[post_data['cmd']]
-        if len(post_data['args']) > 0:
-            func(post_data['args'])
-        else:
-            func()
+        try:
+            func = cmd_executor[post_data['cmd']]
+        except KeyError:
+            self.ok = False
+            self.message['println'] = 'Unknown command: ' + post_data['cmd']
+            return
+        args = (post_data['args'],) if len(post_data['args']) > 0 else ()
+        try:
+            inspect.signature(func).bind(*args)
+        except TypeError:
+            self.ok = False
+            if args:
+                self.message['println'] = post_data['cmd'] + ' takes no arguments.'
+            else:
+                self.message['println'] = 'Missing arguments for ' + post_data['cmd'] + '.'
+            return
+        try:
+            func(*args)
+        except Exception as e:
+            # the client gets an answer, the traceback goes to the server's handle_error
+            self.message['println'] = 'Error running ' + post_data['cmd'] + ': ' + str(e)
+            self._send_error_json_response()
+            raise
 
     def cmd_exit(self):
         self.message['println'] = self.server.exit()
@@ -158,10 +256,19 @@ class ATRHandler(BaseHTTPRequestHandler):
         self.message['println'] = msg
         self.ok = True
 
+    def cmd_queue(self):
+        stats = self.server.get_conversion_stats()
+        lines = ['Queued: ' + str(stats['queued']),
+                 'Converting: ' + str(stats['running']).strip('[]')]
+        for job in stats['recent']:
+            lines.append('{status} in {duration_seconds}s after waiting {wait_seconds}s: {ts_file_path}'.format(**job))
+        self.message['println'] = '\n'.join(lines)
+        self.ok = True
+
     def cmd_add(self, args):
         if len(args) == 0:
+            self.ok = False
             self.message['println'] = 'Missing streamer in arguments.'
-            self._send_bad_json_response()
             return
 
         if len(args) > 1:
@@ -179,6 +286,31 @@ class ATRHandler(BaseHTTPRequestHandler):
             self.ok = False
             self.message['println'] = '\'' + args[0] + '\' is not valid.'
     
+    def cmd_live_remux(self, args):
+        if args[0] in ('on', 'off'):
+            self.message['println'] = self.server.set_live_remux(args[0] == 'on')
+            self.ok = True
+        else:
+            self.ok = False
+            self.message['println'] = '\'' + args[0] + '\' is not valid.'
+
+    def cmd_segment(self, args):
+        try:
+            self.message['println'] = self.server.set_segment_minutes(int(args[0]))
+            self.ok = True
+        except ValueError:
+            self.ok = False
+            self.message['println'] = '\'' + args[0] + '\' is not valid.'
+
+    def cmd_eventsub(self, args):
+        callback_url = str(args[0]).strip()
+        if callback_url.startswith('https://'):
+            self.message['println'] = self.server.enable_eventsub(callback_url)
+            self.ok = True
+        else:
+            self.ok = False
+            self.message['println'] = '\'' + args[0] + '\' is not valid, the callback has to be an https url.'
+
     def cmd_download_folder(self, args):
         try:
             self.message['println'] = self.server.set_download_folder(str(args[0]).strip())
@@ -55,6 +55,16 @@ class AtrCmd(cmd.Cmd):
             'List all watched streamers, seperated in offline and live sets.',
         ]))
 
+    def do_queue(self, line):
+        payload = self._create_payload('queue')
+        self._send_cmd(payload)
+
+    def help_queue(self):
+        print('\n'.join([
+            'queue',
+            'Shows the mp4 conversion queue and the timings of recently finished conversions.',
+        ]))
+
     def do_start(self, line):
         payload = self._create_payload('start')
         self._send_cmd(payload)
@@ -90,6 +100,41 @@ class AtrCmd(cmd.Cmd):
             'Configures the download folder for saving the videos.',
         ]))
 
+    def do_live_remux(self, line):
+        payload = self._create_payload('live_remux', line)
+        self._send_cmd(payload)
+
+    def help_live_remux(self):
+        print('\n'.join([
+            'live_remux on|off',
+            'Remuxes streams to mp4 while they are recorded, so the mp4 is ready right after the stream ends.',
+            'The .ts file is only kept if the live remux fails. Default: off',
+        ]))
+
+    def do_segment(self, line):
+        payload = self._create_payload('segment', line)
+        self._send_cmd(payload)
+
+    def help_segment(self):
+        print('\n'.join([
+            'segment minutes',
+            'Records streams in parts of the given length that are converted to mp4 while the stream goes on.',
+            'The parts are joined without re-encoding once the stream ended and all parts are converted.',
+            '0 records one file per stream. Default: 0',
+        ]))
+
+    def do_eventsub(self, line):
+        payload = self._create_payload('eventsub', line)
+        self._send_cmd(payload)
+
+    def help_eventsub(self):
+        print('\n'.join([
+            'eventsub callback_url',
+            'Subscribes all streamers to Twitch stream.online/offline notifications sent to callback_url,',
+            'a public https url that forwards to this daemon (e.g. an ngrok tunnel).',
+            'Recordings start as soon as a notification arrives, polling only runs every 5 minutes to catch up.',
+        ]))
+
     def do_EOF(self, line):
         self.do_exit(line)
         return True
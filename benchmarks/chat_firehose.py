@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_sink import ChatSink, open_chat_file
+
+WORDS = ['KEKW', 'LUL', 'PogChamp', 'monkaS', 'Pog', 'OMEGALUL', 'gg', 'what', 'no way', 'clip it', 'LETSGO',
+         'xdd', 'Clap', 'ICANT', 'sadge', 'wow', 'that was insane', '???', 'W', 'L']
+
+
+def synthetic_firehose(count, seed):
+    """Chat of a big channel, a few thousand messages a minute."""
+    rng = random.Random(seed)
+    timestamp = 1_600_000_000_000_000
+    for _ in range(count):
+        timestamp += rng.randint(1_000, 40_000)  # microseconds
+        yield {'timestamp': timestamp, 'message': ' '.join(rng.choices(WORDS, k=rng.randint(1, 8))),
+               'message_type': 'text_message'}
+
+
+def load_chat(path):
+    """A recorded chat, NDJSON as written by ChatSink (any compression) or a JSON list."""
+    with open_chat_file(path) as chat_file:
+        text = chat_file.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line]
+
+
+def write_before(messages, path):
+    """How the chat was written before the sink: one json.dump and one newline write per message."""
+    with open(path, 'w') as f:
+        for message in messages:
+            json.dump(message, f)
+            f.write('\n')
+    return path
+
+
+def write_sink(messages, path, compression):
+    with ChatSink(path, compression) as sink:
+        for message in messages:
+            sink.write(message)
+    return sink.path
+
+
+def run(name, write, messages, work_dir):
+    path = os.path.join(work_dir, name.replace(' ', '_'))
+    wall, cpu = time.perf_counter(), time.process_time()
+    path = write(messages, path)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    print(f"{name:<14} {len(messages) / wall:12,.0f} messages/s   {cpu:6.2f} s CPU   "
+          f"{os.path.getsize(path) / 2 ** 20:8.1f} MiB")
+    os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a chat firehose through the old per-message writes and '
+                                                 'through ChatSink without and with compression.')
+    parser.add_argument('--chat', help='recorded chat to replay, a synthetic firehose is used if not given')
+    parser.add_argument('--messages', type=int, default=500_000, help='size of the synthetic firehose')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dir', help='directory to write into, a temporary one by default')
+    args = parser.parse_args()
+
+    messages = load_chat(args.chat) if args.chat else list(synthetic_firehose(args.messages, args.seed))
+    work_dir = args.dir or tempfile.mkdtemp(prefix='chat_benchmark_')
+    print(f"{len(messages):,} messages into {work_dir}")
+    run('before', write_before, messages, work_dir)
+    for compression in (None, 'gzip', 'zstd'):
+        run(f'sink {compression or "plain"}', lambda m, p: write_sink(m, p, compression), messages, work_dir)
+    if not args.dir:
+        os.rmdir(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from videoProcessing.videoWorker import plan_clips, plan_duration, timeframe_to_clip_range
+
+
+def clustered_timeframes(hours, count, seed):
+    """Chat hotspots in clusters, the way a hype moment produces several bursts close to each other."""
+    rng = random.Random(seed)
+    seconds = hours * 3600
+    timeframes = []
+    while len(timeframes) < count:
+        center = rng.uniform(0, seconds)
+        for _ in range(rng.randint(1, 5)):
+            start = max(0.0, center + rng.uniform(-120, 120))
+            end = min(seconds, start + rng.uniform(10, 60))
+            timeframes.append({'start': int(start * 1e6), 'end': int(end * 1e6), 'score': round(rng.random() * 10, 2)})
+    return timeframes[:count]
+
+
+def unplanned_duration(timeframes, video_total_duration):
+    """Seconds of video cut when every timeframe is padded and cut on its own, as before the plan."""
+    total = 0.0
+    for timeframe in timeframes:
+        start, end = timeframe_to_clip_range(0, timeframe, video_total_duration)
+        total += max((end - start).total_seconds(), 0.0)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Speed of plan_clips and the video it saves cutting, on a '
+                                                 'chatsegments.json or on synthetic clustered hotspots.')
+    parser.add_argument('--segments', help='chatsegments.json to plan, synthetic hotspots are used if not given')
+    parser.add_argument('--hours', type=float, default=10, help='length of the video')
+    parser.add_argument('--timeframes', type=int, default=200)
+    parser.add_argument('--merge-gap', type=float, default=30, help='clip_merge_gap_seconds')
+    parser.add_argument('--max-total', type=float, default=None, help='max_total_clip_seconds')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.segments:
+        with open(args.segments) as segments_file:
+            timeframes = json.load(segments_file)
+        # the segment timestamps count from the first chat message, like the video
+        first = min(timeframe['start'] for timeframe in timeframes)
+        timeframes = [{**timeframe, 'start': timeframe['start'] - first, 'end': timeframe['end'] - first}
+                      for timeframe in timeframes]
+    else:
+        timeframes = clustered_timeframes(args.hours, args.timeframes, args.seed)
+    video_total_duration = timedelta(hours=args.hours)
+    keyframes = [i * 2.0 for i in range(int(args.hours * 3600 / 2) + 1)]  # Twitch keyframe interval
+    config = {'clip_merge_gap_seconds': args.merge_gap, 'max_total_clip_seconds': args.max_total}
+
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        plan = plan_clips(0, timeframes, video_total_duration, config, keyframes)
+        timings.append(time.perf_counter() - start)
+
+    before = unplanned_duration(timeframes, video_total_duration)
+    after = plan_duration(plan)
+    print(f"{len(timeframes)} timeframes -> {len(plan)} clips, planned in {min(timings) * 1000:.1f} ms "
+          f"(best of {args.repeat})")
+    print(f"video cut: {before / 60:.1f} minutes one clip per timeframe, {after / 60:.1f} minutes planned "
+          f"({1 - after / before:.0%} less)" if before else "no video to cut")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ffmpeg_runner import run_ffmpeg, run_ffprobe
+from videoProcessing.videoWorker import (get_keyframes, get_video_duration, plan_clips, process_timeframes_parallel,
+                                         timedelta_to_hhmmss, timeframe_to_clip_range)
+
+
+def make_synthetic_video(path, seconds):
+    """A test pattern with a tone, 360p H.264 with a keyframe every 2 seconds like a Twitch recording."""
+    job = run_ffmpeg(['-y', '-f', 'lavfi', '-i', 'testsrc2=size=640x360:rate=30', '-f', 'lavfi',
+                      '-i', 'sine=frequency=440', '-t', str(seconds), '-c:v', 'libx264', '-preset', 'ultrafast',
+                      '-g', '60', '-c:a', 'aac', '-shortest', path])
+    if not job.ok:
+        raise SystemExit(f"Could not make the synthetic video: {job.error}")
+
+
+def random_timeframes(seconds, count, seed):
+    """Chat timeframes of 10 to 90 seconds spread over the video, in microseconds like chatsegments.json."""
+    rng = random.Random(seed)
+    timeframes = []
+    for _ in range(count):
+        start = rng.uniform(0, seconds - 90)
+        timeframes.append({'start': int(start * 1e6), 'end': int((start + rng.uniform(10, 90)) * 1e6),
+                           'score': rng.random()})
+    return timeframes
+
+
+def clip_before(video_path, timeframes, clip_dir):
+    """How clips were cut before: per timeframe two ffprobe runs and one ffmpeg run seeking after -i."""
+    clips = 0
+    for index, timeframe in enumerate(timeframes):
+        duration = timedelta(seconds=get_video_duration(video_path))
+        run_ffprobe(['-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', video_path])
+        start, end = timeframe_to_clip_range(0, timeframe, duration)
+        job = run_ffmpeg(['-y', '-i', video_path, '-ss', timedelta_to_hhmmss(start), '-to', timedelta_to_hhmmss(end),
+                          '-c', 'copy', os.path.join(clip_dir, f'before_{index:03}.mp4')])
+        clips += job.ok
+    return clips
+
+
+def clip_after(video_path, timeframes, clip_dir, config):
+    duration = timedelta(seconds=get_video_duration(video_path))
+    keyframes = get_keyframes(video_path) if config['snap_to_keyframes'] else []
+    plan = plan_clips(0, timeframes, duration, config, keyframes)
+    success_count, _ = process_timeframes_parallel(video_path, plan, timeframes, clip_dir, config)
+    return success_count
+
+
+def run(name, cut, clip_dir, timeframes):
+    """Overlapping timeframes are merged into one clip by the plan, so the rate counts timeframes clipped."""
+    os.makedirs(clip_dir)
+    start = time.perf_counter()
+    clips = cut(clip_dir)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<40} {clips:4} clips in {elapsed:7.1f} s   {len(timeframes) / elapsed * 60:8.1f} clips/minute")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Clips per minute cut out of a synthetic long video, one ffmpeg '
+                                                 'run with output seeking per clip (before) against the clip plan '
+                                                 'and input seeking in a process pool.')
+    parser.add_argument('--video', help='video to cut, a synthetic one is made (and kept at this path) if missing')
+    parser.add_argument('--hours', type=float, default=2)
+    parser.add_argument('--clips', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--skip-before', action='store_true', help='the old way reads the video up to every clip')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='clip_benchmark_')
+    video_path = args.video or os.path.join(work_dir, 'synthetic.mp4')
+    try:
+        if not os.path.exists(video_path):
+            print(f"Making a {args.hours:g} hour synthetic video...")
+            make_synthetic_video(video_path, int(args.hours * 3600))
+        seconds = get_video_duration(video_path)
+        timeframes = random_timeframes(seconds, args.clips, args.seed)
+        print(f"{args.clips} timeframes in {timedelta(seconds=int(seconds))} of video")
+
+        if not args.skip_before:
+            run('before (-ss after -i, 1 per run)', lambda d: clip_before(video_path, timeframes, d),
+                os.path.join(work_dir, 'before'), timeframes)
+        for all_at_once in (False, True):
+            config = {'process_all_at_once': all_at_once, 'clips_per_ffmpeg': 16, 'clip_workers': None,
+                      'snap_to_keyframes': True, 'clip_merge_gap_seconds': 0, 'save_chat_messages': False}
+            run(f"after (process_all_at_once={all_at_once})",
+                lambda d: clip_after(video_path, timeframes, d, config),
+                os.path.join(work_dir, f'after_{all_at_once}'), timeframes)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
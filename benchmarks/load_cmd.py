@@ -0,0 +1,95 @@
+import argparse
+import http.client
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import daemon
+from ATRHandler import ATRHandler
+from daemon import Daemon
+
+
+class SequentialDaemon(Daemon):
+    """The daemon handling one request after another on the accept loop, like the plain HTTPServer before."""
+    process_request = HTTPServer.process_request
+
+
+def slow_resolve_logins(delay):
+    """Stands in for the helix/users request of `add`."""
+    def resolve_logins(logins):
+        time.sleep(delay)
+        return {login: {'id': str(abs(hash(login))), 'login': login, 'display_name': login} for login in logins}
+    return resolve_logins
+
+
+def send(address, cmd, args):
+    body = json.dumps({'cmd': cmd, 'args': args}).encode()
+    start = time.perf_counter()
+    connection = http.client.HTTPConnection(*address, timeout=120)
+    try:
+        connection.request('POST', '/cmd/', body, {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        response.read()
+        status = response.status
+    except OSError:
+        status = None
+    finally:
+        connection.close()
+    return cmd, status, time.perf_counter() - start
+
+
+def run(name, server_class, clients, requests_per_client, slow_share):
+    server = server_class(('127.0.0.1', 0), ATRHandler)
+    serve_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    serve_thread.start()
+
+    # every slow_share-th request is a slow `add`, the others are `list`, which only reads the registry
+    jobs = [('add', [f'streamer{i}']) if i % slow_share == 0 else ('list', [])
+            for i in range(clients * requests_per_client)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(lambda job: send(server.server_address, *job), jobs))
+    elapsed = time.perf_counter() - start
+    server.exit()
+    serve_thread.join()
+
+    print(f"{name:<12} {len(jobs) / elapsed:8.1f} requests/s   "
+          f"{sum(status == 503 for _, status, _ in results)} answered 503   "
+          f"{sum(status is None for _, status, _ in results)} connections failed")
+    for cmd in ('add', 'list'):
+        timings = sorted(seconds for c, status, seconds in results if c == cmd and status == 200)
+        if timings:
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            print(f"  {cmd:<6} median {statistics.median(timings) * 1000:8.1f} ms   p95 {p95 * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent /cmd/ requests against the daemon, a mix of slow '
+                                                 '`add` commands waiting on a stubbed user lookup and fast `list` '
+                                                 'commands, handled one at a time (before) and by the request pool.')
+    parser.add_argument('--clients', type=int, default=32, help='requests sent at the same time')
+    parser.add_argument('--requests', type=int, default=10, help='requests per client')
+    parser.add_argument('--slow-ms', type=float, default=200, help='time an `add` waits for the user lookup')
+    parser.add_argument('--slow-share', type=int, default=10, help='every n-th request is an `add`')
+    args = parser.parse_args()
+
+    # no config or API access is needed, the user lookup is the slow part of `add`
+    daemon.get_client_id = lambda: 'benchmark'
+    daemon.get_webhook_secret = lambda: 'benchmark'
+    daemon.resolve_logins = slow_resolve_logins(args.slow_ms / 1000)
+
+    print(f"{args.clients} clients x {args.requests} requests, every {args.slow_share}th an `add` taking "
+          f"{args.slow_ms:g} ms, {Daemon.request_workers} request workers")
+    run('before', SequentialDaemon, args.clients, args.requests, args.slow_share)
+    run('after', Daemon, args.clients, args.requests, args.slow_share)
+
+
+if __name__ == '__main__':
+    main()
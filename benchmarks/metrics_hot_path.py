@@ -0,0 +1,85 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+
+
+class LockedCounter:
+    """A counter behind one lock, the obvious alternative to the per-thread cells."""
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+
+def ns_per_update(update, threads, updates):
+    """Nanoseconds of wall time per update with `threads` threads updating at the same time."""
+    barrier = threading.Barrier(threads + 1)
+
+    def work():
+        barrier.wait()
+        for _ in range(updates):
+            update()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (threads * updates) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cost of the metrics updates done on every stream read and chat '
+                                                 'message, with several threads updating at once, and of '
+                                                 'rendering /metrics.')
+    parser.add_argument('--updates', type=int, default=200_000, help='updates per thread')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--streamers', type=int, default=500, help='label values rendered per recording metric')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    # children are looked up once and kept, like the watcher does
+    recording_bytes = metrics.RECORDING_BYTES.labels('benchmark')
+    read_seconds = metrics.Histogram('atr_benchmark_read_seconds', 'Benchmark histogram.').labels()
+    locked = LockedCounter()
+    updates = {
+        'empty loop': lambda: None,
+        'locked counter inc': lambda: locked.inc(65536),
+        'Counter inc': lambda: recording_bytes.inc(65536),
+        'Histogram observe': lambda: read_seconds.observe(0.02),
+    }
+
+    print('ns per update, wall time over all threads')
+    print(f"{'':<20}" + ''.join(f"{f'{threads} thread(s)':>14}" for threads in args.threads))
+    for name, update in updates.items():
+        print(f"{name:<20}" + ''.join(f"{ns_per_update(update, threads, args.updates):14.0f}"
+                                      for threads in args.threads))
+
+    for i in range(args.streamers):
+        streamer = f'streamer{i}'
+        metrics.RECORDING_BYTES.labels(streamer).inc(65536)
+        metrics.RECORDING_STALLS.labels(streamer).inc()
+        metrics.CHAT_MESSAGES.labels(streamer).inc()
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        text = metrics.render()
+        timings.append(time.perf_counter() - start)
+    print(f"render with {args.streamers} streamers: {min(timings) * 1000:.1f} ms, {len(text) / 1024:.0f} KiB "
+          f"(best of {args.repeat})")
+
+
+if __name__ == '__main__':
+    main()
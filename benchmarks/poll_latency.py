@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from requests.adapters import HTTPAdapter
+
+import twitch
+import utils
+
+API_HOST = 'https://api.twitch.tv'
+
+
+class StubHelixHandler(BaseHTTPRequestHandler):
+    """Answers helix/streams with every other requested user live. New connections are delayed by
+    server.handshake_delay to stand in for the TCP+TLS round trips to api.twitch.tv."""
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+
+    def setup(self):
+        time.sleep(self.server.handshake_delay)
+        super().setup()
+
+    def do_GET(self):
+        user_ids = parse_qs(urlparse(self.path).query).get('user_id', [])
+        data = [{'user_id': uid, 'type': 'live', 'title': 'stub', 'viewer_count': 1,
+                 'started_at': '2020-01-01T00:00:00Z'} for uid in user_ids[::2]]
+        body = json.dumps({'data': data}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RedirectAdapter(HTTPAdapter):
+    """Sends requests for api.twitch.tv to the stub server."""
+
+    def __init__(self, target, **kwargs):
+        self.target = target
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        request.url = request.url.replace(API_HOST, self.target, 1)
+        return super().send(request, **kwargs)
+
+
+def redirect(session, target, pool_maxsize=10, pool_block=False):
+    adapter = session.get_adapter(API_HOST)
+    session.mount(API_HOST, RedirectAdapter(target, max_retries=adapter.max_retries, pool_maxsize=pool_maxsize,
+                                            pool_block=pool_block))
+    return session
+
+
+def poll_before(user_ids, target):
+    """A sweep as it was done before the shared client: one page after another, each page with a new session
+    and freshly built auth headers."""
+    stream_info = {}
+    for i in range(0, len(user_ids), twitch.STREAM_INFO_PAGE_SIZE):
+        page = user_ids[i:i + twitch.STREAM_INFO_PAGE_SIZE]
+        headers = {'Client-ID': utils.get_client_id(),
+                   'Authorization': f'Bearer {utils.get_app_access_token()}'}
+        session = redirect(twitch.requests_retry_session(), target)
+        response = session.get(API_HOST + '/helix/streams?' + '&'.join(f'user_id={uid}' for uid in page),
+                               headers=headers, timeout=20)
+        stream_info.update((stream['user_id'], stream) for stream in response.json()['data'])
+    return stream_info
+
+
+def poll_after(user_ids):
+    return asyncio.run(twitch.get_stream_info_async(*user_ids))
+
+
+def measure(poll, polls):
+    timings = []
+    for _ in range(polls):
+        start = time.perf_counter()
+        poll()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:<8} median {statistics.median(timings) * 1000:8.1f} ms   p95 {p95 * 1000:8.1f} ms   "
+          f"max {timings[-1] * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-poll latency of a stream info sweep against a local helix '
+                                                 'stub, with a new session per page (before) and with the shared '
+                                                 'pooled client (after).')
+    parser.add_argument('--streamers', type=int, default=500)
+    parser.add_argument('--polls', type=int, default=20)
+    parser.add_argument('--handshake-ms', type=float, default=30,
+                        help='delay of every new connection, stands in for the TLS handshake')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHelixHandler)
+    server.daemon_threads = True
+    server.handshake_delay = args.handshake_ms / 1000
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    target = f'http://127.0.0.1:{server.server_address[1]}'
+
+    # no real credentials are needed against the stub
+    utils.get_client_id = lambda: 'benchmark'
+    utils.get_app_access_token = lambda: 'benchmark'
+    redirect(twitch.client.session, target, pool_maxsize=twitch.MAX_CONCURRENT_PAGES, pool_block=True)
+
+    user_ids = [str(i) for i in range(args.streamers)]
+    live = (args.streamers + 1) // 2
+    assert len(poll_before(user_ids, target)) == live
+    assert sum(info['status'] == 'online' for info in poll_after(user_ids).values()) == live
+
+    print(f"{args.streamers} streamers, {args.polls} polls, {args.handshake_ms:g} ms per new connection")
+    report('before', measure(lambda: poll_before(user_ids, target), args.polls))
+    report('after', measure(lambda: poll_after(user_ids), args.polls))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
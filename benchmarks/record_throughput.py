@@ -0,0 +1,89 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from watcher import Watcher, RECORD_CHUNK_SIZE
+
+STREAM_BITRATE = 8_000_000  # bits per second of a 1080p60 stream
+
+
+class FakeStream:
+    """File-like stream returning `total` bytes from a repeated block, with read() and readinto() like a
+    streamlink stream."""
+
+    def __init__(self, total, block_size=16 * 1024 * 1024):
+        self.block = memoryview(os.urandom(block_size))
+        self.remaining = total
+        self.offset = 0
+
+    def _next(self, size):
+        size = min(size, self.remaining, len(self.block) - self.offset)
+        chunk = self.block[self.offset:self.offset + size]
+        self.offset = (self.offset + size) % len(self.block)
+        self.remaining -= size
+        return chunk
+
+    def read(self, size=-1):
+        return bytes(self._next(size))
+
+    def readinto(self, buf):
+        chunk = self._next(len(buf))
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class ReadOnlyStream(FakeStream):
+    readinto = None
+
+
+def record_before(fd, out_file):
+    """The recording loop as it was before the reusable buffer."""
+    while True:
+        data = fd.read(1024)
+        if not data:
+            return
+        out_file.write(data)
+
+
+def record_after(fd, out_file, chunk_size):
+    streamer_dict = {'user_info': {'display_name': 'benchmark', 'login': 'benchmark'},
+                     'preferred_quality': 'best', 'stream_info': {}}
+    Watcher(streamer_dict, os.devnull, chunk_size)._record(fd, out_file)
+
+
+def run(name, record, total, output):
+    with open(output, 'ab', buffering=-1 if name.startswith('before') else RECORD_CHUNK_SIZE) as out_file:
+        wall, cpu = time.perf_counter(), time.process_time()
+        record(out_file)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    # recordings one core keeps up with, from the CPU time per byte
+    streams_per_core = (total / cpu) / (STREAM_BITRATE / 8) if cpu else float('inf')
+    print(f"{name:<28} {total / wall / 2 ** 20:9.1f} MiB/s   {cpu:6.2f} s CPU   "
+          f"~{streams_per_core:,.0f} 8 Mbit/s streams per core")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput and CPU time of the recording loop, reading a fake '
+                                                 'stream with 1 KiB reads (before) and with Watcher._record.')
+    parser.add_argument('--megabytes', type=int, default=1024)
+    parser.add_argument('--chunk-kib', type=int, default=RECORD_CHUNK_SIZE // 1024)
+    parser.add_argument('--output', default=os.devnull, help='file to record into, /dev/null by default')
+    args = parser.parse_args()
+    total = args.megabytes * 2 ** 20
+    chunk_size = args.chunk_kib * 1024
+
+    print(f"{args.megabytes} MiB into {args.output}")
+    run('before (read 1 KiB)', lambda out: record_before(FakeStream(total), out), total, args.output)
+    run(f'after (read {args.chunk_kib} KiB)', lambda out: record_after(ReadOnlyStream(total), out, chunk_size),
+        total, args.output)
+    run(f'after (readinto {args.chunk_kib} KiB)', lambda out: record_after(FakeStream(total), out, chunk_size),
+        total, args.output)
+    if args.output != os.devnull:
+        os.remove(args.output)
+
+
+if __name__ == '__main__':
+    main()
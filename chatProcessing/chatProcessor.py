@@ -0,0 +1,145 @@
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_sink import open_chat_file
+from chatProcessing.hotspots import DEFAULT_SETTINGS, message_weight
+from videoProcessing.videoWorker import construct_segments_json_path
+
+def load_chat(chat_path):
+    """
+    Read an NDJSON chat file written by Watcher.download_chat.
+    :param chat_path: Path to the chat file, optionally .gz or .zst compressed
+    :return: (timestamps in microseconds as sorted int64 array, messages in the same order)
+    """
+    messages = []
+    with open_chat_file(chat_path) as chat_file:
+        for line in chat_file:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue  # a line cut off by a crash
+            if message.get('timestamp') is not None:
+                messages.append(message)
+    timestamps = np.fromiter((m['timestamp'] for m in messages), dtype=np.int64, count=len(messages))
+    order = np.argsort(timestamps, kind='stable')
+    return timestamps[order], [messages[i] for i in order]
+
+
+def message_weights(messages, keyword_weights, emote_weights):
+    """Every message counts 1, plus the weights of the keywords and emotes it contains."""
+    if not keyword_weights and not emote_weights:
+        return np.ones(len(messages))
+    keyword_weights = {k.lower(): w for k, w in keyword_weights.items()}
+    return np.fromiter((message_weight(m.get('message'), keyword_weights, emote_weights) for m in messages),
+                       dtype=np.float64, count=len(messages))
+
+
+def _trailing_sum(values, window):
+    cumsum = np.concatenate(([0.0], np.cumsum(values)))
+    start = np.maximum(np.arange(1, len(values) + 1) - window, 0)
+    return cumsum[1:] - cumsum[start]
+
+
+def find_bursts(counts, settings):
+    """
+    Find runs of bins whose rolling message rate stands out against the preceding baseline.
+    :param counts: weighted message count per bin
+    :return: list of (first_bin, last_bin, peak z-score)
+    """
+    window = settings['window_bins']
+    baseline = settings['baseline_bins']
+    rate = _trailing_sum(counts, window)
+
+    # mean and standard deviation of the rate over the baseline bins before the current one
+    cumsum = np.concatenate(([0.0], np.cumsum(rate)))
+    cumsum_sq = np.concatenate(([0.0], np.cumsum(rate * rate)))
+    idx = np.arange(len(rate))
+    lo = np.maximum(idx - baseline, 0)
+    n = np.maximum(idx - lo, 1)
+    mean = (cumsum[idx] - cumsum[lo]) / n
+    std = np.sqrt(np.maximum((cumsum_sq[idx] - cumsum_sq[lo]) / n - mean * mean, 0.0))
+    z = (rate - mean) / np.maximum(std, 1.0)
+
+    # the first bins have no baseline to compare against
+    hot = (z >= settings['z_threshold']) & (rate >= settings['min_window_messages']) & (idx >= window)
+    edges = np.diff(np.concatenate(([0], hot.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) - 1
+
+    bursts = []
+    for first, last in zip(starts, ends):
+        peak = float(z[first:last + 1].max())
+        if bursts and first - bursts[-1][1] <= settings['merge_gap_bins'] + 1:
+            prev_first, _, prev_peak = bursts[-1]
+            bursts[-1] = (prev_first, last, max(prev_peak, peak))
+        else:
+            bursts.append((first, last, peak))
+    return bursts
+
+
+def segment_chat(chat_path, settings=None, segments_path=None):
+    """
+    Detect chat bursts and write them as timeframes for videoWorker.make_clips.
+    Timeframes hold 'start' and 'end' in microseconds since the first chat message and the peak z-score as
+    'score', with `include_messages` also the 'messages' inside them.
+    :param chat_path: Path to the chat file
+    :param settings: overrides for DEFAULT_SETTINGS
+    :param segments_path: output path, by default the path videoWorker looks for
+    :return: dict with segments_path, messages, segments and processing_time
+    """
+    start_time = time.time()
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    if segments_path is None:
+        segments_path = segments_path_for_chat(chat_path)
+
+    timestamps, messages = load_chat(chat_path)
+    timeframes = []
+    if len(timestamps):
+        bin_us = int(settings['bin_seconds'] * 1e6)
+        offsets = timestamps - timestamps[0]
+        weights = message_weights(messages, settings['keyword_weights'], settings['emote_weights'])
+        counts = np.bincount(offsets // bin_us, weights=weights)
+
+        for first, last, peak in find_bursts(counts, settings):
+            # the rolling window trails the rate, so the burst started up to one window earlier
+            start = max(first - settings['window_bins'] + 1, 0) * bin_us
+            end = (last + 1) * bin_us
+            timeframe = {'start': int(start), 'end': int(end), 'score': round(peak, 2)}
+            if settings['include_messages']:
+                lo, hi = np.searchsorted(offsets, [start, end])
+                timeframe['messages'] = messages[lo:hi]
+            timeframes.append(timeframe)
+
+    os.makedirs(os.path.dirname(segments_path), exist_ok=True)
+    with open(segments_path, 'w') as segments_file:
+        json.dump(timeframes, segments_file)
+
+    return {'segments_path': segments_path, 'messages': len(messages), 'segments': len(timeframes),
+            'processing_time': time.time() - start_time}
+
+
+def segments_path_for_chat(chat_path):
+    """The chat file is named like the video plus 'chat.json', the segments file is found through the video name."""
+    chat_filename = os.path.basename(chat_path)
+    video_base = chat_filename[:chat_filename.rindex('chat.json')]
+    return construct_segments_json_path(video_base + '.mp4')
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: python chatProcessor.py <chat_path>")
+        sys.exit(1)
+
+    result = segment_chat(sys.argv[1])
+    print(f"{result['segments']} segments from {result['messages']} messages "
+          f"in {result['processing_time']:.2f} seconds: {result['segments_path']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import json
+import math
+import os
+from collections import deque
+
+DEFAULT_SETTINGS = {
+    'bin_seconds': 5,  # resolution of the message rate
+    'window_bins': 6,  # rolling rate over 30 seconds
+    'baseline_bins': 120,  # a burst is measured against the last 10 minutes
+    'z_threshold': 4.0,
+    'min_window_messages': 10,  # ignore "bursts" of a handful of messages in a dead chat
+    'merge_gap_bins': 2,  # hot windows at most 10 seconds apart form one segment
+    'keyword_weights': {},  # e.g. {"clip": 3}, matched case-insensitively anywhere in a message
+    'emote_weights': {},  # e.g. {"KEKW": 2, "PogChamp": 2}, matched against whole words
+    'include_messages': False,  # clip chat is read from the chat store, copying it into segments is only needed without one
+}
+PARTIAL_SUFFIX = '.partial'  # segments found so far, segments_path itself only appears once the chat is complete
+
+
+def message_weight(text, keyword_weights, emote_weights):
+    """A message counts 1, plus the weights of the keywords and emotes it contains.
+    keyword_weights must have lowercase keys."""
+    weight = 1.0
+    if not text:
+        return weight
+    if keyword_weights:
+        lowered = text.lower()
+        for keyword, keyword_weight in keyword_weights.items():
+            if keyword in lowered:
+                weight += keyword_weight
+    if emote_weights:
+        for word in text.split():
+            weight += emote_weights.get(word, 0)
+    return weight
+
+
+class HotspotDetector:
+    """Finds chat bursts while the chat is being recorded.
+    Works like chatProcessor.segment_chat on a stream of messages: the weighted message rate over a trailing
+    window is compared to the mean and standard deviation of the rates before it. Every finished segment is
+    written to segments_path + PARTIAL_SUFFIX right away, close() publishes the file at segments_path in the
+    format videoWorker.make_clips reads. A recording that never got closed leaves only the partial file behind, so
+    the chat is segmented again from the full chat file.
+    """
+
+    def __init__(self, segments_path, settings=None):
+        self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        self.segments_path = segments_path
+        self.bin_us = int(self.settings['bin_seconds'] * 1e6)
+        self.window = self.settings['window_bins']
+        self.baseline = self.settings['baseline_bins']
+        self.keyword_weights = {k.lower(): w for k, w in self.settings['keyword_weights'].items()}
+        self.emote_weights = self.settings['emote_weights']
+        self.include_messages = self.settings['include_messages']
+
+        self.first_timestamp = None
+        self.bin = 0  # index of the bin messages are currently counted into
+        self.bin_count = 0.0
+        self.window_counts = deque()
+        self.window_sum = 0.0
+        self.rates = deque()  # window rates of the baseline bins
+        self.rates_sum = 0.0
+        self.rates_sq_sum = 0.0
+        self.recent = deque()  # (offset, message) of the last window, a segment starts up to one window back
+        self.segment = None  # open segment: dict with first, last, peak and messages
+        self.timeframes = []
+
+    def add(self, message):
+        timestamp = message.get('timestamp')
+        if timestamp is None:
+            return
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        offset = timestamp - self.first_timestamp
+        # a late message is counted into the current bin
+        message_bin = max(offset // self.bin_us, self.bin)
+        while self.bin < message_bin:
+            self._finish_bin()
+
+        self.bin_count += message_weight(message.get('message'), self.keyword_weights, self.emote_weights)
+        if self.include_messages:
+            self.recent.append((offset, message))
+            if self.segment:
+                self.segment['messages'].append((offset, message))
+
+    def close(self):
+        """Finishes the last bin and segment and writes the final segments file."""
+        if self.first_timestamp is not None:
+            self._finish_bin()
+        if self.segment:
+            self._close_segment()
+        self._write(self.segments_path)
+        try:
+            os.remove(self.segments_path + PARTIAL_SUFFIX)
+        except FileNotFoundError:
+            pass
+        return self.timeframes
+
+    def _finish_bin(self):
+        i = self.bin
+        self.window_counts.append(self.bin_count)
+        self.window_sum += self.bin_count
+        if len(self.window_counts) > self.window:
+            self.window_sum -= self.window_counts.popleft()
+        rate = self.window_sum
+
+        n = len(self.rates)
+        mean = self.rates_sum / n if n else 0.0
+        std = math.sqrt(max(self.rates_sq_sum / n - mean * mean, 0.0)) if n else 0.0
+        z = (rate - mean) / max(std, 1.0)
+        hot = z >= self.settings['z_threshold'] and rate >= self.settings['min_window_messages'] and i >= self.window
+
+        self.rates.append(rate)
+        self.rates_sum += rate
+        self.rates_sq_sum += rate * rate
+        if len(self.rates) > self.baseline:
+            old = self.rates.popleft()
+            self.rates_sum -= old
+            self.rates_sq_sum -= old * old
+
+        merge_distance = self.settings['merge_gap_bins'] + 1
+        if hot:
+            if self.segment and i - self.segment['last'] <= merge_distance:
+                self.segment['last'] = i
+                self.segment['peak'] = max(self.segment['peak'], z)
+            else:
+                if self.segment:
+                    self._close_segment()
+                start = max(i - self.window + 1, 0) * self.bin_us
+                self.segment = {'first': i, 'last': i, 'peak': z, 'start': start,
+                                'messages': [(o, m) for o, m in self.recent if o >= start]}
+        elif self.segment and i - self.segment['last'] >= merge_distance:
+            self._close_segment()
+
+        self.bin += 1
+        self.bin_count = 0.0
+        keep_from = max(self.bin - self.window + 1, 0) * self.bin_us
+        while self.recent and self.recent[0][0] < keep_from:
+            self.recent.popleft()
+
+    def _close_segment(self):
+        segment = self.segment
+        self.segment = None
+        end = (segment['last'] + 1) * self.bin_us
+        timeframe = {'start': segment['start'], 'end': end, 'score': round(segment['peak'], 2)}
+        if self.include_messages:
+            timeframe['messages'] = [m for o, m in segment['messages'] if o < end]
+        self.timeframes.append(timeframe)
+        self._write(self.segments_path + PARTIAL_SUFFIX)
+
+    def _write(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as segments_file:
+            json.dump(self.timeframes, segments_file)
+        os.replace(tmp_path, path)
@@ -0,0 +1,297 @@
+import queue
+import random
+import socket
+import threading
+import time
+
+TWITCH_IRC_HOST = 'irc.chat.twitch.tv'
+TWITCH_IRC_PORT = 6667
+CHANNELS_PER_CONNECTION = 50
+JOINS_PER_WINDOW = 20  # twitch allows 20 JOINs per 10 seconds for anonymous users
+JOIN_WINDOW_SECONDS = 10
+RECONNECT_DELAY_SECONDS = 5
+WRITER_THREADS = 4  # threads calling the channel handlers, shared by all channels
+
+
+def _unescape_tag(value):
+    return value.replace('\\s', ' ').replace('\\:', ';').replace('\\\\', '\\')
+
+
+def parse_irc_line(line):
+    """
+    Split an IRCv3 line into its parts.
+    :param line: line without the trailing CRLF
+    :return: (tags dict, prefix, command, params list)
+    """
+    tags = {}
+    if line.startswith('@'):
+        raw_tags, _, line = line[1:].partition(' ')
+        for tag in raw_tags.split(';'):
+            key, _, value = tag.partition('=')
+            tags[key] = _unescape_tag(value)
+    prefix = ''
+    if line.startswith(':'):
+        prefix, _, line = line[1:].partition(' ')
+    line, _, trailing = line.partition(' :')
+    params = line.split()
+    command = params.pop(0) if params else ''
+    if trailing:
+        params.append(trailing)
+    return tags, prefix, command, params
+
+
+class ChatConnection:
+    """One anonymous IRC connection that reads the chat of several channels on its own thread."""
+
+    def __init__(self, multiplexer, name):
+        self.multiplexer = multiplexer
+        self.name = name
+        self.channels = set()
+        self.sock = None
+        self.closed = False
+        self._send_lock = threading.Lock()
+        self._joined = set()  # channels a JOIN was sent for on the current socket
+        self._joins = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+        threading.Thread(target=self._send_joins, name=name + '-joins', daemon=True).start()
+
+    def _send(self, line):
+        with self._send_lock:
+            if self.sock:
+                self.sock.sendall((line + '\r\n').encode('utf-8'))
+
+    def join(self, channel):
+        self.channels.add(channel)
+        self._joins.put(channel)
+
+    def leave(self, channel):
+        self.channels.discard(channel)
+        with self._send_lock:
+            self._joined.discard(channel)
+        try:
+            self._send('PART #' + channel)
+        except OSError:
+            pass  # the channel is not joined again on reconnect anyway
+
+    def close(self):
+        self.closed = True
+        self._joins.put(None)
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _needs_join(self, channel):
+        # not while disconnected, the reconnect queues every channel again
+        return self.sock is not None and channel in self.channels and channel not in self._joined
+
+    def _send_join(self, channel):
+        with self._send_lock:
+            if not self._needs_join(channel):
+                return False
+            self.sock.sendall(('JOIN #' + channel + '\r\n').encode('utf-8'))
+            self._joined.add(channel)
+            return True
+
+    def _send_joins(self):
+        # JOINs are sent from their own thread so the rate limit never blocks callers or the reader. Only JOINs
+        # that are sent count against it, a channel queued twice or left again before it was joined does not.
+        join_times = []
+        while (channel := self._joins.get()) is not None:
+            if not self._needs_join(channel):
+                continue
+            now = time.monotonic()
+            join_times = [t for t in join_times if now - t < JOIN_WINDOW_SECONDS]
+            if len(join_times) >= JOINS_PER_WINDOW:
+                time.sleep(JOIN_WINDOW_SECONDS - (now - join_times[0]))
+            try:
+                if self._send_join(channel):
+                    join_times.append(time.monotonic())
+            except OSError:
+                pass  # joined again after the reconnect
+
+    def _connect(self):
+        sock = socket.create_connection((self.multiplexer.host, self.multiplexer.port), timeout=60)
+        # registered before the socket is handed to the JOIN thread, JOINs sent before NICK are ignored
+        sock.sendall(('CAP REQ :twitch.tv/tags twitch.tv/commands\r\nPASS SCHMOOPIIE\r\n'
+                      f'NICK justinfan{random.randint(10000, 99999)}\r\n').encode('utf-8'))
+        with self._send_lock:
+            self.sock = sock
+            self._joined = set()
+        for channel in list(self.channels):
+            self._joins.put(channel)
+
+    def _run(self):
+        while not self.closed:
+            try:
+                self._connect()
+                self._read()
+            except OSError as e:
+                if not self.closed:
+                    print(f'Chat connection {self.name} lost: {e}')
+            finally:
+                with self._send_lock:
+                    sock, self.sock = self.sock, None
+                if sock:
+                    sock.close()
+            if not self.closed:
+                time.sleep(RECONNECT_DELAY_SECONDS)
+
+    def _read(self):
+        buffer = b''
+        while not self.closed:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                self._send('PING :tmi.twitch.tv')  # idle connection, make sure it is still alive
+                continue
+            if not data:
+                raise ConnectionError('connection closed by server')
+            buffer += data
+            *lines, buffer = buffer.split(b'\r\n')
+            for line in lines:
+                self._handle(line.decode('utf-8', errors='replace'))
+
+    def _handle(self, line):
+        tags, prefix, command, params = parse_irc_line(line)
+        if command == 'PING':
+            self._send('PONG :' + (params[0] if params else 'tmi.twitch.tv'))
+        elif command == 'RECONNECT':
+            raise ConnectionError('server asked to reconnect')
+        elif command == 'PRIVMSG' and len(params) == 2:
+            channel = params[0].lstrip('#')
+            sent_ts = tags.get('tmi-sent-ts')
+            message = {
+                'timestamp': int(sent_ts) * 1000 if sent_ts else int(time.time() * 1e6),
+                'message': params[1],
+                'message_type': 'text_message',
+            }
+            self.multiplexer.dispatch(self, channel, message)
+
+
+class _Channel:
+    """A joined channel: its connection, its handler and the number of its messages waiting for the handler."""
+
+    def __init__(self, name, connection, handler):
+        self.name = name
+        self.connection = connection
+        self.handler = handler
+        self._pending = 0
+        self._idle = threading.Condition()
+
+    def add_pending(self):
+        with self._idle:
+            self._pending += 1
+
+    def done(self):
+        with self._idle:
+            self._pending -= 1
+            if not self._pending:
+                self._idle.notify_all()
+
+    def wait_idle(self):
+        with self._idle:
+            while self._pending:
+                self._idle.wait()
+
+
+class ChannelWriters:
+    """A fixed number of threads that hand the messages to the channel handlers, so a handler that waits for the
+    disk does not hold up the reader thread and with it the other channels of the connection. Every channel is
+    handled by the thread of its shard, which keeps its messages in order."""
+
+    def __init__(self, threads=WRITER_THREADS):
+        self._queues = [queue.SimpleQueue() for _ in range(threads)]
+        self._threads = [threading.Thread(target=self._run, args=(messages,), name=f'chat-writer-{i}', daemon=True)
+                         for i, messages in enumerate(self._queues)]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, channel, message):
+        """Queues a message of a channel, the channel has to count it as pending first."""
+        self._queues[hash(channel.name) % len(self._queues)].put((channel, message))
+
+    def _run(self, messages):
+        while (item := messages.get()) is not None:
+            channel, message = item
+            try:
+                channel.handler(message)
+            except Exception as e:
+                print(f'Error handling chat message of {channel.name}: {e}')
+            finally:
+                channel.done()
+
+    def on_writer_thread(self):
+        return threading.current_thread() in self._threads
+
+    def close(self):
+        """Stops the writers once the queued messages are handled and waits for that."""
+        for messages in self._queues:
+            messages.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+
+class ChatMultiplexer:
+    """Reads the chat of many channels over a few shared IRC connections.
+    Every joined channel gets a handler that is called with message dicts in the format of Watcher.download_chat,
+    in order and always from the same one of the shared writer threads.
+    """
+
+    def __init__(self, host=TWITCH_IRC_HOST, port=TWITCH_IRC_PORT, channels_per_connection=CHANNELS_PER_CONNECTION,
+                 writer_threads=WRITER_THREADS):
+        self.host = host
+        self.port = port
+        self.channels_per_connection = channels_per_connection
+        self.connections = []
+        self.writers = ChannelWriters(writer_threads)
+        self._channels = {}  # channel name -> _Channel
+        self._lock = threading.Lock()
+
+    def join(self, channel, handler):
+        channel = channel.lower()
+        with self._lock:
+            if channel in self._channels:
+                self._channels[channel].handler = handler
+                return
+            connection = next((c for c in self.connections if len(c.channels) < self.channels_per_connection), None)
+            if connection is None:
+                connection = ChatConnection(self, f'chat-{len(self.connections)}')
+                self.connections.append(connection)
+            self._channels[channel] = _Channel(channel, connection, handler)
+        connection.join(channel)
+
+    def leave(self, channel):
+        """Stops the chat of a channel. Once this returns its handler is not called anymore."""
+        channel = channel.lower()
+        with self._lock:
+            state = self._channels.pop(channel, None)
+        if state:
+            state.connection.leave(channel)
+            # messages that arrived before the leave are still handled, a handler leaving its own channel cannot
+            # wait for itself
+            if not self.writers.on_writer_thread():
+                state.wait_idle()
+
+    def dispatch(self, connection, channel, message):
+        with self._lock:
+            state = self._channels.get(channel)
+            if state:
+                state.add_pending()  # under the lock, so a leave that follows waits for this message
+        if state:
+            self.writers.put(state, message)
+
+    def channel_count(self):
+        with self._lock:
+            return len(self._channels)
+
+    def close(self):
+        with self._lock:
+            self._channels.clear()
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+        self.writers.close()
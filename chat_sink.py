@@ -0,0 +1,140 @@
+import gzip
+import io
+import json
+import os
+import threading
+import time
+import zlib
+
+COMPRESSION_SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+FLUSH_CHECK_SECONDS = 1.0  # how often the open sinks are checked for a batch that is due
+
+
+class _Flusher:
+    """One thread that flushes the pending batch of every open sink once its flush_interval passed, so a chat that
+    goes quiet is still written on time without a thread per sink. Started with the first sink."""
+
+    def __init__(self):
+        self._sinks = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, sink):
+        with self._lock:
+            self._sinks.add(sink)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='chat-flush', daemon=True)
+                self._thread.start()
+
+    def remove(self, sink):
+        with self._lock:
+            self._sinks.discard(sink)
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_CHECK_SECONDS)
+            with self._lock:
+                sinks = list(self._sinks)
+            for sink in sinks:
+                try:
+                    sink._flush_if_due()
+                except Exception as e:
+                    print(f'Error flushing chat to {sink.path}: {e}')
+
+
+_flusher = _Flusher()
+
+
+class ChatSink:
+    """Writes chat messages as NDJSON, optionally gzip or zstd compressed.
+    Messages are batched in memory and written once flush_messages are buffered or flush_interval seconds passed,
+    a thread shared by all sinks flushes the batch on time when the chat goes quiet. Every flush is a compression sync point
+    followed by an fsync, so a crash loses at most the current batch and everything written before it stays readable.
+    """
+
+    def __init__(self, path, compression=None, flush_messages=1000, flush_interval=5.0):
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                print('zstandard is not installed, writing gzip compressed chat instead.')
+                compression = 'gzip'
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f'Unknown chat compression: {compression}')
+
+        self.path = path + COMPRESSION_SUFFIXES[compression]
+        self.compression = compression
+        self.flush_messages = flush_messages
+        self.flush_interval = flush_interval
+        self.message_count = 0
+        self._lines = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._raw = open(self.path, 'ab')
+        if compression == 'gzip':
+            self._stream = gzip.GzipFile(fileobj=self._raw, mode='ab')
+        elif compression == 'zstd':
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._raw)
+        else:
+            self._stream = self._raw
+        if flush_interval:
+            _flusher.add(self)
+
+    def write(self, message):
+        line = json.dumps(message, separators=(',', ':'))
+        with self._lock:
+            self._lines.append(line)
+            self.message_count += 1
+            if len(self._lines) >= self.flush_messages or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def _flush_if_due(self):
+        with self._lock:
+            if self._lines and not self._raw.closed and time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._lines:
+            self._lines.append('')  # trailing newline
+            self._stream.write('\n'.join(self._lines).encode('utf-8'))
+            self._lines = []
+        if self.compression == 'gzip':
+            self._stream.flush(zlib.Z_SYNC_FLUSH)
+        elif self.compression == 'zstd':
+            import zstandard
+            self._stream.flush(zstandard.FLUSH_BLOCK)
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        _flusher.remove(self)
+        with self._lock:
+            if self._raw.closed:
+                return
+            self._flush()
+            if self._stream is not self._raw:
+                self._stream.close()  # writes the gzip trailer / zstd frame end
+            if not self._raw.closed:
+                self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_chat_file(path):
+    """Opens a chat NDJSON file for reading as text, whatever compression ChatSink wrote it with."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.zst'):
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True),
+                                encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
@@ -0,0 +1,79 @@
+import json
+import os
+import sqlite3
+
+from chat_sink import open_chat_file
+
+_INSERT_BATCH = 10000
+
+
+def chat_store_path(chat_path):
+    """The store lives next to the chat file: '<video>chat.json[.gz|.zst]' -> '<video>chat.sqlite'."""
+    directory, filename = os.path.split(chat_path)
+    return os.path.join(directory, filename[:filename.rindex('chat.json')] + 'chat.sqlite')
+
+
+def build_chat_store(chat_path, store_path=None):
+    """ Index an NDJSON chat file by timestamp in a SQLite file
+    :param chat_path: Path to the chat file, optionally .gz or .zst compressed
+    :param store_path: Path of the store, next to the chat file by default
+    :return: Path of the store
+    """
+    if store_path is None:
+        store_path = chat_store_path(chat_path)
+    tmp_path = store_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('CREATE TABLE messages (timestamp integer NOT NULL, message text, message_type text)')
+        conn.execute('CREATE TABLE meta (key text PRIMARY KEY, value integer)')
+        batch = []
+        with open_chat_file(chat_path) as chat_file:
+            for line in chat_file:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue  # a line cut off by a crash
+                if message.get('timestamp') is None:
+                    continue
+                batch.append((message['timestamp'], message.get('message'), message.get('message_type')))
+                if len(batch) >= _INSERT_BATCH:
+                    conn.executemany('INSERT INTO messages VALUES (?,?,?)', batch)
+                    batch = []
+        conn.executemany('INSERT INTO messages VALUES (?,?,?)', batch)
+        # offsets in chat segments count from the first message
+        conn.execute("INSERT INTO meta VALUES ('first_timestamp', (SELECT MIN(timestamp) FROM messages))")
+        conn.execute('CREATE INDEX messages_timestamp ON messages (timestamp)')
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, store_path)
+    return store_path
+
+
+class ChatStore:
+    """Reads chat messages of a time range from a store written by build_chat_store with one index range scan."""
+
+    def __init__(self, store_path):
+        self.conn = sqlite3.connect(store_path)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'first_timestamp'").fetchone()
+        self.first_timestamp = row[0] if row and row[0] is not None else 0
+
+    def messages_between(self, start, end):
+        """ Messages sent in [start, end]
+        :param start: microseconds since the first message
+        :param end: microseconds since the first message
+        :return: list of message dicts in timestamp order
+        """
+        rows = self.conn.execute('SELECT timestamp, message, message_type FROM messages '
+                                 'WHERE timestamp BETWEEN ? AND ? ORDER BY timestamp',
+                                 (self.first_timestamp + int(start), self.first_timestamp + int(end)))
+        return [{'timestamp': timestamp, 'message': message, 'message_type': message_type}
+                for timestamp, message, message_type in rows]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,160 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+import metrics
+from db_connection import create_connection, create_table, DATABASE
+from ffmpeg_runner import cancel_all
+from segments import finish_if_complete, set_part_status
+from streamConverter import convert_stream_to_mp4
+from videoProcessing.videoWorker import insert_video
+
+sql_create_conversions_table = """ CREATE TABLE IF NOT EXISTS conversions (
+                                       id integer PRIMARY KEY,
+                                       ts_file_path text NOT NULL,
+                                       chat_file_path text,
+                                       file_size integer NOT NULL DEFAULT 0,
+                                       status text NOT NULL DEFAULT 'queued',
+                                       queued_at real NOT NULL,
+                                       started_at real,
+                                       finished_at real,
+                                       manifest_path text
+                                   ); """
+
+
+class ConversionQueue:
+    """Converts finished recordings to mp4 with a bounded number of workers.
+    Queued jobs run smallest file first (oldest first on ties) and are kept in the conversions table, so jobs
+    that were queued or running when the daemon stopped are picked up again on the next start.
+    ffmpeg runs in its own process, so the workers are plain threads waiting on it.
+    Running conversions are cancelled on shutdown and start over on the next start.
+    Parts of a segmented recording are marked in their manifest instead of being inserted as videos, the last
+    converted part joins them.
+    """
+
+    def __init__(self, max_workers=2, database=DATABASE):
+        self.database = database
+        self._heap = []
+        self._seq = itertools.count()  # keeps heap entries comparable when size and age are equal
+        self._cond = threading.Condition()
+        self._running = {}  # job id -> ts_file_path
+        self._kill = False
+        self.recent_jobs = deque(maxlen=50)  # timings of finished jobs, newest last
+
+        conn = self._connect()
+        if conn is not None:
+            # jobs that were interrupted by a shutdown start over
+            conn.execute("UPDATE conversions SET status = 'queued', started_at = NULL WHERE status = 'running'")
+            conn.commit()
+            rows = conn.execute("SELECT id, ts_file_path, chat_file_path, file_size, queued_at, manifest_path "
+                                "FROM conversions WHERE status = 'queued'").fetchall()
+            conn.close()
+            for job_id, ts_file_path, chat_file_path, file_size, queued_at, manifest_path in rows:
+                heapq.heappush(self._heap, (file_size, queued_at, next(self._seq), job_id, ts_file_path,
+                                            chat_file_path, manifest_path))
+
+        self._workers = [threading.Thread(target=self._work, name=f'conversion-{i}', daemon=True)
+                         for i in range(max_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _connect(self):
+        conn = create_connection(self.database)
+        if conn is not None:
+            create_table(conn, sql_create_conversions_table)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(conversions)")}
+            if 'manifest_path' not in columns:  # tables from before segmented recording
+                conn.execute("ALTER TABLE conversions ADD COLUMN manifest_path text")
+                conn.commit()
+        return conn
+
+    def _update(self, sql, params):
+        with metrics.DB_OPERATION_SECONDS.labels('conversion_update').time():
+            conn = self._connect()
+            if conn is not None:
+                conn.execute(sql, params)
+                conn.commit()
+                conn.close()
+
+    def submit(self, ts_file_path, chat_file_path, manifest_path=None):
+        file_size = os.path.getsize(ts_file_path) if os.path.exists(ts_file_path) else 0
+        queued_at = time.time()
+        job_id = None
+        with metrics.DB_OPERATION_SECONDS.labels('conversion_insert').time():
+            conn = self._connect()
+            if conn is not None:
+                cur = conn.execute("INSERT INTO conversions(ts_file_path, chat_file_path, file_size, queued_at, "
+                                   "manifest_path) VALUES(?,?,?,?,?)",
+                                   (ts_file_path, chat_file_path, file_size, queued_at, manifest_path))
+                conn.commit()
+                job_id = cur.lastrowid
+                conn.close()
+        with self._cond:
+            heapq.heappush(self._heap, (file_size, queued_at, next(self._seq), job_id, ts_file_path, chat_file_path,
+                                        manifest_path))
+            self._cond.notify()
+        return job_id
+
+    def depth(self):
+        with self._cond:
+            return len(self._heap)
+
+    def stats(self):
+        with self._cond:
+            return {'queued': len(self._heap),
+                    'running': [f"{path} ({progress:.0%})" for path, progress in self._running.values()],
+                    'recent': list(self.recent_jobs)}
+
+    def shutdown(self):
+        with self._cond:
+            self._kill = True
+            self._cond.notify_all()
+        cancel_all()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._heap and not self._kill:
+                    self._cond.wait()
+                if self._kill:
+                    return
+                _, queued_at, _, job_id, ts_file_path, chat_file_path, manifest_path = heapq.heappop(self._heap)
+                self._running[job_id] = (ts_file_path, 0.0)
+
+            started_at = time.time()
+            self._update("UPDATE conversions SET status = 'running', started_at = ? WHERE id = ?",
+                         (started_at, job_id))
+
+            def on_progress(fraction, job_id=job_id, ts_file_path=ts_file_path):
+                with self._cond:
+                    self._running[job_id] = (ts_file_path, fraction)
+
+            try:
+                ok = convert_stream_to_mp4(ts_file_path, on_progress)
+                if manifest_path:
+                    set_part_status(manifest_path, ts_file_path, 'converted' if ok else 'failed')
+                    if ok:
+                        finish_if_complete(manifest_path)
+                elif ok:
+                    insert_video(ts_file_path.replace('.ts', '.mp4'), chat_file_path)
+            except Exception as e:
+                print(f"Error during conversion job {ts_file_path}: {e}")
+                ok = False
+            if not ok and self._kill:
+                return  # cancelled by shutdown, the job stays 'running' and is queued again on the next start
+            finished_at = time.time()
+            status = 'done' if ok else 'failed'
+            self._update("UPDATE conversions SET status = ?, finished_at = ? WHERE id = ?",
+                         (status, finished_at, job_id))
+            metrics.CONVERSION_WAIT_SECONDS.observe(started_at - queued_at)
+            metrics.CONVERSION_JOB_SECONDS.labels(status).observe(finished_at - started_at)
+
+            with self._cond:
+                self._running.pop(job_id, None)
+                self.recent_jobs.append({'ts_file_path': ts_file_path,
+                                         'status': status,
+                                         'wait_seconds': round(started_at - queued_at, 2),
+                                         'duration_seconds': round(finished_at - started_at, 2)})
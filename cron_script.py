@@ -1,9 +1,15 @@
+import json
+import multiprocessing
 import os
 import logging
+import socket
+import threading
 import twitch
-import db_connection
-import subprocess
-import time
+import job_queue
+from videoProcessing import videoWorker
+from chatProcessing.chatProcessor import segment_chat
+from chat_store import build_chat_store, chat_store_path
+from user_cache import resolve_logins
 from tg_bot import send_tg
 
 # Configure logging
@@ -23,11 +29,8 @@ def load_streamers_from_file(file_path):
     return streamers
 
 def fetch_streamer_user_ids(streamer_names):
-    user_ids = []
-    for streamer_name in streamer_names:
-        if user_info := twitch.get_user_info(streamer_name):
-            user_ids.append(user_info[0]['id'])
-    return user_ids
+    users = resolve_logins(streamer_names)
+    return [user_info['id'] for user_info in users.values()]
 
 def are_any_streamers_live(streamer_user_ids):
     if not streamer_user_ids:
@@ -43,53 +46,115 @@ def check_live_streams():
     streamer_user_ids = fetch_streamer_user_ids(streamer_names)
     return are_any_streamers_live(streamer_user_ids)
 
-# Now you can call check_live_streams in your process_videos function
-def process_videos():
-    database_path = "mp4_processing.db"
-    conn = db_connection.create_connection(database_path)
-
-    if conn is not None:
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, file_path, chat_file_path FROM videos WHERE processed = 0 AND id < 83")
-        videos = cursor.fetchall()
-
-        for video in videos:
-            if check_live_streams():
-                logging.info("Live streams are ongoing. Skipping video processing.")
-                # return
-            video_id, video_path, chat_path = video
-
-            try:
-                logging.info("Starting processing for video ID %s", video_id)
-
-                if checkIfFileExistREmoveIfNot(video_path, chat_path, video_id, cursor, conn) != True:
-                    continue
-                # Construct the path to chatProcessor.py
-                chat_processor_path = os.path.join(os.path.dirname(__file__), 'chatProcessing', 'chatProcessor.py')
-                # Call chatProcessor script
-                subprocess.run(['python', chat_processor_path, chat_path], check=True)
-
-                # Construct the path to videoWorker.py
-                video_worker_path = os.path.join(os.path.dirname(__file__), 'videoProcessing', 'videoWorker.py')
-
-                # Call videoProcessor script with video path and configuration path
-                subprocess.run(['python', video_worker_path, video_path, config_path], check=True)
-
-
-                # Update processed status to 2 (success)
-                cursor.execute("UPDATE videos SET processed = 2 WHERE id = ?", (video_id,))
-                logging.info("Finished processing for video ID %s", video_id)
-            except subprocess.CalledProcessError:
-                logging.error("Error processing video ID %s: %s", video_id, e)
-                # Update processed status to 1 (failed)
-                cursor.execute("UPDATE videos SET processed = 1 WHERE id = ?", (video_id,))
+def load_config():
+    try:
+        with open(config_path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        logging.error("Could not read config %s: %s", config_path, e)
+        return {}
 
-        conn.commit()
-        conn.close()
-    else:
+def process_videos():
+    conn = job_queue.connect()
+    if conn is None:
         logging.error("Failed to connect to the database")
+        return
+    job_queue.ensure_job_columns(conn)
+    logging.info("Jobs by state: %s", job_queue.count_jobs(conn))
+    conn.close()
+
+    if check_live_streams():
+        logging.info("Live streams are ongoing. Processing videos anyway.")
+
+    worker_count = load_config().get('job_workers', 4)
+    workers = [multiprocessing.Process(target=run_worker, args=(f"{socket.gethostname()}-{os.getpid()}-{i}",))
+               for i in range(worker_count)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+def run_worker(worker_id):
+    """Claims and processes jobs until the queue is drained."""
+    config = load_config()
+    conn = job_queue.connect()
+    if conn is None:
+        logging.error("Worker %s failed to connect to the database", worker_id)
+        return
+
+    while job := job_queue.claim_job(conn, worker_id):
+        video_id, video_path, chat_path = job
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=keep_lease, args=(video_id, worker_id, stop_heartbeat), daemon=True)
+        heartbeat.start()
+        try:
+            state, error = process_video(conn, video_id, video_path, chat_path, config)
+        except Exception as e:
+            logging.exception("Error processing video ID %s: %s", video_id, e)
+            state, error = job_queue.FAILED, str(e)
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+        job_queue.finish_job(conn, video_id, worker_id, state, error)
+    conn.close()
+
+def keep_lease(video_id, worker_id, stop_event):
+    conn = job_queue.connect()
+    if conn is None:
+        return
+    while not stop_event.wait(job_queue.LEASE_SECONDS / 3):
+        if not job_queue.heartbeat(conn, video_id, worker_id):
+            logging.error("Worker %s lost the lease on video ID %s", worker_id, video_id)
+            break
+    conn.close()
+
+def run_chat_stage(chat_path, video_path, config):
+    """Indexes the chat for per-clip slicing and segments it, unless the segments were already found while recording.
+    :return: segment_chat result or None if the segmentation was skipped
+    """
+    if not os.path.exists(chat_store_path(chat_path)):
+        build_chat_store(chat_path)
+    segments_path = videoWorker.construct_segments_json_path(video_path)
+    if config.get('use_live_chat_segments', True) and os.path.exists(segments_path):
+        return None
+    return segment_chat(chat_path, config.get('chat_segmentation'), segments_path)
+
+def run_video_stage(video_path, chat_path, config):
+    timeframes_json = videoWorker.construct_segments_json_path(video_path)
+    return videoWorker.make_clips(video_path, timeframes_json, config_path, config=config,
+                                  chat_store_path=chat_store_path(chat_path))
+
+def process_video(conn, video_id, video_path, chat_path, config):
+    logging.info("Starting processing for video ID %s", video_id)
+
+    if not checkIfFileExistREmoveIfNot(video_path, chat_path, video_id):
+        return job_queue.FAILED, "missing or empty file"
 
-def checkIfFileExistREmoveIfNot(video_path, chat_path, video_id, cursor, conn):
+    try:
+        job_queue.mark_stage(conn, video_id, 'chat_started_at')
+        result = run_chat_stage(chat_path, video_path, config)
+        job_queue.mark_stage(conn, video_id, 'chat_finished_at')
+        if result:
+            logging.info("Found %s chat segments in %s messages of video ID %s in %.2f seconds", result['segments'],
+                         result['messages'], video_id, result['processing_time'])
+        else:
+            logging.info("Using chat segments found while recording video ID %s", video_id)
+    except (OSError, ValueError) as e:
+        logging.error("Error processing chat of video ID %s: %s", video_id, e)
+        return job_queue.FAILED, str(e)
+
+    job_queue.mark_stage(conn, video_id, 'video_started_at')
+    result = run_video_stage(video_path, chat_path, config)
+    job_queue.mark_stage(conn, video_id, 'video_finished_at')
+    if result['error']:
+        logging.error("Error processing video ID %s: %s", video_id, result['error'])
+        return job_queue.FAILED, result['error']
+
+    logging.info("Finished processing for video ID %s: %s clips in %.2f seconds, %s failed", video_id,
+                 result['success_count'], result['processing_time'], result['failure_count'])
+    return job_queue.DONE, None
+
+def checkIfFileExistREmoveIfNot(video_path, chat_path, video_id):
     video_exists = os.path.exists(video_path) and os.path.getsize(video_path) > 0
     chat_exists = os.path.exists(chat_path) and os.path.getsize(chat_path) > 0
 
@@ -110,8 +175,6 @@ def checkIfFileExistREmoveIfNot(video_path, chat_path, video_id, cursor, conn):
         cursor.execute("DELETE FROM videos WHERE id = ?", (video_id,))
         conn.commit()
         '''
-        cursor.execute("UPDATE videos SET processed = 1 WHERE id = ?", (video_id,))
-        conn.commit()
         return False
     return True
 
@@ -1,13 +1,24 @@
+import asyncio
 import logging
 import os
+import sqlite3
 import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer
 
 import ATRHandler
+import job_queue
+import metrics
 import twitch
-from utils import get_client_id, StreamQualities
-from watcher import Watcher
+from conversion_queue import ConversionQueue
+from eventsub import MessageDeduper
+from chat_ingest import ChatMultiplexer
+from stream_resolver import StreamResolver
+from streamer_registry import StreamerRegistry, IDLE, LIVE, RECORDING
+from user_cache import resolve_logins
+from utils import get_client_id, get_webhook_secret, StreamQualities
+from watcher import Watcher, RECORD_CHUNK_SIZE
 from tg_bot import send_tg
 
 class Daemon(HTTPServer):
@@ -15,29 +26,84 @@ class Daemon(HTTPServer):
     # CONSTANTS
     #
     VALID_BROADCAST = ['live']  # 'rerun' can be added through commandline flags/options
-    WEBHOOK_SECRET = 'automaticTwitchRecorder'
     WEBHOOK_URL_PREFIX = 'https://api.twitch.tv/helix/streams?user_id='
     LEASE_SECONDS = 864000  # 10 days = 864000
     check_interval = 10
+    reconcile_interval = 300  # polling interval while EventSub notifications report stream changes
+    conversion_workers = 2  # ffmpeg conversions running at the same time
+    request_workers = 8  # requests handled at the same time
+    request_backlog = 64  # requests waiting for a worker before new ones are answered with 503
+    event_workers = 4  # EventSub notifications and subscriptions handled at the same time
 
     def __init__(self, server_address, RequestHandlerClass, streamers_file=None):
+        # requests run on their own pool, so a slow command or webhook does not block the accept loop
+        self.request_pool = ThreadPoolExecutor(max_workers=self.request_workers, thread_name_prefix='request')
+        self._request_slots = threading.BoundedSemaphore(self.request_workers + self.request_backlog)
         super().__init__(server_address, RequestHandlerClass)
         self.PORT = server_address[1]
-        self.streamers = {}  # holds all streamers that need to be surveilled
-        self.watched_streamers = {}  # holds all live streamers that are currently being recorded
+        # all streamers on the watchlist with their state (idle, live, recording, converting) and watcher
+        self.registry = StreamerRegistry()
         self.client_id = get_client_id()
+        self.webhook_secret = get_webhook_secret()  # signs the webhook messages sent to this server
         self.kill = False
         self.started = False
+        self.poll_thread = None
         self.download_folder = os.getcwd() + os.path.sep + "#streamer#"
+        self.record_chunk_size = RECORD_CHUNK_SIZE
+        self.recorder_backend = 'streamlink'  # or 'hls' to fetch the playlist segments in parallel (hls_reader)
+        self.stream_resolver = StreamResolver()  # one streamlink session for all recordings
+        self.prefetch_streams = True  # resolve the stream qualities as soon as a streamer is seen going live
+        self.eventsub_callback_url = None  # public url of this server, set to get stream changes pushed
+        self.eventsub_messages = MessageDeduper()
+        self.live_remux = False  # remux to mp4 while recording instead of converting the .ts afterwards
+        self.chat_compression = None  # None, 'gzip' or 'zstd'
+        self.live_hotspots = True  # find chat hotspots while recording instead of in a later pass
+        # rotate recordings into parts that are converted during the stream, None records one file per stream
+        self.segment_seconds = None
+        self.segment_bytes = None
+        # read the chat of all live streamers over a few shared connections instead of one thread each
+        self.chat_multiplexer = ChatMultiplexer()
         # ThreadPoolExecutor(max_workers): If max_workers is None or not given, it will default to the number of
         # processors on the machine, multiplied by 5
         self.pool = ThreadPoolExecutor()
+        # notifications and subscriptions get their own threads, recordings can hold all threads of the pool
+        self.event_pool = ThreadPoolExecutor(max_workers=self.event_workers, thread_name_prefix='eventsub')
+        self.conversion_queue = ConversionQueue(self.conversion_workers)
+        metrics.CONVERSION_QUEUE_DEPTH.set_function(self.conversion_queue.depth)
+        metrics.RECORDINGS_ACTIVE.set_function(lambda: len(self.registry.in_state(RECORDING)))
+        metrics.add_collector(self._collect_clip_metrics)
         if streamers_file:
             self.load_streamers_from_file(streamers_file)
 
+    def process_request(self, request, client_address):
+        if not self._request_slots.acquire(blocking=False):
+            # overloaded, answer right away instead of letting the queue grow
+            try:
+                request.sendall(b'HTTP/1.0 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n')
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self.request_pool.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._request_slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.request_pool.shutdown(wait=False)
+
     def add_streamer(self, streamer, quality=StreamQualities.BEST.value):
-        streamer = streamer.lower()
-        streamer_dict = {}
+        return self.add_streamers([streamer], quality)
+
+    def add_streamers(self, streamers, quality=StreamQualities.BEST.value):
+        streamers = [streamer.lower() for streamer in streamers]
         resp = []
         ok = False
         qualities = [q.value for q in StreamQualities]
@@ -45,36 +111,36 @@ class Daemon(HTTPServer):
             resp.append('Invalid quality: ' + quality + '.')
             resp.append('Quality options: ' + str(qualities))
         else:
-            streamer_dict.update({'preferred_quality': quality})
-
-            # get channel id of streamer
-            user_info = list(twitch.get_user_info(streamer))
-
-            # check if user exists
-            if user_info:
-                streamer_dict.update({'user_info': user_info[0]})
-                self.streamers.update({streamer: streamer_dict})
-                resp.append('Successfully added ' + streamer + ' to watchlist.')
-                ok = True
-            else:
-                resp.append('Invalid streamer name: ' + streamer + '.')
+            # get channel ids of streamers, cached ones are not requested again
+            users = resolve_logins(streamers)
+
+            # check if users exist
+            ok = True
+            for streamer in streamers:
+                if streamer in users:
+                    self.registry.add(streamer, users[streamer], quality)
+                    if self.eventsub_callback_url:
+                        self.event_pool.submit(self._subscribe, users[streamer])
+                    resp.append('Successfully added ' + streamer + ' to watchlist.')
+                else:
+                    resp.append('Invalid streamer name: ' + streamer + '.')
+                    ok = False
         return ok, resp
 
     def remove_streamer(self, streamer):
         streamer = streamer.lower()
-        if streamer in self.streamers.keys():
-            self.streamers.pop(streamer)
-            return True, 'Removed ' + streamer + ' from watchlist.'
-        elif streamer in self.watched_streamers.keys():
-            watcher = self.watched_streamers[streamer]['watcher']
-            watcher.quit()
-            return True, 'Removed ' + streamer + ' from watchlist.'
-        else:
+        entry = self.registry.remove(streamer)
+        if entry is None:
             return False, 'Could not find ' + streamer + '. Already removed?'
+        self.stream_resolver.forget(streamer)
+        if entry.watcher:
+            entry.watcher.quit()
+        return True, 'Removed ' + streamer + ' from watchlist.'
 
     def start(self):
         if not self.started:
-            self._check_streams()
+            self.poll_thread = threading.Thread(target=self._run_poller, name='poller', daemon=True)
+            self.poll_thread.start()
             self.started = True
             return 'Daemon is started.'
         else:
@@ -90,61 +156,161 @@ class Daemon(HTTPServer):
         self.download_folder = download_folder
         return 'Download folder is now set to \'' + download_folder + '\' .'
 
-    def _check_streams(self):
-        user_ids = [self.streamers[s]['user_info']['id'] for s in self.streamers]
-        stream_info = twitch.get_stream_info(*user_ids)
+    def set_live_remux(self, enabled):
+        self.live_remux = enabled
+        return 'Live remux is now ' + ('on' if enabled else 'off') + '.'
 
-        live_streamers = []
+    def set_segment_minutes(self, minutes):
+        if minutes <= 0:
+            self.segment_seconds = None
+            return 'Streams are recorded into one file.'
+        self.segment_seconds = minutes * 60
+        return 'Streams are recorded in parts of ' + str(minutes) + ' minutes.'
 
-        # Process each streamer based on their status
-        for streamer_name, info in self.streamers.items():
-            user_id = info['user_info']['id']
-            status = stream_info[user_id]
-            if status['status'] == 'online':
-                # Streamer is live, add to the list to start watchers
-                info.update({'stream_info': status})
-                live_streamers.append(streamer_name)
-            elif status['status'] == 'offline':
-                # Streamer went offline, handle the watcher
-                if streamer_name in self.watched_streamers:
-                    watcher = self.watched_streamers.pop(streamer_name)['watcher']
-                    watcher.clean_break()  # Signal watcher to stop
-                    watcher.quit()
+    def enable_eventsub(self, callback_url):
+        """Subscribes all streamers to stream.online/offline notifications sent to callback_url, polling becomes a
+        slow sweep that only catches missed notifications.
+
+           """
+        self.eventsub_callback_url = callback_url
+        streamers = self.registry.snapshot()
+        for entry in streamers.values():
+            self.event_pool.submit(self._subscribe, entry.user_info)
+        return 'Subscribing ' + str(len(streamers)) + ' streamer(s) to notifications at ' + callback_url + '.'
+
+    def _subscribe(self, user_info):
+        if not twitch.subscribe_stream_events(user_info['id'], self.eventsub_callback_url, self.webhook_secret):
+            send_tg(f"Could not subscribe to stream notifications of {user_info['login']}, it is polled instead.")
+
+    def handle_stream_event(self, subscription_type, event):
+        """Acts on a verified stream.online/offline notification, the work runs on the event pool so the webhook can
+        be answered right away.
+
+           """
+        streamer = event.get('broadcaster_user_login', '').lower()
+        if subscription_type == 'stream.online':
+            self.event_pool.submit(self._stream_online, streamer, event)
+        elif subscription_type == 'stream.offline':
+            self.event_pool.submit(self._stream_offline, streamer)
 
-        # Start watchers for live streamers
-        self._start_watchers(live_streamers)
+    def _stream_online(self, streamer, event):
+        entry = self.registry.snapshot().get(streamer)
+        if entry is None or entry.state != IDLE:
+            return  # not on the watchlist or already recording
+        detected_at = time.time()
+        if self.prefetch_streams:
+            self.stream_resolver.prefetch(streamer)
+        # the notification can arrive before helix/streams lists the stream, the title is filled in if it does
+        user_id = entry.user_info['id']
+        status = twitch.get_stream_info(user_id)[user_id]
+        if status['status'] != 'online':
+            status = {'status': 'online', 'title': 'No Title', 'viewer_count': 0,
+                      'started_at': event.get('started_at', '')}
+        if self.registry.mark_live(streamer, status, detected_at):
+            self._start_watchers([streamer])
 
-        if not self.kill:
-            t = threading.Timer(self.check_interval, self._check_streams)
-            t.start()
+    def _stream_offline(self, streamer):
+        # a recording is left to its watcher, which records what the stream still delivers and ends with it.
+        # quit() is kept for remove and exit, a killed watcher takes the streamer off the watchlist.
+        self.stream_resolver.forget(streamer)  # streams resolved for this broadcast are of no use for the next one
 
+    def _run_poller(self):
+        asyncio.run(self._poll_streams())
 
+    async def _poll_streams(self):
+        """Checks all streams on a fixed cadence. A sweep never overlaps the next one, ticks missed by a slow sweep
+        are skipped instead of being caught up in a burst.
+
+           """
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while not self.kill:
+            try:
+                with metrics.POLL_SWEEP_SECONDS.time():
+                    await self._check_streams()
+            except Exception as e:
+                print(f'Error during stream check: {e}')
+            interval = self.reconcile_interval if self.eventsub_callback_url else self.check_interval
+            next_tick += interval
+            now = loop.time()
+            if next_tick < now:
+                missed = int((now - next_tick) // interval) + 1
+                print(f'Stream check took longer than {interval} seconds, skipping {missed} tick(s).')
+                next_tick += missed * interval
+            await asyncio.sleep(next_tick - now)
+
+    async def _check_streams(self):
+        # recording streamers are left to their watcher, which stops when the stream ends
+        streamers = self.registry.in_state(IDLE)
+        user_ids = [entry.user_info['id'] for entry in streamers]
+        stream_info = await twitch.get_stream_info_async(*user_ids)
+
+        live_streamers = []
+
+        # Process each streamer based on their status
+        for entry in streamers:
+            status = stream_info[entry.user_info['id']]
+            if status['status'] == 'online' and self.registry.mark_live(entry.login, status):
+                # Streamer is live, add to the list to start watchers
+                if self.prefetch_streams:
+                    self.stream_resolver.prefetch(entry.login)
+                live_streamers.append(entry.login)
+
+        # Start watchers for live streamers, off the event loop as joining the chat sends a Telegram notification
+        await asyncio.to_thread(self._start_watchers, live_streamers)
 
     def _start_watchers(self, live_streamers_list):
         for live_streamer in live_streamers_list:
-            if live_streamer not in self.watched_streamers:
-                live_streamer_dict = self.streamers.pop(live_streamer)
-                curr_watcher = Watcher(live_streamer_dict, self.download_folder)
+            self._start_watcher(live_streamer)
 
-                # Submit the watch method to the thread pool and attach the callback
-                t = self.pool.submit(curr_watcher.watch)
-                t.add_done_callback(self._watcher_callback)
+    def _start_watcher(self, live_streamer):
+        if self.kill:
+            return  # exiting, a sweep still in flight must not start watchers nobody quits
+        entry = self.registry.snapshot().get(live_streamer)
+        if entry and entry.state == LIVE:
+            live_streamer_dict = {'preferred_quality': entry.preferred_quality, 'user_info': entry.user_info,
+                                  'stream_info': entry.stream_info, 'live_detected_at': entry.live_detected_at}
+            curr_watcher = Watcher(live_streamer_dict, self.download_folder, self.record_chunk_size,
+                                   self.live_remux, self.conversion_queue, self.chat_compression,
+                                   self.live_hotspots, self.chat_multiplexer, self.segment_seconds,
+                                   self.segment_bytes, self.recorder_backend, self.stream_resolver)
+            if not self.registry.start_recording(live_streamer, curr_watcher):
+                return  # removed or started by someone else in the meantime
+            curr_watcher.on_recording_finished = lambda: self.registry.mark_converting(live_streamer)
 
-                # Submit the download_chat method to the thread pool
-                self.pool.submit(curr_watcher.download_chat)
+            try:
+                if self.chat_multiplexer:
+                    # joined before the recording starts, so a recording that ends right away also leaves the chat
+                    curr_watcher.start_chat_download()
+                else:
+                    # Submit the download_chat method to the thread pool
+                    self.pool.submit(curr_watcher.download_chat)
 
-                self.watched_streamers.update({live_streamer: {'watcher': curr_watcher,
-                                                            'streamer_dict': live_streamer_dict}})
+                # Submit the watch method to the thread pool
+                t = self.pool.submit(curr_watcher.watch)
+            except Exception as e:
+                print(f'Could not start watching {live_streamer}: {e}')
+                try:
+                    curr_watcher.quit()  # a chat download already running on the pool stops
+                    curr_watcher.stop_chat()
+                finally:
+                    # back to idle, the poller only checks idle streamers
+                    self.registry.finish(live_streamer)
+                return
+            t.add_done_callback(lambda future: self._watcher_callback(live_streamer, future))
 
-    def _watcher_callback(self, returned_watcher):
-        streamer_dict = returned_watcher.result()
+    def _watcher_callback(self, streamer, returned_watcher):
+        try:
+            streamer_dict = returned_watcher.result()
+        except Exception as e:
+            print(f'Watcher of {streamer} failed: {e}')
+            streamer_dict = None
         if streamer_dict is None:
-            print("streamer_dict is None in _watcher_callback")
+            # nothing was recorded, the streamer is checked again on the next sweep
+            self.registry.finish(streamer)
             return
-        streamer = streamer_dict['user_info']['login']
         kill = streamer_dict['kill']
         cleanup = streamer_dict['cleanup']
-        self.watched_streamers.pop(streamer)
         if not cleanup:
             print('Finished watching ' + streamer)
         else:
@@ -152,18 +318,52 @@ class Daemon(HTTPServer):
             if output_filepath and os.path.exists(output_filepath):
                 os.remove(output_filepath)
                 print(f'Removed file: {output_filepath}')
-        if not kill:
-            self.add_streamer(streamer, streamer_dict['preferred_quality'])
+        if kill:
+            self.registry.remove(streamer)
+        else:
+            self.registry.finish(streamer, streamer_dict['preferred_quality'])
 
     def get_streamers(self):
-        return list(self.watched_streamers.keys()), list(self.streamers.keys())
+        """Live and offline streamers from the registry snapshot, live ones with their state."""
+        streamers = self.registry.snapshot().values()
+        live = [entry.login + ' (' + entry.state + ')' for entry in streamers if entry.state != IDLE]
+        offline = [entry.login for entry in streamers if entry.state == IDLE]
+        return live, offline
+
+    def get_conversion_stats(self):
+        return self.conversion_queue.stats()
+
+    def _collect_clip_metrics(self):
+        """Clip jobs are run by the cron script, their queue depth and stage durations are read from the database."""
+        conn = job_queue.connect()
+        if conn is None:
+            return
+        try:
+            with metrics.DB_OPERATION_SECONDS.labels('clip_job_stats').time():
+                counts = job_queue.count_jobs(conn)
+                durations = job_queue.stage_durations(conn)
+        except sqlite3.OperationalError:
+            return  # the cron script has not added the job columns yet
+        finally:
+            conn.close()
+        for state in (job_queue.QUEUED, job_queue.RUNNING, job_queue.DONE, job_queue.FAILED):
+            metrics.CLIP_JOBS.labels(state).set(counts.get(state, 0))
+        for stage, seconds in durations.items():
+            metrics.CLIP_STAGE_SECONDS.labels(stage).set(seconds)
 
     def exit(self):
         self.kill = True
-        for streamer in self.watched_streamers.values():
-            watcher = streamer['watcher']
-            watcher.quit()
+        # before the watchers are quit, a notification still being handled can start one
+        self.event_pool.shutdown(wait=True, cancel_futures=True)
+        for entry in self.registry.snapshot().values():
+            if entry.watcher:
+                entry.watcher.quit()
         self.pool.shutdown(wait=True)
+        self.registry.close()
+        self.conversion_queue.shutdown()
+        self.stream_resolver.close()
+        if self.chat_multiplexer:
+            self.chat_multiplexer.close()
         self.server_close()
         threading.Thread(target=self.shutdown, daemon=True).start()
         return 'Daemon exited successfully'
@@ -174,10 +374,10 @@ class Daemon(HTTPServer):
             return
 
         with open(file_path, 'r') as file:
-            for line in file:
-                if streamer := line.strip():
-                    self.add_streamer(streamer)
-                    print(f"Added {streamer} to watchlist from file.")
+            streamers = [streamer for line in file if (streamer := line.strip())]
+        _, resp = self.add_streamers(streamers)
+        print('\n'.join(resp))
+        print(f"Loaded {len(self.registry.snapshot())} streamers from file.")
 
 
 if __name__ == '__main__':
@@ -1,6 +1,9 @@
 import sqlite3
 from sqlite3 import Error
 
+DATABASE = r"mp4_processing.db"
+
+
 def create_connection(db_file):
     """ Create a database connection to the SQLite database specified by db_file
     :param db_file: database file
@@ -28,7 +31,7 @@ def create_table(conn, create_table_sql):
         print(e)
 
 def main():
-    database = r"mp4_processing.db"
+    database = DATABASE
 
     sql_create_projects_table = """ CREATE TABLE IF NOT EXISTS videos (
                                         id integer PRIMARY KEY,
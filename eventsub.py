@@ -0,0 +1,61 @@
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+# Headers of EventSub webhook requests, see https://dev.twitch.tv/docs/eventsub/handling-webhook-events
+MESSAGE_ID = 'Twitch-Eventsub-Message-Id'
+MESSAGE_TIMESTAMP = 'Twitch-Eventsub-Message-Timestamp'
+MESSAGE_SIGNATURE = 'Twitch-Eventsub-Message-Signature'
+MESSAGE_TYPE = 'Twitch-Eventsub-Message-Type'
+
+MAX_MESSAGE_AGE = 10 * 60  # seconds, older messages are rejected as replays
+STREAM_EVENTS = ('stream.online', 'stream.offline')
+
+
+def sign(secret, message_id, timestamp, body):
+    """Signature header value of a message, HMAC-SHA256 over id, timestamp and the raw body."""
+    digest = hmac.new(secret.encode(), message_id.encode() + timestamp.encode() + body, hashlib.sha256).hexdigest()
+    return 'sha256=' + digest
+
+
+def verify_signature(secret, message_id, timestamp, body, signature):
+    if not (message_id and timestamp and signature):
+        return False
+    return hmac.compare_digest(sign(secret, message_id, timestamp, body).encode(), signature.encode())
+
+
+def message_age(timestamp):
+    """Seconds since the RFC3339 message timestamp, Twitch sends nanoseconds which are cut to microseconds."""
+    stamp = timestamp.rstrip('Z')
+    if '.' in stamp:
+        stamp, fraction = stamp.split('.', 1)
+        stamp += '.' + fraction[:6]
+    else:
+        stamp += '.0'
+    sent_at = datetime.strptime(stamp, '%Y-%m-%dT%H:%M:%S.%f').replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - sent_at).total_seconds()
+
+
+class MessageDeduper:
+    """Remembers recently seen message ids, Twitch redelivers a message if it did not get a 2xx in time."""
+
+    def __init__(self, max_age=MAX_MESSAGE_AGE, max_size=10000):
+        self.max_age = max_age
+        self.max_size = max_size
+        self._seen = OrderedDict()  # message id -> time first seen, oldest first
+        self._lock = threading.Lock()
+
+    def seen(self, message_id):
+        """Records the id and tells whether it was seen before."""
+        now = time.monotonic()
+        with self._lock:
+            while self._seen and (len(self._seen) >= self.max_size or
+                                  now - next(iter(self._seen.values())) > self.max_age):
+                self._seen.popitem(last=False)
+            if message_id in self._seen:
+                return True
+            self._seen[message_id] = now
+            return False
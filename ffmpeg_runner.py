@@ -0,0 +1,254 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+FFMPEG_PATH = shutil.which('ffmpeg') or 'C:\\Program Files\\FFmpeg\\bin\\ffmpeg.exe'
+FFPROBE_PATH = shutil.which('ffprobe') or 'C:\\Program Files\\FFmpeg\\bin\\ffprobe.exe'
+IONICE_PATH = shutil.which('ionice')
+NICE_PATH = shutil.which('nice')
+TASKSET_PATH = shutil.which('taskset')
+
+BATCH_NICE = 10  # conversions and clipping run below the live recordings
+STDERR_LINES = 20  # lines of ffmpeg's log kept for error messages
+
+recent_jobs = deque(maxlen=100)  # timings of finished jobs, newest last
+_running_jobs = set()
+_running_lock = threading.Lock()
+
+
+class FFmpegJob:
+    """One ffmpeg or ffprobe run.
+    ffmpeg reports its progress as key=value blocks on stdout (-progress pipe:1), so nothing has to parse the
+    human readable log. The job is killed when it runs longer than timeout seconds or is cancelled. A positive
+    nice value lowers the CPU priority and puts the process into the idle IO class (below normal priority class
+    on Windows), cpus restricts it to those cores. Wall and CPU time are recorded when the process ends.
+    """
+
+    def __init__(self, args, executable=FFMPEG_PATH, name=None, timeout=None, nice=0, cpus=None,
+                 on_progress=None, capture_output=False):
+        self.args = list(args)
+        self.executable = executable
+        self.name = name or os.path.basename(executable)
+        self.timeout = timeout
+        self.nice = nice
+        self.cpus = cpus
+        self.on_progress = on_progress
+        self.capture_output = capture_output
+        self.process = None
+        self.returncode = None
+        self.stdout = ''
+        self.progress = {}  # last progress block
+        self.timed_out = False
+        self.cancelled = False
+        self.wall_time = None
+        self.cpu_time = None
+        self._stderr = deque(maxlen=STDERR_LINES)
+        self._launch_error = None
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out and not self.cancelled
+
+    @property
+    def error(self):
+        if self._launch_error:
+            return f"{self.name} could not be started: {self._launch_error}"
+        if self.timed_out:
+            return f"{self.name} timed out after {self.timeout} seconds"
+        if self.cancelled:
+            return f"{self.name} was cancelled"
+        if self.returncode:
+            return f"{self.name} exited with {self.returncode}: " + ' | '.join(self._stderr)
+        return None
+
+    def _command(self):
+        command = [self.executable]
+        if not self.capture_output:
+            command += ['-hide_banner', '-nostats', '-progress', 'pipe:1']
+        command += self.args
+        if sys.platform == 'win32':
+            return command
+        # priority and affinity are set by wrappers that exec ffmpeg, so every thread ffmpeg starts inherits them
+        if self.nice > 0 and IONICE_PATH:
+            command = [IONICE_PATH, '-c', '3'] + command
+        if self.nice > 0 and NICE_PATH:
+            command = [NICE_PATH, '-n', str(self.nice)] + command
+        if self.cpus and TASKSET_PATH:
+            command = [TASKSET_PATH, '-c', ','.join(str(cpu) for cpu in sorted(self.cpus))] + command
+        return command
+
+    def _lower_priority(self, pid):
+        """Sets priority and affinity of the started process from here when there is no wrapper for it.
+        preexec_fn is not used for this, it can deadlock the child of a process with threads."""
+        try:
+            if self.nice > 0 and not NICE_PATH:
+                os.setpriority(os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, 0) + self.nice)
+            if self.cpus and not TASKSET_PATH and hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(pid, self.cpus)
+        except OSError as e:
+            print(f"Could not lower the priority of {self.name}: {e}")
+
+    def run(self):
+        start = time.time()
+        kwargs = {}
+        if sys.platform == 'win32' and self.nice > 0:
+            kwargs['creationflags'] = subprocess.BELOW_NORMAL_PRIORITY_CLASS
+        try:
+            self.process = subprocess.Popen(self._command(), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                            stderr=subprocess.PIPE, text=True, errors='replace', **kwargs)
+        except OSError as e:
+            self._launch_error = e
+            self.returncode = -1
+            self.wall_time = time.time() - start
+            return self
+        if sys.platform == 'win32':
+            if self.cpus:
+                _set_windows_affinity(self.process, self.cpus)
+        elif self.nice > 0 or self.cpus:
+            self._lower_priority(self.process.pid)
+
+        with _running_lock:
+            _running_jobs.add(self)
+        watchdog = None
+        if self.timeout:
+            watchdog = threading.Timer(self.timeout, self._expire)
+            watchdog.daemon = True
+            watchdog.start()
+        stderr_reader = threading.Thread(target=self._read_stderr, daemon=True)
+        stderr_reader.start()
+        try:
+            if self.capture_output:
+                self.stdout = self.process.stdout.read()
+            else:
+                self._read_progress()
+            stderr_reader.join()
+            self.returncode, self.cpu_time = _reap(self.process)
+        finally:
+            if watchdog:
+                watchdog.cancel()
+            with _running_lock:
+                _running_jobs.discard(self)
+            self.process.stdout.close()
+            self.process.stderr.close()
+
+        self.wall_time = time.time() - start
+        recent_jobs.append({'name': self.name,
+                            'returncode': self.returncode,
+                            'ok': self.ok,
+                            'wall_seconds': round(self.wall_time, 2),
+                            'cpu_seconds': round(self.cpu_time, 2) if self.cpu_time is not None else None})
+        return self
+
+    def _read_progress(self):
+        block = {}
+        for line in self.process.stdout:
+            key, _, value = line.strip().partition('=')
+            if not key:
+                continue
+            block[key] = value
+            if key == 'progress':  # last key of every block, 'end' after the last one
+                self.progress = block
+                if self.on_progress:
+                    self.on_progress(block)
+                block = {}
+
+    def _read_stderr(self):
+        for line in self.process.stderr:
+            if line.strip():
+                self._stderr.append(line.strip())
+
+    def _expire(self):
+        self.timed_out = True
+        self._kill()
+
+    def cancel(self):
+        self.cancelled = True
+        self._kill()
+
+    def _kill(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass  # already gone
+
+    def out_time_seconds(self):
+        """Position of the output in seconds according to the last progress block."""
+        try:
+            return int(self.progress.get('out_time_us', 0)) / 1e6
+        except ValueError:
+            return 0.0
+
+
+def _reap(process):
+    """Waits for the process and returns (returncode, cpu seconds or None)."""
+    if hasattr(os, 'wait4'):
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            return process.wait(), None
+        returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        process.returncode = returncode
+        return returncode, usage.ru_utime + usage.ru_stime
+    returncode = process.wait()
+    return returncode, _windows_cpu_time(process)
+
+
+def _set_windows_affinity(process, cpus):
+    try:
+        import ctypes
+        mask = 0
+        for cpu in cpus:
+            mask |= 1 << cpu
+        ctypes.windll.kernel32.SetProcessAffinityMask(int(process._handle), mask)
+    except (ImportError, AttributeError, OSError) as e:
+        print(f"Could not set CPU affinity: {e}")
+
+
+def _windows_cpu_time(process):
+    try:
+        import ctypes
+        from ctypes import wintypes
+        times = [wintypes.FILETIME() for _ in range(4)]  # creation, exit, kernel, user
+        if not ctypes.windll.kernel32.GetProcessTimes(int(process._handle), *[ctypes.byref(t) for t in times]):
+            return None
+    except (ImportError, AttributeError, OSError):
+        return None
+    # FILETIME counts 100 ns units
+    return sum((t.dwHighDateTime << 32 | t.dwLowDateTime) / 1e7 for t in times[2:])
+
+
+def run_ffmpeg(args, **kwargs):
+    """Runs ffmpeg with args and returns the finished FFmpegJob."""
+    return FFmpegJob(args, FFMPEG_PATH, **kwargs).run()
+
+
+def run_ffprobe(args, timeout=120, **kwargs):
+    """Runs ffprobe with args and returns the finished FFmpegJob, its output is in job.stdout."""
+    return FFmpegJob(['-v', 'error'] + list(args), FFPROBE_PATH, timeout=timeout, capture_output=True,
+                     **kwargs).run()
+
+
+def probe(path, timeout=120):
+    """Format and streams of a media file as parsed ffprobe JSON, None if probing failed."""
+    job = run_ffprobe(['-show_format', '-show_streams', '-of', 'json', path], timeout=timeout)
+    if not job.ok:
+        print(f"Error probing {path}: {job.error}")
+        return None
+    try:
+        return json.loads(job.stdout)
+    except ValueError as e:
+        print(f"Error reading ffprobe output for {path}: {e}")
+        return None
+
+
+def cancel_all():
+    """Cancels every running job, e.g. on shutdown."""
+    with _running_lock:
+        jobs = list(_running_jobs)
+    for job in jobs:
+        job.cancel()
@@ -0,0 +1,160 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+from requests.exceptions import RequestException
+
+from twitch import requests_retry_session
+
+SEGMENT_WORKERS = 4  # segments downloaded at the same time
+MAX_BUFFERED_SEGMENTS = 16  # downloaded or downloading segments not read yet
+REQUEST_TIMEOUT = 10  # seconds
+STALL_TIMEOUT = 60  # seconds without a new segment or a readable playlist before the stream counts as ended
+
+
+def parse_media_playlist(text):
+    """Parses an HLS media playlist.
+
+       Returns:
+       -------
+       dict: 'segments' as a list of (sequence number, uri, duration), 'target_duration' and 'ended'
+       """
+    sequence = 0
+    target_duration = 2.0
+    duration = None
+    segments = []
+    ended = False
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-TARGETDURATION:'):
+            target_duration = float(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            duration = float(line.split(':', 1)[1].split(',', 1)[0])
+        elif line.startswith('#EXT-X-ENDLIST'):
+            ended = True
+        elif line and not line.startswith('#'):
+            segments.append((sequence, line, duration if duration is not None else target_duration))
+            sequence += 1
+            duration = None
+    return {'segments': segments, 'target_duration': target_duration, 'ended': ended}
+
+
+class HLSReader:
+    """Reads a live HLS media playlist as one byte stream, as an alternative to streamlink's stream reader.
+    The playlist is polled on its own thread and new segments are downloaded in parallel over one pooled session,
+    read() and readinto() return them strictly in sequence order. Segments that dropped out of the playlist before
+    they were seen or that failed to download are skipped and logged as gaps.
+    """
+
+    def __init__(self, playlist_url, session=None, workers=SEGMENT_WORKERS, max_buffered=MAX_BUFFERED_SEGMENTS,
+                 timeout=REQUEST_TIMEOUT, stall_timeout=STALL_TIMEOUT):
+        self.playlist_url = playlist_url
+        self.session = session or requests_retry_session(retries=2, backoff_factor=0.3, pool_maxsize=workers + 1)
+        self.max_buffered = max_buffered
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.gaps = []  # (first missing sequence number, last missing sequence number)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hls-segment')
+        self._cond = threading.Condition()
+        self._pending = deque()  # (sequence number, future) in sequence order
+        self._ended = False
+        self._closed = False
+        self._current = memoryview(b'')
+        self._offset = 0
+        self._poller = threading.Thread(target=self._poll, name='hls-playlist', daemon=True)
+        self._poller.start()
+
+    def _log_gap(self, first, last, reason):
+        self.gaps.append((first, last))
+        print(f"HLS gap in {self.playlist_url}: segment(s) {first}-{last} {reason}")
+
+    def _poll(self):
+        last_sequence = None
+        last_progress = time.monotonic()
+        try:
+            while not self._closed:
+                try:
+                    response = self.session.get(self.playlist_url, timeout=self.timeout)
+                    response.raise_for_status()
+                    playlist = parse_media_playlist(response.text)
+                except (RequestException, ValueError) as e:
+                    print(f"Error reading HLS playlist {self.playlist_url}: {e}")
+                    if time.monotonic() - last_progress > self.stall_timeout:
+                        return
+                    time.sleep(1)
+                    continue
+
+                for sequence, uri, _ in playlist['segments']:
+                    if last_sequence is not None and sequence <= last_sequence:
+                        continue
+                    if last_sequence is not None and sequence > last_sequence + 1:
+                        self._log_gap(last_sequence + 1, sequence - 1, 'left the playlist before they were fetched')
+                    with self._cond:
+                        while len(self._pending) >= self.max_buffered and not self._closed:
+                            self._cond.wait()
+                        if self._closed:
+                            return
+                        future = self._pool.submit(self._fetch, urljoin(self.playlist_url, uri))
+                        self._pending.append((sequence, future))
+                        self._cond.notify_all()
+                    last_sequence = sequence
+                    last_progress = time.monotonic()
+
+                if playlist['ended'] or time.monotonic() - last_progress > self.stall_timeout:
+                    return
+                time.sleep(playlist['target_duration'] / 2)
+        finally:
+            with self._cond:
+                self._ended = True
+                self._cond.notify_all()
+
+    def _fetch(self, url):
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    def _next_segment(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._ended and not self._closed:
+                    self._cond.wait()
+                if self._closed or not self._pending:
+                    return None
+                sequence, future = self._pending.popleft()
+                self._cond.notify_all()
+            try:
+                return future.result()
+            except RequestException as e:
+                self._log_gap(sequence, sequence, f'failed to download: {e}')
+
+    def readinto(self, buf):
+        while self._offset >= len(self._current):
+            data = self._next_segment()
+            if data is None:
+                return 0
+            self._current = memoryview(data)
+            self._offset = 0
+        n = min(len(buf), len(self._current) - self._offset)
+        buf[:n] = self._current[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while data := self.read(1 << 20):
+                chunks.append(data)
+            return b''.join(chunks)
+        buf = bytearray(size)
+        n = self.readinto(buf)
+        return bytes(buf[:n])
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,127 @@
+import time
+
+from db_connection import create_connection, DATABASE
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+LEASE_SECONDS = 300  # a running job whose lease is not renewed for this long is claimed again
+MAX_ATTEMPTS = 3
+
+# columns added to the videos table on top of the ones created in db_connection.main
+_JOB_COLUMNS = {
+    'state': "text NOT NULL DEFAULT 'queued'",
+    'lease_owner': 'text',
+    'lease_expires': 'real',
+    'attempts': 'integer NOT NULL DEFAULT 0',
+    'error': 'text',
+    'chat_started_at': 'real',
+    'chat_finished_at': 'real',
+    'video_started_at': 'real',
+    'video_finished_at': 'real',
+}
+_STAGE_COLUMNS = {'chat_started_at', 'chat_finished_at', 'video_started_at', 'video_finished_at'}
+
+
+def connect(database=DATABASE):
+    """ Create a connection in autocommit mode, transactions are started explicitly where needed
+    :param database: database file
+    :return: Connection object or None
+    """
+    conn = create_connection(database)
+    if conn is not None:
+        conn.isolation_level = None
+        conn.execute('PRAGMA busy_timeout = 30000')
+    return conn
+
+
+def ensure_job_columns(conn):
+    """ Add the job columns to the videos table if they are missing.
+    Rows that were already handled through the old `processed` flag keep their outcome.
+    :param conn: Connection object
+    """
+    existing = {row[1] for row in conn.execute('PRAGMA table_info(videos)')}
+    for column, definition in _JOB_COLUMNS.items():
+        if column not in existing:
+            conn.execute(f'ALTER TABLE videos ADD COLUMN {column} {definition}')
+            if column == 'state':
+                conn.execute(f"UPDATE videos SET state = '{DONE}' WHERE processed = 2")
+                conn.execute(f"UPDATE videos SET state = '{FAILED}' WHERE processed = 1")
+
+
+def claim_job(conn, worker_id, lease_seconds=LEASE_SECONDS):
+    """ Claim the oldest queued job, or a running job whose worker stopped renewing its lease
+    :param conn: Connection object
+    :param worker_id: unique name of the claiming worker
+    :param lease_seconds: how long the claim is valid without a heartbeat
+    :return: (id, file_path, chat_file_path) or None if there is nothing to do
+    """
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # jobs that crashed their workers too often are given up
+        conn.execute("UPDATE videos SET state = ?, processed = 1, error = 'lease expired too often' "
+                     "WHERE state = ? AND lease_expires < ? AND attempts >= ?",
+                     (FAILED, RUNNING, now, MAX_ATTEMPTS))
+        row = conn.execute("SELECT id, file_path, chat_file_path FROM videos "
+                           "WHERE state = ? OR (state = ? AND lease_expires < ?) ORDER BY id LIMIT 1",
+                           (QUEUED, RUNNING, now)).fetchone()
+        if row:
+            conn.execute("UPDATE videos SET state = ?, lease_owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                         "WHERE id = ?", (RUNNING, worker_id, now + lease_seconds, row[0]))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return row
+
+
+def heartbeat(conn, job_id, worker_id, lease_seconds=LEASE_SECONDS):
+    """ Renew the lease of a claimed job
+    :return: False if the lease was lost to another worker
+    """
+    cur = conn.execute("UPDATE videos SET lease_expires = ? WHERE id = ? AND lease_owner = ? AND state = ?",
+                       (time.time() + lease_seconds, job_id, worker_id, RUNNING))
+    return cur.rowcount == 1
+
+
+def mark_stage(conn, job_id, column):
+    """ Record the current time in one of the per-stage timing columns
+    :param column: one of chat_started_at, chat_finished_at, video_started_at, video_finished_at
+    """
+    if column not in _STAGE_COLUMNS:
+        raise ValueError(f'Unknown stage column: {column}')
+    conn.execute(f'UPDATE videos SET {column} = ? WHERE id = ?', (time.time(), job_id))
+
+
+def finish_job(conn, job_id, worker_id, state, error=None):
+    """ Release a claimed job as done or failed, the old `processed` flag is kept in sync
+    :param state: DONE or FAILED
+    """
+    processed = 2 if state == DONE else 1
+    conn.execute("UPDATE videos SET state = ?, processed = ?, error = ?, lease_owner = NULL, lease_expires = NULL "
+                 "WHERE id = ? AND lease_owner = ?", (state, processed, error, job_id, worker_id))
+
+
+def count_jobs(conn):
+    """ Number of jobs per state
+    :return: dict state -> count
+    """
+    return dict(conn.execute('SELECT state, COUNT(*) FROM videos GROUP BY state').fetchall())
+
+
+def stage_durations(conn, last=100):
+    """ Average duration of the chat and video stage over the last jobs that finished them
+    :param last: number of most recent jobs per stage
+    :return: dict stage -> seconds, stages no job finished yet are left out
+    """
+    durations = {}
+    for stage in ('chat', 'video'):
+        row = conn.execute(f"SELECT AVG(finished - started) FROM (SELECT {stage}_started_at AS started, "
+                           f"{stage}_finished_at AS finished FROM videos WHERE {stage}_finished_at IS NOT NULL "
+                           f"ORDER BY id DESC LIMIT ?)", (last,)).fetchone()
+        if row[0] is not None:
+            durations[stage] = row[0]
+    return durations
@@ -1,3 +1,4 @@
+import logging
 import threading
 
 import ATRHandler
@@ -5,9 +6,11 @@ import utils
 import os
 from atr_cmd import AtrCmd
 from daemon import Daemon
+from videoProcessing.videoWorker import LOG_FILE
 
 STREAMERS_FILE = 'streamers.txt'
 if __name__ == '__main__':
+    logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
     utils.get_client_id()  # creates necessary config before launch
     streamers_file_path = os.path.join(os.getcwd(), STREAMERS_FILE)
     server = Daemon(('127.0.0.1', 1234), ATRHandler.ATRHandler, streamers_file=streamers_file_path)
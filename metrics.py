@@ -0,0 +1,263 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Prometheus text exposition format, see https://prometheus.io/docs/instrumenting/exposition_formats/
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+_metrics = []  # every metric in the order it was created
+_collectors = []  # functions that update gauges right before the metrics are rendered
+_metrics_lock = threading.Lock()
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class _Shards:
+    """Per-thread cells of a value. Every thread only ever writes its own cell, so updates need no lock,
+    a lock is only taken when a thread writes for the first time. Reads add up all cells."""
+
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+
+    def cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = [0.0] * self._size
+            with self._lock:
+                self._cells.append(cell)
+            self._local.cell = cell
+            return cell
+
+    def totals(self):
+        with self._lock:
+            cells = list(self._cells)
+        totals = [0.0] * self._size
+        for cell in cells:
+            for i in range(self._size):
+                totals[i] += cell[i]
+        return totals
+
+
+class _Metric:
+    metric_type = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._children_lock = threading.Lock()
+        with _metrics_lock:
+            _metrics.append(self)
+
+    def labels(self, *values, **kwargs):
+        """The child metric of one label combination, keep it around on hot paths."""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._children_lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        """(suffix, labels, value) of all children."""
+        if not self.labelnames:
+            return self._child_samples(self._default(), ())
+        samples = []
+        with self._children_lock:
+            children = list(self._children.items())
+        for key, child in children:
+            samples.extend(self._child_samples(child, tuple(zip(self.labelnames, key))))
+        return samples
+
+    def _default(self):
+        return self.labels()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        for suffix, labels, value in self._samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class _CounterChild:
+    def __init__(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount=1):
+        self._shards.cell()[0] += amount
+
+    def value(self):
+        return self._shards.totals()[0]
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def _child_samples(self, child, labels):
+        return [('', labels, child.value())]
+
+
+class _GaugeChild:
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        """Reads the value from function when the metrics are collected, e.g. a queue depth."""
+        self._function = function
+
+    def value(self):
+        if self._function:
+            try:
+                return float(self._function())
+            except Exception:
+                return math.nan
+        return self._value
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+    def _child_samples(self, child, labels):
+        return [('', labels, child.value())]
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        # one count per bucket plus +Inf, then the sum
+        self._shards = _Shards(len(buckets) + 2)
+
+    def observe(self, value):
+        cell = self._shards.cell()
+        cell[bisect.bisect_left(self._buckets, value)] += 1
+        cell[-1] += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self, labels):
+        totals = self._shards.totals()
+        samples = []
+        count = 0
+        for bound, bucket_count in zip(self._buckets + (math.inf,), totals[:-1]):
+            count += bucket_count
+            samples.append(('_bucket', labels + (('le', _format_value(float(bound))),), count))
+        samples.append(('_count', labels, count))
+        samples.append(('_sum', labels, totals[-1]))
+        return samples
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def _child_samples(self, child, labels):
+        return child.samples(labels)
+
+
+def add_collector(function):
+    """Runs function on every scrape, for numbers that are cheaper to read on demand, e.g. from the database."""
+    with _metrics_lock:
+        _collectors.append(function)
+
+
+def render():
+    """All metrics in the Prometheus text format."""
+    with _metrics_lock:
+        metrics = list(_metrics)
+        collectors = list(_collectors)
+    for collector in collectors:
+        try:
+            collector()
+        except Exception as e:
+            print(f"Error collecting metrics: {e}")
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+# Polling and the Twitch API
+POLL_SWEEP_SECONDS = Histogram('atr_poll_sweep_seconds', 'Duration of a sweep over all idle streamers.')
+API_REQUEST_SECONDS = Histogram('atr_twitch_api_request_seconds', 'Latency of Twitch API requests.',
+                                ['method', 'status'])
+
+# Recordings
+RECORDING_BYTES = Counter('atr_recording_bytes_total', 'Bytes written by recordings.', ['streamer'])
+RECORDING_STALLS = Counter('atr_recording_stalls_total', 'Stream reads that took longer than the stall threshold.',
+                           ['streamer'])
+RECORDINGS_ACTIVE = Gauge('atr_recordings_active', 'Recordings running right now.')
+CHAT_MESSAGES = Counter('atr_chat_messages_total', 'Chat messages received while recording.', ['streamer'])
+
+# Conversion and clipping
+CONVERSION_QUEUE_DEPTH = Gauge('atr_conversion_queue_depth', 'Conversions waiting for a worker.')
+CONVERSION_JOB_SECONDS = Histogram('atr_conversion_job_seconds', 'Duration of mp4 conversion jobs.', ['status'])
+CONVERSION_WAIT_SECONDS = Histogram('atr_conversion_wait_seconds', 'Time conversion jobs spent queued.')
+CLIP_JOBS = Gauge('atr_clip_jobs', 'Clip jobs in the videos table by state.', ['state'])
+CLIP_STAGE_SECONDS = Gauge('atr_clip_stage_seconds', 'Average duration of a clip job stage over the last '
+                                                     '100 jobs that finished it.', ['stage'])
+
+# Database
+DB_OPERATION_SECONDS = Histogram('atr_db_operation_seconds', 'Latency of SQLite operations.', ['operation'])
@@ -0,0 +1,274 @@
+import json
+import os
+import sys
+import threading
+import time
+
+from ffmpeg_runner import BATCH_NICE, run_ffmpeg
+from videoProcessing.videoWorker import insert_video
+from tg_bot import send_tg
+
+TS_PACKET_SIZE = 188
+PAT_PID = 0
+VIDEO_STREAM_TYPES = {0x01, 0x02, 0x1b, 0x24}  # MPEG-1/2 video, H.264, HEVC
+CONCAT_TIMEOUT = 60 * 60
+
+_manifest_lock = threading.Lock()  # conversion workers and watchers update the manifests from different threads
+
+
+def manifest_path_for(stem_path):
+    return stem_path + '.manifest.json'
+
+
+def read_manifest(manifest_path):
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def _write_manifest(manifest_path, manifest):
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+
+def update_manifest(manifest_path, update):
+    """Applies update(manifest) to the manifest on disk and returns the new manifest."""
+    with _manifest_lock:
+        manifest = read_manifest(manifest_path)
+        update(manifest)
+        _write_manifest(manifest_path, manifest)
+        return manifest
+
+
+def _packet_pid(packet):
+    return ((packet[1] & 0x1f) << 8) | packet[2]
+
+
+def _section(packet):
+    """The PSI section starting in a packet, None if no section starts in it."""
+    if not packet[1] & 0x40:  # payload_unit_start_indicator
+        return None
+    offset = 4
+    if packet[3] & 0x20:  # adaptation field
+        offset += 1 + packet[4]
+    if not packet[3] & 0x10 or offset >= len(packet):  # no payload
+        return None
+    offset += 1 + packet[offset]  # pointer field
+    section = packet[offset:]
+    return section if len(section) >= 3 else None
+
+
+def _pmt_pid(pat_section):
+    """PID of the first program's PMT in a PAT section."""
+    end = min(3 + (((pat_section[1] & 0x0f) << 8) | pat_section[2]) - 4, len(pat_section) - 3)  # without CRC
+    for offset in range(8, end, 4):
+        if (pat_section[offset] << 8) | pat_section[offset + 1]:  # program 0 is the network PID
+            return ((pat_section[offset + 2] & 0x1f) << 8) | pat_section[offset + 3]
+    return None
+
+
+def _video_pid(pmt_section):
+    """PID of the first video stream in a PMT section."""
+    if len(pmt_section) < 12:
+        return None
+    end = min(3 + (((pmt_section[1] & 0x0f) << 8) | pmt_section[2]) - 4, len(pmt_section))  # without CRC
+    offset = 12 + (((pmt_section[10] & 0x0f) << 8) | pmt_section[11])  # after the program descriptors
+    while offset + 5 <= end:
+        if pmt_section[offset] in VIDEO_STREAM_TYPES:
+            return ((pmt_section[offset + 1] & 0x1f) << 8) | pmt_section[offset + 2]
+        offset += 5 + (((pmt_section[offset + 3] & 0x0f) << 8) | pmt_section[offset + 4])
+    return None
+
+
+def _random_access(packet):
+    """True for a packet whose adaptation field flags a random access point, the start of a keyframe."""
+    return bool(packet[1] & 0x40 and packet[3] & 0x20 and packet[4] and packet[5] & 0x40)
+
+
+class SegmentedOutput:
+    """File-like target for a recording that rotates into <stem>.partNNN.ts files.
+    A part is closed once it is segment_seconds long or segment_bytes big, right before the next video packet that
+    is flagged as a random access point (a keyframe). The new part starts with copies of the last PAT and PMT and
+    that keyframe, so it can be converted on its own. Muxers repeat the PAT within segments, so a PAT alone does
+    not mark a place to cut. The parts are listed in <stem>.manifest.json, on_part_closed(ts_path) is called for
+    every closed part.
+    """
+
+    def __init__(self, stem_path, segment_seconds=None, segment_bytes=None, buffering=-1, on_part_closed=None):
+        self.stem_path = stem_path
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.buffering = buffering
+        self.on_part_closed = on_part_closed
+        self.manifest_path = manifest_path_for(stem_path)
+        self._file = None
+        self._part_path = None
+        self._part_started = 0.0
+        self._part_bytes = 0
+        self._written = 0  # bytes of the whole recording, to find TS packet boundaries
+        # program tables of the stream, learnt from its start and refreshed while a rotation is due
+        self._pat = None
+        self._pmt = None
+        self._pmt_pid = None
+        self._video_pid = None
+        with _manifest_lock:
+            _write_manifest(self.manifest_path, {'output': stem_path + '.mp4', 'chat_file_path': None,
+                                                 'closed': False, 'concatenated': False, 'parts': []})
+        self._open_part()
+
+    def _open_part(self):
+        index = len(read_manifest(self.manifest_path)['parts'])
+        self._part_path = f"{self.stem_path}.part{index:03}.ts"
+        self._file = open(self._part_path, 'ab', buffering=self.buffering)
+        self._part_started = time.monotonic()
+        self._part_bytes = 0
+        part = {'ts': self._part_path, 'mp4': self._part_path.replace('.ts', '.mp4'), 'status': 'recording',
+                'started_at': time.time(), 'bytes': 0}
+        update_manifest(self.manifest_path, lambda manifest: manifest['parts'].append(part))
+
+    def _close_part(self):
+        self._file.close()
+        part_path, part_bytes = self._part_path, self._part_bytes
+
+        def close(manifest):
+            for part in manifest['parts']:
+                if part['ts'] == part_path:
+                    part.update({'status': 'closed', 'bytes': part_bytes})
+        update_manifest(self.manifest_path, close)
+        if not part_bytes:
+            os.remove(part_path)
+        elif self.on_part_closed:
+            self.on_part_closed(part_path)
+
+    def _rotation_due(self):
+        if self.segment_seconds and time.monotonic() - self._part_started >= self.segment_seconds:
+            return True
+        return bool(self.segment_bytes and self._part_bytes >= self.segment_bytes)
+
+    def _scan(self, data):
+        """Reads the PAT and PMT packets in data and returns the offset of the first keyframe packet after them,
+        None if there is none. Packets cut off at the end of data are skipped."""
+        offset = -self._written % TS_PACKET_SIZE
+        while offset + TS_PACKET_SIZE <= len(data):
+            packet = data[offset:offset + TS_PACKET_SIZE]
+            if packet[0] == 0x47:
+                pid = _packet_pid(packet)
+                if pid == self._video_pid and _random_access(packet):
+                    return offset
+                if pid == PAT_PID and (section := _section(packet)) and section[0] == 0x00:
+                    self._pat = bytes(packet)
+                    self._pmt_pid = _pmt_pid(section)
+                elif pid == self._pmt_pid and (section := _section(packet)) and section[0] == 0x02:
+                    self._pmt = bytes(packet)
+                    self._video_pid = _video_pid(section)
+            offset += TS_PACKET_SIZE
+        return None
+
+    def write(self, data):
+        # packets are only looked at until the stream's tables are known and while a rotation is due
+        rotate = self._rotation_due()
+        if rotate or self._video_pid is None:
+            split = self._scan(data)
+            if rotate and split is not None and self._pat and self._pmt:
+                if split:
+                    self._write(data[:split])
+                self._close_part()
+                self._open_part()
+                self._write(self._pat + self._pmt)  # two whole packets, the packet boundaries stay in place
+                data = data[split:]
+        self._write(data)
+
+    def _write(self, data):
+        self._file.write(data)
+        self._part_bytes += len(data)
+        self._written += len(data)
+
+    def close(self):
+        if self._file and not self._file.closed:
+            self._close_part()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def close_manifest(manifest_path, chat_file_path):
+    """Marks the recording as finished, no more parts are added."""
+    def close(manifest):
+        manifest.update({'closed': True, 'chat_file_path': chat_file_path})
+    return update_manifest(manifest_path, close)
+
+
+def set_part_status(manifest_path, ts_path, status):
+    def update(manifest):
+        for part in manifest['parts']:
+            if part['ts'] == ts_path:
+                part['status'] = status
+    return update_manifest(manifest_path, update)
+
+
+def finish_if_complete(manifest_path):
+    """Concatenates the parts and inserts the video record once the recording is closed and every part is
+    converted. Only one caller gets to do it.
+
+       Returns:
+       -------
+       bool: True if this call finished the recording.
+       """
+    with _manifest_lock:
+        manifest = read_manifest(manifest_path)
+        parts = [part for part in manifest['parts'] if part['bytes']]
+        if not manifest['closed'] or manifest['concatenated'] or manifest.get('concatenating') or \
+                any(part['status'] != 'converted' for part in parts):
+            return False
+        manifest['concatenating'] = True
+        _write_manifest(manifest_path, manifest)
+
+    ok = bool(parts) and concat_parts([part['mp4'] for part in parts], manifest['output'])
+
+    def done(manifest):
+        manifest['concatenating'] = False
+        manifest['concatenated'] = ok
+    update_manifest(manifest_path, done)
+    if ok:
+        for part in parts:
+            os.remove(part['mp4'])
+        insert_video(manifest['output'], manifest['chat_file_path'])
+    return ok
+
+
+def concat_parts(part_paths, output_path):
+    """Joins mp4 parts with the concat demuxer, streams are copied so nothing is re-encoded."""
+    list_path = output_path + '.parts.txt'
+    with open(list_path, 'w') as list_file:
+        for part_path in part_paths:
+            escaped = os.path.abspath(part_path).replace("'", "'\\''")
+            list_file.write(f"file '{escaped}'\n")
+    job = run_ffmpeg(['-y', '-f', 'concat', '-safe', '0', '-i', list_path, '-map', '0', '-c', 'copy', output_path],
+                     name=os.path.basename(output_path), timeout=CONCAT_TIMEOUT, nice=BATCH_NICE)
+    os.remove(list_path)
+    if not job.ok:
+        print(f"Error joining {len(part_paths)} parts into {output_path}: {job.error}")
+        send_tg(f"Error joining {len(part_paths)} parts into {output_path}: {job.error}", True)
+        return False
+    send_tg(f"Joined {len(part_paths)} parts into {output_path} in {job.wall_time:.2f} seconds.")
+    return True
+
+
+def main():
+    # joins the parts of a recording by hand, e.g. after the daemon was stopped
+    if len(sys.argv) != 2:
+        print("Usage: python segments.py <manifest_path>")
+        sys.exit(1)
+    manifest_path = sys.argv[1]
+    update_manifest(manifest_path, lambda manifest: manifest.update({'closed': True, 'concatenating': False}))
+    if not finish_if_complete(manifest_path):
+        print("Not all parts are converted, or the recording was joined already.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
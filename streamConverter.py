@@ -1,21 +1,75 @@
-from converter import Converter
+import subprocess
 import time
 import os
+from ffmpeg_runner import FFMPEG_PATH, BATCH_NICE, probe, run_ffmpeg
 from tg_bot import send_tg
 
+CONVERSION_TIMEOUT = 6 * 60 * 60  # seconds, far more than a 24 hour stream needs
+
+# Codec arguments of the conversion paths, cheapest first
+CONVERSION_PATHS = {
+    'remux': ['-c', 'copy'],
+    'bitstream_filter': ['-c', 'copy', '-bsf:a', 'aac_adtstoasc'],
+    'reencode': ['-c:v', 'copy', '-c:a', 'aac', '-b:a', '192k', '-ar', '48000', '-ac', '2'],
+}
+MP4_AUDIO_CODECS = ('aac', 'mp3', 'ac3', 'eac3', 'opus', 'alac', 'flac')
+ADTS_FORMATS = ('mpegts', 'aac')  # containers that carry AAC with ADTS headers, mp4 needs them stripped
+
+
 def get_file_size(file_path):
     return os.path.getsize(file_path)
 
 
-def convert_stream_to_mp4(ts_file_path):
-    ffmpeg_path = 'C:\\Program Files\\FFmpeg\\bin\\ffmpeg.exe'
-    ffprobe_path = 'C:\\Program Files\\FFmpeg\\bin\\ffprobe.exe'
-    conv = Converter(ffmpeg_path, ffprobe_path)
+def choose_conversion_path(info):
+    """Picks the cheapest way to get the probed input into mp4.
+       Video is always copied. Twitch audio is AAC already, so in a TS file it only needs its ADTS headers
+       turned into mp4 headers, audio is only re-encoded if mp4 cannot carry it.
+
+       Parameters:
+       ----------
+       info (dict): ffprobe output with format and streams
+
+       Returns:
+       -------
+       str: a key of CONVERSION_PATHS
+       """
+    audio_codecs = {stream.get('codec_name') for stream in info.get('streams', [])
+                    if stream.get('codec_type') == 'audio'}
+    if not audio_codecs <= set(MP4_AUDIO_CODECS):
+        return 'reencode'
+    format_names = info.get('format', {}).get('format_name', '').split(',')
+    if 'aac' in audio_codecs and any(name in ADTS_FORMATS for name in format_names):
+        return 'bitstream_filter'
+    return 'remux'
+
+
+def _run_conversion(ts_file_path, mp4_file_path, path, timeout, on_progress):
+    return run_ffmpeg(['-y', '-i', ts_file_path, '-map', '0:v?', '-map', '0:a?'] + CONVERSION_PATHS[path] +
+                      ['-f', 'mp4', mp4_file_path],
+                      name=os.path.basename(ts_file_path), timeout=timeout, nice=BATCH_NICE, on_progress=on_progress)
+
+
+def convert_stream_to_mp4(ts_file_path, on_progress=None, timeout=CONVERSION_TIMEOUT):
+    """Converts a recorded TS file to mp4 and deletes the TS file.
+       The input is probed once to choose the conversion path (see choose_conversion_path), if a stream copy
+       fails it is converted again with re-encoded audio. ffmpeg runs with batch priority, so it does not slow down
+       live recordings.
+
+       Parameters:
+       ----------
+       on_progress (callable): called with the converted fraction of the stream (0.0 to 1.0) while converting
+       timeout (int): seconds after which the conversion is killed
 
+       Returns:
+       -------
+       bool: True if the mp4 was written.
+       """
     # Get the size and duration of the original TS file
-    info = conv.probe(ts_file_path)
+    info = probe(ts_file_path)
+    if info is None:
+        return False
     original_size = round(get_file_size(ts_file_path) / (1024 * 1024 * 1024) , 2)  # Convert bytes to gigabytes
-    duration = round(info.format.duration, 2)
+    duration = round(float(info['format'].get('duration', 0)), 2)
 
     send_tg(f"File: {ts_file_path} \n Original Size: {original_size} GB, Duration: {duration} seconds")
     # Derive MP4 file path from TS file path
@@ -23,24 +77,24 @@ def convert_stream_to_mp4(ts_file_path):
 
     print("Stream is converting to mp4, please wait...")
     start_time = time.time()
+
+    def report_progress(block):
+        if on_progress and duration:
+            try:
+                on_progress(min(1.0, int(block.get('out_time_us', 0)) / 1e6 / duration))
+            except ValueError:
+                pass  # out_time_us is N/A until the first frame is written
+
     try:
-        # Start conversion process
-        convert = conv.convert(ts_file_path, mp4_file_path, {
-            'format': 'mp4',
-            'audio': {
-                'codec': 'aac',
-                'bitrate': 192,
-                'samplerate': 48000,
-                'channels': 2
-            },
-            'video': {
-                'codec': 'copy'
-            }})
-
-        # Wait for conversion to complete without printing each timecode
-        for _ in convert:
-            pass
-        
+        path = choose_conversion_path(info)
+        job = _run_conversion(ts_file_path, mp4_file_path, path, timeout, report_progress)
+        if not job.ok and path != 'reencode' and not job.cancelled:
+            print(f"Conversion path {path} failed for {ts_file_path}: {job.error}, re-encoding the audio")
+            path = 'reencode'
+            job = _run_conversion(ts_file_path, mp4_file_path, path, timeout, report_progress)
+        if not job.ok:
+            raise RuntimeError(job.error)
+
         conversion_time = time.time() - start_time
         new_size_bytes = get_file_size(mp4_file_path)
         new_size_gb = new_size_bytes / (1024 * 1024 * 1024)  # Convert bytes to gigabytes
@@ -49,11 +103,64 @@ def convert_stream_to_mp4(ts_file_path):
         formatted_time = round(conversion_time, 2)
         formatted_size_gb = round(new_size_gb, 2)
 
-        send_tg(f"Converting finished in {formatted_time} seconds.\nNew MP4 Size: {formatted_size_gb} GB")
+        cpu_time = f", {job.cpu_time:.2f} seconds CPU" if job.cpu_time is not None else ""
+        print(f"Converted {ts_file_path} with path {path} in {formatted_time} seconds{cpu_time}")
+        send_tg(f"Converting ({path}) finished in {formatted_time} seconds{cpu_time}.\n"
+                f"New MP4 Size: {formatted_size_gb} GB")
 
         # Delete the original TS file
         os.remove(ts_file_path)
         print(f"Deleted original file: {ts_file_path}")
         print("Converting is finished, you may continue.")
+        return True
     except Exception as e:
         print(f"Error during conversion: {e}")
+        return False
+
+
+
+class LiveRemuxer:
+    """Remuxes a live TS byte stream into a fragmented MP4 while it is being recorded.
+    Fragments are flushed on every keyframe, so the MP4 is playable up to the last written keyframe even if the
+    recording is cut off, and it is complete within seconds of the stream ending.
+    """
+
+    def __init__(self, mp4_file_path):
+        self.mp4_file_path = mp4_file_path
+        self.failed = False
+        self.process = subprocess.Popen(
+            [FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-y',
+             '-f', 'mpegts', '-i', 'pipe:0',
+             # video and audio only, the mp4 muxer rejects the timed_id3 data stream of Twitch streams
+             '-map', '0:v?', '-map', '0:a?', '-c', 'copy', '-bsf:a', 'aac_adtstoasc',
+             '-movflags', '+frag_keyframe+empty_moov+default_base_moof',
+             '-f', 'mp4', mp4_file_path],
+            stdin=subprocess.PIPE)
+
+    def write(self, data):
+        if self.failed:
+            return
+        try:
+            self.process.stdin.write(data)
+        except (BrokenPipeError, OSError) as e:
+            # ffmpeg died, the recording goes on into the .ts fallback only
+            print(f"Live remux to {self.mp4_file_path} failed: {e}")
+            self.failed = True
+
+    def close(self, timeout=60):
+        """Ends the input and waits for ffmpeg to finalize the MP4.
+
+           Returns:
+           -------
+           bool: True if the MP4 is complete.
+           """
+        try:
+            self.process.stdin.close()
+        except OSError:
+            self.failed = True
+        try:
+            returncode = self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            returncode = None
+        return not self.failed and returncode == 0 and os.path.exists(self.mp4_file_path)
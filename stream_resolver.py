@@ -0,0 +1,67 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlink
+
+PREFETCH_TTL = 30  # seconds a prefetched quality map is handed to a watcher, the playlist tokens live longer
+PREFETCH_WORKERS = 4
+
+
+class StreamResolver:
+    """One long-lived streamlink session shared by all watchers.
+    streamlink.streams() builds a new session, which loads every plugin from disk, before it resolves the channel.
+    Here the plugins are loaded once, the plugin of every channel is kept, and the quality map of a channel can
+    be prefetched as soon as the poller sees it go live, so the watcher only has to open the stream.
+    """
+
+    def __init__(self, session=None):
+        self.session = session or streamlink.Streamlink()
+        self._plugins = {}  # login -> plugin instance
+        self._prefetched = {}  # login -> (fetched at, future of the streams)
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='stream-prefetch')
+
+    def _plugin(self, login):
+        with self._lock:
+            plugin = self._plugins.get(login)
+        if plugin is None:
+            plugin = self.session.resolve_url('https://www.twitch.tv/' + login)
+            with self._lock:
+                self._plugins[login] = plugin
+        return plugin
+
+    def _fetch(self, login):
+        return self._plugin(login).streams()
+
+    def prefetch(self, login):
+        """Starts resolving the streams of a channel in the background, a running prefetch is not repeated."""
+        with self._lock:
+            prefetched = self._prefetched.get(login)
+            if prefetched and time.monotonic() - prefetched[0] < PREFETCH_TTL:
+                return
+            self._prefetched[login] = (time.monotonic(), self._pool.submit(self._fetch, login))
+
+    def streams(self, login):
+        """Quality map of a channel, from a prefetch if there is a recent one.
+
+           Returns:
+           -------
+           dict: quality name -> stream, empty if the channel is offline
+           """
+        with self._lock:
+            prefetched = self._prefetched.pop(login, None)
+        if prefetched and time.monotonic() - prefetched[0] < PREFETCH_TTL:
+            try:
+                return prefetched[1].result()
+            except Exception as e:
+                print(f"Prefetching the streams of {login} failed, resolving again: {e}")
+        return self._fetch(login)
+
+    def forget(self, login):
+        with self._lock:
+            self._plugins.pop(login, None)
+            self._prefetched.pop(login, None)
+
+    def close(self):
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,124 @@
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from types import MappingProxyType
+
+IDLE = 'idle'  # on the watchlist, not live
+LIVE = 'live'  # seen live, the recording is being started
+RECORDING = 'recording'
+CONVERTING = 'converting'  # recording ended, the file is being handed to / run through the conversion
+
+StreamerEntry = namedtuple('StreamerEntry', ['login', 'state', 'preferred_quality', 'user_info', 'stream_info',
+                                             'live_detected_at', 'watcher'])
+
+
+class StreamerRegistry:
+    """Watchlist and per-streamer state of the daemon.
+    All changes run one after another on the registry's own thread, so the poller, request handlers and watcher
+    callbacks cannot interleave a read and a write. After every change an immutable snapshot is published, reading
+    it never waits for the registry thread.
+    """
+
+    def __init__(self):
+        self._entries = {}  # login -> StreamerEntry, only touched on the registry thread
+        self._snapshot = MappingProxyType({})
+        self._commands = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='streamer-registry', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            command, future = self._commands.get()
+            if command is None:
+                return
+            try:
+                result = command()
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            self._snapshot = MappingProxyType(dict(self._entries))
+
+    def _call(self, command):
+        if threading.current_thread() is self._thread or self._closed:
+            return command()  # nested in a command, or the registry thread is gone after close
+        future = Future()
+        self._commands.put((command, future))
+        return future.result()
+
+    def snapshot(self):
+        """Immutable login -> StreamerEntry mapping as of the last change."""
+        return self._snapshot
+
+    def in_state(self, *states):
+        return [entry for entry in self._snapshot.values() if entry.state in states]
+
+    def add(self, login, user_info, quality):
+        """Puts a streamer on the watchlist, an entry that exists already only gets the new quality.
+
+           Returns:
+           -------
+           bool: True if the streamer was not on the watchlist before.
+           """
+        def add():
+            entry = self._entries.get(login)
+            if entry:
+                self._entries[login] = entry._replace(preferred_quality=quality)
+                return False
+            self._entries[login] = StreamerEntry(login, IDLE, quality, user_info, None, None, None)
+            return True
+        return self._call(add)
+
+    def remove(self, login):
+        """Takes a streamer off the watchlist.
+
+           Returns:
+           -------
+           StreamerEntry: the removed entry, None if there was none. A running watcher is left to the caller.
+           """
+        return self._call(lambda: self._entries.pop(login, None))
+
+    def mark_live(self, login, stream_info, detected_at=None):
+        """idle -> live. Returns the entry if this call made the transition, None otherwise."""
+        def mark_live():
+            entry = self._entries.get(login)
+            if entry is None or entry.state != IDLE:
+                return None
+            entry = entry._replace(state=LIVE, stream_info=stream_info, live_detected_at=detected_at or time.time())
+            self._entries[login] = entry
+            return entry
+        return self._call(mark_live)
+
+    def start_recording(self, login, watcher):
+        """live -> recording. Returns False if the streamer is not live any more, e.g. removed or already started."""
+        def start_recording():
+            entry = self._entries.get(login)
+            if entry is None or entry.state != LIVE:
+                return False
+            self._entries[login] = entry._replace(state=RECORDING, watcher=watcher)
+            return True
+        return self._call(start_recording)
+
+    def mark_converting(self, login):
+        def mark_converting():
+            entry = self._entries.get(login)
+            if entry is not None and entry.state == RECORDING:
+                self._entries[login] = entry._replace(state=CONVERTING)
+        self._call(mark_converting)
+
+    def finish(self, login, quality=None):
+        """Back to idle after a recording, with the quality the watcher ended up using."""
+        def finish():
+            entry = self._entries.get(login)
+            if entry is not None:
+                self._entries[login] = entry._replace(state=IDLE, stream_info=None, live_detected_at=None,
+                                                      watcher=None,
+                                                      preferred_quality=quality or entry.preferred_quality)
+        self._call(finish)
+
+    def close(self):
+        self._closed = True
+        self._commands.put((None, None))
@@ -0,0 +1,176 @@
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chat_ingest
+from chat_ingest import ChatMultiplexer
+
+
+class FakeIRCServer:
+    """Accepts IRC connections on 127.0.0.1 and records every line the clients send, with the connection it came
+    in on and the time it arrived. Lines can be sent to any of the connections."""
+
+    def __init__(self):
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.connections = []
+        self.lines = []  # (connection index, monotonic time, line)
+        self.cond = threading.Condition()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with self.cond:
+                self.connections.append(conn)
+                index = len(self.connections) - 1
+                self.cond.notify_all()
+            threading.Thread(target=self._read, args=(conn, index), daemon=True).start()
+
+    def _read(self, conn, index):
+        buffer = b''
+        while True:
+            try:
+                data = conn.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            *lines, buffer = buffer.split(b'\r\n')
+            with self.cond:
+                self.lines.extend((index, time.monotonic(), line.decode()) for line in lines)
+                self.cond.notify_all()
+
+    def received(self, prefix, connection=None):
+        with self.cond:
+            return [(index, at, line) for index, at, line in self.lines
+                    if line.startswith(prefix) and connection in (None, index)]
+
+    def wait_for(self, prefix, count=1, connection=None, timeout=5):
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self.received(prefix, connection)) >= count, timeout)
+
+    def send(self, line, connection=-1):
+        with self.cond:
+            conn = self.connections[connection]
+        conn.sendall((line + '\r\n').encode())
+
+    def close(self):
+        self.sock.close()
+        with self.cond:
+            for conn in self.connections:
+                conn.close()
+
+
+def privmsg(channel, text, sent_ts=1600000000000):
+    return f'@tmi-sent-ts={sent_ts} :viewer!viewer@viewer.tmi.twitch.tv PRIVMSG #{channel} :{text}'
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class ChatMultiplexerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeIRCServer()
+        self.addCleanup(self.server.close)
+        for name, value in (('JOINS_PER_WINDOW', 3), ('JOIN_WINDOW_SECONDS', 0.5), ('RECONNECT_DELAY_SECONDS', 0.05)):
+            patch = mock.patch.object(chat_ingest, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.multiplexer = ChatMultiplexer('127.0.0.1', self.server.port, writer_threads=2)
+        self.addCleanup(self.multiplexer.close)
+
+    def join(self, channel):
+        messages = []
+        self.multiplexer.join(channel, messages.append)
+        return messages
+
+    def test_joins_are_rate_limited(self):
+        channels = [f'channel{i}' for i in range(7)]
+        for channel in channels:
+            self.join(channel)
+        self.assertTrue(self.server.wait_for('JOIN ', len(channels)))
+        joins = self.server.received('JOIN ')
+        self.assertEqual({line for _, _, line in joins}, {'JOIN #' + channel for channel in channels})
+        times = [at for _, at, _ in joins]
+        for first, fourth in zip(times, times[3:]):
+            self.assertGreaterEqual(fourth - first, 0.45, 'more than 3 JOINs within the window')
+
+    def test_messages_go_to_the_handler_of_their_channel(self):
+        first, second = self.join('first'), self.join('second')
+        self.assertTrue(self.server.wait_for('JOIN ', 2))
+        self.server.send(privmsg('first', 'hello first'))
+        self.server.send(privmsg('second', 'hello second'))
+        self.server.send(privmsg('unknown', 'nobody listens'))
+        self.server.send(privmsg('first', 'bye first', sent_ts=1600000001000))
+        self.assertTrue(wait_until(lambda: len(first) == 2 and len(second) == 1))
+        self.assertEqual([message['message'] for message in first], ['hello first', 'bye first'])
+        self.assertEqual(second, [{'timestamp': 1600000000000000, 'message': 'hello second',
+                                   'message_type': 'text_message'}])
+
+    def test_ping_is_answered(self):
+        self.join('first')
+        self.assertTrue(self.server.wait_for('JOIN '))
+        self.server.send('PING :tmi.twitch.tv')
+        self.assertTrue(self.server.wait_for('PONG :tmi.twitch.tv'))
+
+    def test_reconnect_joins_the_channels_again(self):
+        messages = self.join('first')
+        self.assertTrue(self.server.wait_for('JOIN ', connection=0))
+        self.server.send(':tmi.twitch.tv RECONNECT', connection=0)
+        self.assertTrue(self.server.wait_for('JOIN #first', connection=1))
+        self.assertTrue(self.server.wait_for('NICK ', connection=1))
+        self.server.send(privmsg('first', 'after the reconnect'), connection=1)
+        self.assertTrue(wait_until(lambda: messages))
+        self.assertEqual(messages[0]['message'], 'after the reconnect')
+
+    def test_no_handler_call_after_leave(self):
+        calls = []
+        left = threading.Event()
+        late_calls = []
+
+        def slow_handler(message):
+            if left.is_set():
+                late_calls.append(message)
+            time.sleep(0.02)  # a handler waiting for the disk
+            calls.append(message)
+
+        self.multiplexer.join('first', slow_handler)
+        other = self.join('second')
+        self.assertTrue(self.server.wait_for('JOIN ', 2))
+        for i in range(30):
+            self.server.send(privmsg('first', f'message {i}'))
+        self.assertTrue(wait_until(lambda: calls))
+        self.multiplexer.leave('first')
+        left.set()
+        handled = len(calls)
+
+        self.assertTrue(self.server.wait_for('PART #first'))
+        self.server.send(privmsg('first', 'too late'))
+        self.server.send(privmsg('second', 'still joined'))
+        self.assertTrue(wait_until(lambda: other))
+        time.sleep(0.1)
+        self.assertEqual(late_calls, [])
+        self.assertEqual(len(calls), handled)
+        self.assertEqual([message['message'] for message in calls], [f'message {i}' for i in range(handled)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from http.server import HTTPServer
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import eventsub
+import utils
+from ATRHandler import ATRHandler
+from daemon import Daemon
+from eventsub import MessageDeduper
+from streamer_registry import RECORDING
+
+SECRET = 'test-webhook-secret'
+
+
+class EventSubServer(HTTPServer):
+    """The parts of the daemon the webhook handler uses, stream events are recorded instead of acted on.
+    Requests are handled one at a time, so after shutdown() every request has been handled completely."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ATRHandler)
+        self.webhook_secret = SECRET
+        self.eventsub_messages = MessageDeduper()
+        self.stream_events = []
+
+    def handle_stream_event(self, subscription_type, event):
+        self.stream_events.append((subscription_type, event['broadcaster_user_login']))
+
+
+def timestamp(age=timedelta()):
+    """RFC3339 with nanoseconds, like Twitch sends it."""
+    return (datetime.now(timezone.utc) - age).strftime('%Y-%m-%dT%H:%M:%S.%f') + '123Z'
+
+
+def notification(subscription_type='stream.online', login='somestreamer'):
+    return {'subscription': {'type': subscription_type, 'status': 'enabled'},
+            'event': {'broadcaster_user_login': login, 'started_at': timestamp()}}
+
+
+def post(address, payload, message_type='notification', message_id='message-1', sent_at=None, secret=SECRET):
+    body = json.dumps(payload).encode()
+    sent_at = sent_at or timestamp()
+    headers = {'Content-Type': 'application/json',
+               eventsub.MESSAGE_ID: message_id,
+               eventsub.MESSAGE_TIMESTAMP: sent_at,
+               eventsub.MESSAGE_TYPE: message_type,
+               eventsub.MESSAGE_SIGNATURE: eventsub.sign(secret, message_id, sent_at, body)}
+    connection = http.client.HTTPConnection(*address, timeout=10)
+    try:
+        connection.request('POST', '/', body, headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+class FakeWatcher:
+    """Records until stream_ended is set, like a watcher whose stream delivers until the broadcast is over."""
+
+    def __init__(self, streamer_dict, *args):
+        self.streamer_dict = streamer_dict
+        self.kill = False
+        self.cleanup = False
+        self.on_recording_finished = None
+        self.stream_ended = threading.Event()
+
+    def quit(self):
+        self.kill = True
+        self.stream_ended.set()
+
+    def clean_break(self):
+        self.cleanup = True
+        self.stream_ended.set()
+
+    def start_chat_download(self):
+        pass
+
+    def watch(self):
+        self.stream_ended.wait(10)
+        # a stream that ended on its own is cleaned up like this too, see Watcher._watch
+        self.streamer_dict.update({'kill': self.kill, 'cleanup': True, 'output_filepath': None})
+        return self.streamer_dict
+
+
+class EventSubWebhookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = EventSubServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.addCleanup(self.server.server_close)
+
+    def stop_server(self):
+        self.server.shutdown()
+        self.server_thread.join()
+
+    def post(self, payload, **kwargs):
+        return post(self.server.server_address, payload, **kwargs)
+
+    def test_challenge_is_echoed(self):
+        payload = {'challenge': 'pogchamp-kappa-360noscope', 'subscription': {'type': 'stream.online'}}
+        status, body = self.post(payload, message_type='webhook_callback_verification')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'pogchamp-kappa-360noscope')
+
+    def test_duplicate_notification_is_acted_on_once(self):
+        self.assertEqual(self.post(notification())[0], 204)
+        self.assertEqual(self.post(notification())[0], 204)
+        self.assertEqual(self.post(notification('stream.offline'), message_id='message-2')[0], 204)
+        self.stop_server()
+        self.assertEqual(self.server.stream_events,
+                         [('stream.online', 'somestreamer'), ('stream.offline', 'somestreamer')])
+
+    def test_bad_signature_is_rejected(self):
+        status, _ = self.post(notification(), secret='automaticTwitchRecorder')
+        self.stop_server()
+        self.assertEqual(status, 403)
+        self.assertEqual(self.server.stream_events, [])
+
+    def test_stale_timestamp_is_rejected(self):
+        sent_at = timestamp(timedelta(seconds=eventsub.MAX_MESSAGE_AGE + 60))
+        status, _ = self.post(notification(), sent_at=sent_at)
+        self.stop_server()
+        self.assertEqual(status, 403)
+        self.assertEqual(self.server.stream_events, [])
+        # not remembered, a fresh delivery of the same message is still acted on
+        self.assertFalse(self.server.eventsub_messages.seen('message-1'))
+
+
+
+class DaemonStreamEventTest(unittest.TestCase):
+    """Notifications handled by a real daemon, only the recording is faked."""
+
+    def setUp(self):
+        # the conversion queue opens its database in the working directory
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(work_dir.name)
+        # no config.txt is read, the daemon only needs a client id and the webhook secret
+        config = mock.patch.object(utils, 'CONFIG', {'client_id': 'test', 'client_secret': 'test',
+                                                     'ngrok_authtoken': '', 'webhook_secret': SECRET})
+        config.start()
+        self.addCleanup(config.stop)
+        watcher = mock.patch('daemon.Watcher', FakeWatcher)
+        watcher.start()
+        self.addCleanup(watcher.stop)
+
+        self.daemon = Daemon(('127.0.0.1', 0), ATRHandler)
+        serve_thread = threading.Thread(target=self.daemon.serve_forever, daemon=True)
+        serve_thread.start()
+        self.addCleanup(serve_thread.join)
+        self.addCleanup(self.daemon.exit)
+
+        self.handled = threading.Event()
+        handle_stream_event = self.daemon.handle_stream_event
+
+        def handle_and_signal(*args):
+            handle_stream_event(*args)
+            self.handled.set()
+        self.daemon.handle_stream_event = handle_and_signal
+
+    def test_stream_offline_keeps_the_streamer_on_the_watchlist(self):
+        user_info = {'id': '1', 'login': 'somestreamer', 'display_name': 'SomeStreamer'}
+        self.daemon.registry.add('somestreamer', user_info, 'best')
+        self.daemon.registry.mark_live('somestreamer', {'status': 'online', 'title': 'stub'})
+        self.daemon._start_watcher('somestreamer')
+        watcher = self.daemon.registry.snapshot()['somestreamer'].watcher
+
+        status, _ = post(self.daemon.server_address, notification('stream.offline'))
+        self.assertEqual(status, 204)
+        self.assertTrue(self.handled.wait(10))
+        self.daemon.event_pool.shutdown(wait=True)  # the queued offline work has run
+        self.assertFalse(watcher.kill)
+        self.assertFalse(watcher.stream_ended.is_set(), 'the recording was cut off')
+
+        def recording():
+            entry = self.daemon.registry.snapshot().get('somestreamer')
+            return entry is not None and entry.state == RECORDING
+
+        watcher.stream_ended.set()  # the stream delivers its last bytes
+        deadline = time.monotonic() + 10
+        while recording() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.daemon.get_streamers(), ([], ['somestreamer']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hls_reader import HLSReader
+
+
+def playlist(first_sequence, count, ended):
+    lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:0.2', f'#EXT-X-MEDIA-SEQUENCE:{first_sequence}']
+    for sequence in range(first_sequence, first_sequence + count):
+        lines += ['#EXTINF:0.2,', f'seg{sequence}.ts']
+    if ended:
+        lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def segment(sequence):
+    return f'<segment {sequence}>'.encode() * 100
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serves server.playlists one after another on every playlist request (the last one is repeated) and
+    seg<N>.ts segments, delayed by server.delays[N] seconds, with a 404 for the numbers in server.missing."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/playlist.m3u8':
+            with server.lock:
+                body = server.playlists[min(server.playlist_requests, len(server.playlists) - 1)].encode()
+                server.playlist_requests += 1
+        else:
+            sequence = int(self.path[len('/seg'):-len('.ts')])
+            time.sleep(server.delays.get(sequence, 0))
+            if sequence in server.missing:
+                self.send_error(404)
+                return
+            body = segment(sequence)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HLSReaderTest(unittest.TestCase):
+
+    def serve(self, playlists, delays=None, missing=()):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+        server.daemon_threads = True
+        server.playlists = playlists
+        server.playlist_requests = 0
+        server.lock = threading.Lock()
+        server.delays = delays or {}
+        server.missing = set(missing)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f'http://127.0.0.1:{server.server_address[1]}/playlist.m3u8'
+
+    def read_all(self, url):
+        reader = HLSReader(url, workers=4, stall_timeout=5)
+        self.addCleanup(reader.close)
+        return reader, reader.read()
+
+    def test_segments_downloaded_out_of_order_are_read_in_order(self):
+        # the first segments take the longest, so they finish downloading last
+        url = self.serve([playlist(0, 6, ended=True)], delays={0: 0.4, 1: 0.3, 2: 0.2, 3: 0.1})
+        reader, data = self.read_all(url)
+        self.assertEqual(data, b''.join(segment(sequence) for sequence in range(6)))
+        self.assertEqual(reader.gaps, [])
+
+    def test_failed_segment_is_skipped_as_a_gap(self):
+        url = self.serve([playlist(0, 5, ended=True)], missing={2})
+        reader, data = self.read_all(url)
+        self.assertEqual(data, b''.join(segment(sequence) for sequence in (0, 1, 3, 4)))
+        self.assertEqual(reader.gaps, [(2, 2)])
+
+    def test_playlist_jump_is_logged_as_a_gap(self):
+        url = self.serve([playlist(0, 3, ended=False), playlist(6, 3, ended=True)])
+        reader, data = self.read_all(url)
+        self.assertEqual(data, b''.join(segment(sequence) for sequence in (0, 1, 2, 6, 7, 8)))
+        self.assertEqual(reader.gaps, [(3, 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,26 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-from time import sleep
+from time import perf_counter, sleep
+import metrics
 import utils
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 
-auth = {'Client-ID': str(utils.get_client_id()),
-        'Authorization': 'Bearer ' + utils.get_app_access_token()}
+STREAM_INFO_PAGE_SIZE = 100  # helix/streams accepts at most 100 user_id parameters
+USER_INFO_PAGE_SIZE = 100  # helix/users accepts at most 100 login parameters
+MAX_CONCURRENT_PAGES = 20  # 2000 streamers per sweep
+EVENTSUB_SUBSCRIPTIONS_URL = 'https://api.twitch.tv/helix/eventsub/subscriptions'
+
 
 def requests_retry_session(
     retries=3,
     backoff_factor=2,
     status_forcelist=(500, 502, 503, 504),
+    pool_maxsize=10,
+    pool_block=False,
 ):
     session = requests.Session()
     retry = Retry(
@@ -20,12 +30,68 @@ def requests_retry_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize, pool_block=pool_block)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
 
+class TwitchClient:
+    """
+    Helix API client shared by all calls of this module.
+    Holds a bounded keep-alive connection pool with the retry policy and the auth headers, which are rebuilt
+    lazily whenever the app access token from `utils.get_app_access_token` changes.
+    """
+
+    def __init__(self, pool_maxsize=MAX_CONCURRENT_PAGES, timeout=20):
+        self.session = requests_retry_session(pool_maxsize=pool_maxsize, pool_block=True)
+        self.timeout = timeout
+        self._token = None
+        self._headers = None
+        self._lock = threading.Lock()
+
+    def _auth_headers(self):
+        with self._lock:
+            token = utils.get_app_access_token()
+            if token != self._token:
+                self._token = token
+                self._headers = {'Client-ID': str(utils.get_client_id()),
+                                 'Authorization': 'Bearer ' + token}
+            return self._headers
+
+    def _request(self, method, url, **kwargs):
+        start = perf_counter()
+        status = 'error'
+        try:
+            r = self.session.request(method, url, headers=self._auth_headers(), timeout=self.timeout, **kwargs)
+            status = str(r.status_code)
+            return r
+        finally:
+            metrics.API_REQUEST_SECONDS.labels(method, status).observe(perf_counter() - start)
+
+    def get(self, url):
+        r = self._request('GET', url)
+        if r.status_code == 401:
+            # token got revoked or expired early, fetch a new one and try once more
+            with self._lock:
+                utils.invalidate_app_access_token()
+            r = self._request('GET', url)
+        return r
+
+    def post(self, url, body):
+        r = self._request('POST', url, json=body)
+        if r.status_code == 401:
+            with self._lock:
+                utils.invalidate_app_access_token()
+            r = self._request('POST', url, json=body)
+        return r
+
+
+client = TwitchClient()
+# worker threads shared by all stream info pages of a poll sweep
+_page_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PAGES, thread_name_prefix='stream-info')
+
+
 def get_user_info(user_login, *args: str) -> list:
     """
     Gets user info for user logins
@@ -48,9 +114,8 @@ def get_user_info(user_login, *args: str) -> list:
         args = args[:99]
     for user_login_i in args:
         get_user_id_url += '&login=' + user_login_i
-    session = requests_retry_session()
     try:
-        r = session.get(get_user_id_url, headers=auth, timeout=20)
+        r = client.get(get_user_id_url)
     except Exception as e:
         print(f"Error during API call: {e}")
         return []
@@ -58,6 +123,28 @@ def get_user_info(user_login, *args: str) -> list:
     return list(temp['data']) if temp['data'] else []
 
 
+def get_users_info(*user_logins) -> list:
+    """
+    Gets user info for any number of user logins.
+    The logins are split into pages of 100 which are fetched concurrently.
+
+    Parameters
+    ----------
+    user_logins: str
+        username strings
+
+    Returns
+    -------
+    list
+        contains user_info dicts of all existing users
+    """
+    pages = [user_logins[i:i + USER_INFO_PAGE_SIZE] for i in range(0, len(user_logins), USER_INFO_PAGE_SIZE)]
+    users = []
+    for page_users in _page_executor.map(lambda page: get_user_info(*page), pages):
+        users.extend(page_users)
+    return users
+
+
 def get_stream_info(*user_ids):
     """
     Gets stream info for user ids
@@ -78,18 +165,11 @@ def get_stream_info(*user_ids):
     if len(user_ids) > 100:
         user_ids = user_ids[:100]
     base_url = 'https://api.twitch.tv/helix/streams?'
-    auth_token = utils.get_app_access_token()  # Get the app access token
-    headers = {
-        'Client-ID': utils.get_client_id(),
-        'Authorization': f'Bearer {auth_token}'
-    }
-
     user_id_params = '&'.join([f'user_id={uid}' for uid in user_ids])
     full_url = base_url + user_id_params
-    session = requests_retry_session()
     stream_info = {uid: {'status': 'offline'} for uid in user_ids} # Default to offline
     try:
-        response = session.get(full_url, headers=headers, timeout=20)
+        response = client.get(full_url)
         if response.status_code == 200:
             data = response.json().get('data', [])
             for stream in data:
@@ -105,3 +185,76 @@ def get_stream_info(*user_ids):
     except Exception as e:
         print(f"Error during API call: {e}")
     return stream_info
+
+
+async def get_stream_info_async(*user_ids):
+    """
+    Gets stream info for any number of user ids.
+    The ids are split into pages of 100 which are fetched concurrently over one shared keep-alive session.
+
+    Parameters
+    ----------
+    user_ids: str
+        user id strings
+
+    Returns
+    -------
+    dict
+        maps every user id to its stream_info dict
+    """
+    loop = asyncio.get_running_loop()
+    pages = [user_ids[i:i + STREAM_INFO_PAGE_SIZE] for i in range(0, len(user_ids), STREAM_INFO_PAGE_SIZE)]
+    results = await asyncio.gather(*(loop.run_in_executor(_page_executor, get_stream_info, *page) for page in pages))
+    stream_info = {}
+    for page_info in results:
+        stream_info.update(page_info)
+    return stream_info
+
+
+def create_eventsub_subscription(subscription_type, user_id, callback_url, secret):
+    """
+    Subscribes a webhook to an EventSub event of a broadcaster
+    See https://dev.twitch.tv/docs/api/reference#create-eventsub-subscription
+
+    Parameters
+    ----------
+    subscription_type: str
+        e.g. 'stream.online' or 'stream.offline'
+    user_id: str
+        user id of the broadcaster
+    callback_url: str
+        public https url of the webhook
+    secret: str
+        secret the notifications are signed with (10 to 100 characters)
+
+    Returns
+    -------
+    bool
+        True if the subscription exists now
+    """
+    body = {'type': subscription_type,
+            'version': '1',
+            'condition': {'broadcaster_user_id': str(user_id)},
+            'transport': {'method': 'webhook', 'callback': callback_url, 'secret': secret}}
+    try:
+        response = client.post(EVENTSUB_SUBSCRIPTIONS_URL, body)
+    except Exception as e:
+        print(f"Error during API call: {e}")
+        return False
+    if response.status_code in (202, 409):  # 409: subscribed already
+        return True
+    print(f"Error subscribing to {subscription_type} of {user_id}: {response.status_code} - {response.text}")
+    return False
+
+
+def subscribe_stream_events(user_id, callback_url, secret):
+    """
+    Subscribes a webhook to stream.online and stream.offline of a broadcaster
+
+    Returns
+    -------
+    bool
+        True if both subscriptions exist now
+    """
+    return all([create_eventsub_subscription(subscription_type, user_id, callback_url, secret)
+                for subscription_type in ('stream.online', 'stream.offline')])
@@ -0,0 +1,81 @@
+import json
+import time
+
+import metrics
+import twitch
+from db_connection import create_connection, create_table, DATABASE
+
+CACHE_TTL = 7 * 24 * 60 * 60  # user ids never change, display names rarely do
+_SQL_PARAMS_PER_QUERY = 500  # stay below SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds
+
+sql_create_user_cache_table = """ CREATE TABLE IF NOT EXISTS user_cache (
+                                      login text PRIMARY KEY,
+                                      user_info text NOT NULL,
+                                      fetched_at real NOT NULL
+                                  ); """
+
+
+def _connect():
+    conn = create_connection(DATABASE)
+    if conn is not None:
+        create_table(conn, sql_create_user_cache_table)
+    return conn
+
+
+def get_cached_users(logins, ttl=CACHE_TTL):
+    """ Look up user_info dicts of logins that were resolved less than ttl seconds ago
+    :param logins: list of lowercase user logins
+    :param ttl: maximum age of a cache entry in seconds
+    :return: dict login -> user_info
+    """
+    users = {}
+    with metrics.DB_OPERATION_SECONDS.labels('user_cache_read').time():
+        conn = _connect()
+        if conn is None:
+            return users
+        min_fetched_at = time.time() - ttl
+        try:
+            cur = conn.cursor()
+            for i in range(0, len(logins), _SQL_PARAMS_PER_QUERY):
+                chunk = logins[i:i + _SQL_PARAMS_PER_QUERY]
+                cur.execute(f"SELECT login, user_info FROM user_cache WHERE fetched_at > ? "
+                            f"AND login IN ({','.join('?' * len(chunk))})", (min_fetched_at, *chunk))
+                users.update((login, json.loads(user_info)) for login, user_info in cur.fetchall())
+        finally:
+            conn.close()
+    return users
+
+
+def store_users(user_infos):
+    """ Insert or refresh user_info dicts in the cache
+    :param user_infos: list of user_info dicts as returned by twitch.get_user_info
+    """
+    if not user_infos:
+        return
+    with metrics.DB_OPERATION_SECONDS.labels('user_cache_write').time():
+        conn = _connect()
+        if conn is None:
+            return
+        now = time.time()
+        try:
+            conn.executemany("INSERT OR REPLACE INTO user_cache(login, user_info, fetched_at) VALUES(?,?,?)",
+                             [(info['login'].lower(), json.dumps(info), now) for info in user_infos])
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def resolve_logins(logins, ttl=CACHE_TTL):
+    """ Resolve user logins to user_info dicts, asking the API in batches of 100 only for logins missing from the cache
+    :param logins: list of user logins
+    :param ttl: maximum age of a cache entry in seconds
+    :return: dict login -> user_info, logins of non-existing users are left out
+    """
+    logins = list(dict.fromkeys(login.lower() for login in logins))
+    users = get_cached_users(logins, ttl)
+    missing = [login for login in logins if login not in users]
+    if missing:
+        fetched = twitch.get_users_info(*missing)
+        store_users(fetched)
+        users.update((info['login'].lower(), info) for info in fetched)
+    return users
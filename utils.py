@@ -1,4 +1,5 @@
 import os
+import secrets
 from datetime import datetime, timedelta
 from enum import Enum
 from pathlib import Path
@@ -99,6 +100,17 @@ def get_ngrok_auth_token():
     return CONFIG['ngrok_authtoken']
 
 
+def get_webhook_secret():
+    global CONFIG
+    if not CONFIG:
+        _read_config()
+    if not CONFIG.get('webhook_secret'):
+        # generated once per install and kept, existing subscriptions stay signed with the secret they were made with
+        CONFIG['webhook_secret'] = secrets.token_hex(32)
+        _write_config()
+    return CONFIG['webhook_secret']
+
+
 def get_app_access_token():
     global _APP_ACCESS_TOKEN, _APP_ACCESS_TOKEN_REFRESH_TIME
     # API Notes:
@@ -122,6 +134,12 @@ def get_app_access_token():
     return _APP_ACCESS_TOKEN
 
 
+def invalidate_app_access_token():
+    global _APP_ACCESS_TOKEN, _APP_ACCESS_TOKEN_REFRESH_TIME
+    _APP_ACCESS_TOKEN = ''
+    _APP_ACCESS_TOKEN_REFRESH_TIME = None
+
+
 def get_valid_filename(s):
     s = str(s)
     return sanitize_filename(s)
@@ -1,19 +1,22 @@
 import json
+import math
 import os
-import subprocess
 import sys
 import time
 import logging
 
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from db_connection import create_connection
+from chat_store import ChatStore
+from ffmpeg_runner import BATCH_NICE, run_ffmpeg, run_ffprobe
+from metrics import DB_OPERATION_SECONDS
 from tg_bot import send_tg
 
-logging.basicConfig(filename='C:\\OpenServer\\twitch\\automatic-twitch-recorder\\daemon.log',
-                    level=logging.INFO,
-                    format='%(asctime)s %(levelname)s:%(message)s')
+LOG_FILE = 'C:\\OpenServer\\twitch\\automatic-twitch-recorder\\daemon.log'
 
 def insert_video(video_path, chat_path):
     """
@@ -28,8 +31,9 @@ def insert_video(video_path, chat_path):
         sql = ''' INSERT INTO videos(file_path, chat_file_path)
                   VALUES(?,?) '''
         cur = conn.cursor()
-        cur.execute(sql, (video_path, chat_path))
-        conn.commit()
+        with DB_OPERATION_SECONDS.labels('insert_video').time():
+            cur.execute(sql, (video_path, chat_path))
+            conn.commit()
         last_id = cur.lastrowid
         conn.close()
         return last_id
@@ -87,77 +91,77 @@ def calculate_duration_from_start(video_start_time, event_time):
     return max(event_time - video_start_time, 0)  # Ensure non-negative
 
 
-def save_chat_messages(timeframe, clip_path):
-    chat_messages = list(timeframe['messages'])
+def save_chat_messages(timeframe, clip_path, chat_store=None, clip_start=None, clip_end=None):
+    """
+    Save the chat of a clip next to it. Older segments files carry the messages in the timeframe, otherwise they
+    are read from the chat store for the clip range.
+    :param clip_start: start of the clip in microseconds since the start of the video
+    :param clip_end: end of the clip in microseconds since the start of the video
+    """
+    if 'messages' in timeframe:
+        chat_messages = list(timeframe['messages'])
+    elif chat_store:
+        chat_messages = chat_store.messages_between(clip_start, clip_end)
+    else:
+        return
     with open(f"{os.path.splitext(clip_path)[0]}_chat.json", 'w') as chat_file:
         json.dump(chat_messages, chat_file, indent=4)
 
-def slice_video(video_path, start_time, end_time, clip_path):
-    try:
-        ffmpeg_cmd = ["ffmpeg", "-i", video_path, "-ss", start_time, "-to", end_time, "-c", "copy", clip_path]
-        subprocess.run(ffmpeg_cmd, check=True)
-        return True
-    except subprocess.CalledProcessError as e:
-        send_tg(f"Error slicing video: {e}", True)
-        print(f"Error slicing video: {e}")
+CLIP_TIMEOUT = 15 * 60  # seconds per ffmpeg run, stream copies of a few clips take seconds
+PROBE_TIMEOUT = 10 * 60  # the keyframe index reads every packet of a long video
+
+def slice_video_multi(video_path, clips):
+    """
+    Cut several clips with one ffmpeg invocation. Every clip opens the video as its own input with input-side seeking,
+    so each of them only reads its own part of the file.
+    :param video_path: Path to the video file
+    :param clips: list of (start_time, end_time, clip_path) with HH:MM:SS timestamps
+    :return: True if all clips were written
+    """
+    ffmpeg_args = ["-y"]
+    for start_time, end_time, _ in clips:
+        ffmpeg_args += ["-ss", start_time, "-to", end_time, "-i", video_path]
+    for i, (_, _, clip_path) in enumerate(clips):
+        ffmpeg_args += ["-map", str(i), "-c", "copy", clip_path]
+    job = run_ffmpeg(ffmpeg_args, name=os.path.basename(clips[0][2]), timeout=CLIP_TIMEOUT * len(clips),
+                     nice=BATCH_NICE)
+    if not job.ok:
+        send_tg(f"Error slicing {len(clips)} clips from video: {job.error}", True)
+        print(f"Error slicing {len(clips)} clips from video: {job.error}")
         return False
+    logging.info(f"Sliced {len(clips)} clips in {job.wall_time:.2f} seconds, {job.cpu_time} seconds CPU")
+    return True
     
 def get_video_duration(video_path):
 # Returns the duration of the video in seconds.
     try:
-        result = subprocess.run(["ffprobe", "-v", "error", "-show_entries",
-                                    "format=duration", "-of",
-                                    "default=noprint_wrappers=1:nokey=1", video_path],
-                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        return float(result.stdout)
+        job = run_ffprobe(["-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1",
+                           video_path])
+        if not job.ok:
+            raise RuntimeError(job.error)
+        return float(job.stdout)
     except Exception as e:
         print(f"Error getting video duration: {e}")
         send_tg(f"Error getting video duration: {e}", True)
         return None
-    
-def process_timeframe(video_path, video_start_time, timeframe, clip_dir, config):
-    logging.info("-------------------  START ----------------")
-    logging.info(f"timeframe start {timeframe['start']} and timeframe end {timeframe['end']}")
-
-    # Get the total duration of the video
-    video_total_duration = get_video_duration(video_path)
-    logging.info(f"Video total duration {video_total_duration}")
 
-    if video_total_duration is None:
-        print("Error obtaining video duration for", video_path)
-        return
-
-    video_total_duration = timedelta(seconds=video_total_duration)
-    logging.info(f"Video total duration timedelta {video_total_duration}")
-
-    video_total_duration_seconds = get_video_duration(video_path)
-    if video_total_duration_seconds is None:
-        print("Error obtaining video duration for", video_path)
-        return
-
-    video_total_duration_td = timedelta(seconds=video_total_duration_seconds)
-    logging.info(f"Video total duration timedelta {video_total_duration_td}")
+def timeframe_to_clip_range(video_start_time, timeframe, video_total_duration):
+    """
+    Widen a chat timeframe to the minimum clip length and clamp it to the video.
+    :param video_start_time: start of the video in seconds
+    :param timeframe: dict with 'start' and 'end' in microseconds
+    :param video_total_duration: duration of the video as timedelta
+    :return: (start_duration, end_duration) as timedelta
+    """
     # Convert timestamps from microseconds to seconds
-    logging.info("Convert timestamps from microseconds to seconds")
     start_time = microseconds_to_seconds(timeframe['start'])
     end_time = microseconds_to_seconds(timeframe['end'])
-    logging.info(f"start_time {start_time} and end_time {end_time}")
-
 
     # Calculate duration from the start of the video
-    logging.info("Calculate duration from the start of the video")
-    start_duration = calculate_duration_from_start(video_start_time, start_time)
-    end_duration = calculate_duration_from_start(video_start_time, end_time)
-    logging.info(f"start_duration {start_duration} and end_duration {end_duration}")
-
-    # Convert to timedelta
-    logging.info("Convert to timedelta")
-    start_duration = timedelta(seconds=start_duration)
-    end_duration = timedelta(seconds=end_duration)
-    logging.info(f"start_duration {start_duration} and end_duration {end_duration}")
+    start_duration = timedelta(seconds=calculate_duration_from_start(video_start_time, start_time))
+    end_duration = timedelta(seconds=calculate_duration_from_start(video_start_time, end_time))
 
     # Adjust timeframe duration
-    logging.info("Adjust timeframe duration")
     duration = end_duration - start_duration
     if duration < timedelta(minutes=1.5):
         extend_each_side = (timedelta(minutes=1.5) - duration) / 2
@@ -167,33 +171,192 @@ def process_timeframe(video_path, video_start_time, timeframe, clip_dir, config)
         extend_each_side = (timedelta(minutes=3) - duration) / 2
         start_duration -= extend_each_side
         end_duration += extend_each_side
-    logging.info(f"start_duration {start_duration} and end_duration {end_duration}")
+
     # Ensure the start and end durations are within the video's duration
-    logging.info("Ensure the start and end durations are within the video's duration")
     start_duration = max(timedelta(seconds=0), start_duration)
-    # Replace 'video_total_duration' with the total duration of the video in timedelta format
-    logging.info("Replace 'video_total_duration' with the total duration of the video in timedelta format")
     end_duration = min(video_total_duration, end_duration)
-    logging.info(f"start_duration {start_duration} and end_duration {end_duration}")
+    return start_duration, end_duration
 
-    # Format as HH:MM:SS
-    logging.info("Format as HH:MM:SS")
-    start_timestamp = timedelta_to_hhmmss(start_duration)
-    end_timestamp = timedelta_to_hhmmss(end_duration)
-    logging.info(f"start_timestamp {start_timestamp} and end_timestamp {end_timestamp}")
-    logging.info("-------------------  END ----------------")
-
-    clip_path = os.path.join(clip_dir, f"clip_{datetime.now().strftime('%Y%m%d%H%M%S')}.mp4")
-    success = slice_video(video_path, start_timestamp, end_timestamp, clip_path)
-
-    if success and config.get('save_chat_messages', False):
-        save_chat_messages(timeframe, clip_path)
+def clip_file_path(clip_dir, index):
+    return os.path.join(clip_dir, f"clip_{datetime.now().strftime('%Y%m%d%H%M%S')}_{index:03}.mp4")
+    
+def get_keyframes(video_path):
+    """
+    Keyframe timestamps of the first video stream in seconds. The index is built once from the packet flags
+    (nothing is decoded) and cached next to the video as <video>.keyframes.json.
+    :param video_path: Path to the video file
+    :return: sorted list of keyframe timestamps, empty if probing failed
+    """
+    index_path = video_path + '.keyframes.json'
+    video_size = os.path.getsize(video_path)
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'r') as index_file:
+                index = json.load(index_file)
+            if index.get('size') == video_size:
+                return index['keyframes']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable keyframe index {index_path}: {e}")
+
+    job = run_ffprobe(["-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0",
+                       video_path], timeout=PROBE_TIMEOUT, nice=BATCH_NICE)
+    if not job.ok:
+        print(f"Error building keyframe index: {job.error}")
+        send_tg(f"Error building keyframe index: {job.error}", True)
+        return []
+
+    keyframes = []
+    for line in job.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time))
+    keyframes.sort()
 
-    return success
+    try:
+        with open(index_path, 'w') as index_file:
+            json.dump({'size': video_size, 'keyframes': keyframes}, index_file)
+    except OSError as e:
+        print(f"Could not cache keyframe index {index_path}: {e}")
+    return keyframes
 
-def make_clips(video_path, timeframes_json, config_path):
+def snap_to_keyframes(start_seconds, end_seconds, keyframes, video_total_seconds):
+    """
+    Move the start back to the keyframe at or before it and the end forward to the keyframe at or after it,
+    so a stream-copy cut contains exactly the requested range.
+    :return: (start_seconds, end_seconds)
+    """
+    if not keyframes:
+        return start_seconds, end_seconds
+    i = bisect_right(keyframes, start_seconds) - 1
+    start_seconds = keyframes[i] if i >= 0 else 0.0
+    j = bisect_left(keyframes, end_seconds)
+    end_seconds = keyframes[j] if j < len(keyframes) else video_total_seconds
+    return start_seconds, end_seconds
+
+def seconds_to_ffmpeg(seconds):
+    return f"{seconds:.3f}"
+
+def plan_clips(video_start_time, timeframes, video_total_duration, config, keyframes=None):
+    """
+    Turn all chat timeframes into one clip plan. Every timeframe is padded like a single clip and snapped to
+    keyframes, then the ranges are sorted and merged when they overlap or are at most `clip_merge_gap_seconds`
+    apart. With `max_total_clip_seconds` only the best scored clips that fit into that total are kept.
+    :param video_start_time: start of the video in seconds
+    :param timeframes: list of dicts with 'start' and 'end' in microseconds and optionally 'score'
+    :param video_total_duration: duration of the video as timedelta
+    :param config: configuration dict
+    :param keyframes: sorted keyframe timestamps in seconds, clip boundaries are not snapped if empty
+    :return: list of dicts with 'start' and 'end' in seconds, 'score' and the 'timeframes' indices, sorted by start
+    """
+    merge_gap = config.get('clip_merge_gap_seconds', 0)
+    max_total = config.get('max_total_clip_seconds')
+    video_total_seconds = video_total_duration.total_seconds()
+
+    ranges = []
+    for index, timeframe in enumerate(timeframes):
+        start_duration, end_duration = timeframe_to_clip_range(video_start_time, timeframe, video_total_duration)
+        start_seconds, end_seconds = snap_to_keyframes(start_duration.total_seconds(), end_duration.total_seconds(),
+                                                       keyframes, video_total_seconds)
+        if end_seconds <= start_seconds:
+            continue  # the timeframe lies past the end of the video
+        ranges.append({'start': start_seconds, 'end': end_seconds,
+                       'score': timeframe.get('score', 0), 'timeframes': [index]})
+    ranges.sort(key=lambda clip: (clip['start'], clip['end']))
+
+    plan = []
+    for clip in ranges:
+        if plan and clip['start'] - plan[-1]['end'] <= merge_gap:
+            last = plan[-1]
+            last['end'] = max(last['end'], clip['end'])
+            last['score'] = max(last['score'], clip['score'])
+            last['timeframes'] += clip['timeframes']
+        else:
+            plan.append(clip)
+
+    if max_total:
+        kept = []
+        total = 0.0
+        for clip in sorted(plan, key=lambda clip: -clip['score']):
+            duration = clip['end'] - clip['start']
+            if total + duration <= max_total:
+                kept.append(clip)
+                total += duration
+        plan = sorted(kept, key=lambda clip: clip['start'])
+    return plan
+
+def plan_duration(plan):
+    return sum(clip['end'] - clip['start'] for clip in plan)
+
+def merged_chat_timeframe(timeframes):
+    """
+    The timeframe whose chat is saved for a merged clip. The embedded messages of the merged timeframes are
+    combined without duplicates, without them the chat is read from the chat store.
+    """
+    if len(timeframes) == 1:
+        return timeframes[0]
+    if not all('messages' in timeframe for timeframe in timeframes):
+        return {}
+    messages = {}
+    for timeframe in timeframes:
+        for message in timeframe['messages']:
+            messages.setdefault((message.get('timestamp'), message.get('message')), message)
+    return {'messages': sorted(messages.values(), key=lambda message: message.get('timestamp') or 0)}
+
+def process_timeframes_parallel(video_path, plan, timeframes, clip_dir, config, chat_store=None):
+    """
+    Cut the clips of a clip plan in a process pool of `clip_workers` workers (default: number of cores).
+    With `process_all_at_once` up to `clips_per_ffmpeg` clips share one ffmpeg run.
+    :param plan: clip plan from plan_clips
+    :param timeframes: the timeframes the plan was made from
+    :return: (success_count, failure_count)
+    """
+    clips = [(seconds_to_ffmpeg(clip['start']), seconds_to_ffmpeg(clip['end']), clip_file_path(clip_dir, index))
+             for index, clip in enumerate(plan)]
+    if not clips:
+        return 0, 0
+
+    workers = config.get('clip_workers') or os.cpu_count() or 1
+    if config.get('process_all_at_once', False):
+        # keep every worker busy before packing several clips into one ffmpeg run
+        batch_size = max(1, min(config.get('clips_per_ffmpeg', 16), math.ceil(len(clips) / workers)))
+    else:
+        batch_size = 1
+
+    success_count = 0
+    failure_count = 0
+    with ProcessPoolExecutor(max_workers=min(workers, math.ceil(len(clips) / batch_size))) as pool:
+        futures = {pool.submit(slice_video_multi, video_path, clips[i:i + batch_size]): i
+                   for i in range(0, len(clips), batch_size)}
+        for future in as_completed(futures):
+            batch_start = futures[future]
+            batch = clips[batch_start:batch_start + batch_size]
+            if future.result():
+                success_count += len(batch)
+                if config.get('save_chat_messages', False):
+                    for clip, (_, _, clip_path) in zip(plan[batch_start:], batch):
+                        timeframe = merged_chat_timeframe([timeframes[i] for i in clip['timeframes']])
+                        save_chat_messages(timeframe, clip_path, chat_store, clip['start'] * 1e6, clip['end'] * 1e6)
+            else:
+                failure_count += len(batch)
+    return success_count, failure_count
+
+def make_clips(video_path, timeframes_json, config_path, config=None, chat_store_path=None, dry_run=False):
+    """
+    Cut the clips of all chat timeframes out of a video.
+    :param video_path: Path to the video file
+    :param timeframes_json: Path to the chat segments file
+    :param config_path: Path to the configuration file, not read if config is given
+    :param config: already loaded configuration
+    :param chat_store_path: Path to the chat store of the video, by default '<video>chat.sqlite' next to the video
+    :param dry_run: only make the clip plan, nothing is cut
+    :return: dict with clip_dir, timeframes, plan, success_count, failure_count, processing_time, planning_time
+             and error (None on success)
+    """
     start_time = time.time()
-    config = read_config(config_path)
+    result = {'video_path': video_path, 'clip_dir': None, 'timeframes': 0, 'plan': [],
+              'success_count': 0, 'failure_count': 0, 'processing_time': 0.0, 'planning_time': 0.0, 'error': None}
+    if config is None:
+        config = read_config(config_path)
     video_dir, video_filename = os.path.split(video_path)
     # Split the filename and extract the date part
     parts = video_filename.split(' - ')
@@ -202,28 +365,33 @@ def make_clips(video_path, timeframes_json, config_path):
         streamer_name = parts[1].split('.')[0]  # Assuming the streamer's name is the second part
     else:
         print("Error: Invalid video filename format.")
-        return
+        result['error'] = "invalid video filename format"
+        return result
     
-    send_tg(f"Starting processing for streamer: {streamer_name}")
-    file_size = os.path.getsize(video_path) / (1024 * 1024 * 1024)   # Size in GB
-    send_tg(f"File size: {file_size:.2f} GB")
+    if not dry_run:
+        send_tg(f"Starting processing for streamer: {streamer_name}")
+        file_size = os.path.getsize(video_path) / (1024 * 1024 * 1024)   # Size in GB
+        send_tg(f"File size: {file_size:.2f} GB")
 
     try:
         video_date = datetime.strptime(video_date_str, "%Y-%m-%d %H.%M.%S")
 
     except ValueError as e:
         print(f"Error parsing the date from the video filename: {e}")
-        return
+        result['error'] = f"invalid date in video filename: {e}"
+        return result
 
     base_clip_dir = config.get('clips_storage_path', os.path.join(video_dir, "Clips"))
     clip_dir = os.path.join(base_clip_dir, streamer_name, video_date.strftime("%Y-%m-%d"))
-    os.makedirs(clip_dir, exist_ok=True)
+    result['clip_dir'] = clip_dir
 
     delete_if_not_interesting = config.get('deleteNotInteresting', False)
 
     with open(timeframes_json, 'r') as file:
         timeframes = json.load(file)
-        send_tg(f"Total timeframes from chat: {len(timeframes)}")
+        result['timeframes'] = len(timeframes)
+        if not dry_run:
+            send_tg(f"Total timeframes from chat: {len(timeframes)}")
             # Check if there are no interesting segments
         if delete_if_not_interesting and not timeframes:
             send_tg(f"No interesting segments found in chat for video {video_path}. Deleting files.", True)
@@ -233,25 +401,49 @@ def make_clips(video_path, timeframes_json, config_path):
             # Delete database record
             # delete_video_record(video_path)
 
-            return  # Exit the function as there is nothing more to process
+            return result  # Exit the function as there is nothing more to process
 
         video_start_time = 0  # Assuming the video starts at 0 seconds
         success_count = 0
         failure_count = 0
-        if config.get('process_all_at_once', False):
-            # Process all timeframes in a single call
-            for timeframe in timeframes:
-                process_timeframe(video_path, video_start_time, timeframe, clip_dir, config)
-        else:
-            # Process each timeframe individually
-            for timeframe in timeframes:
-                success = process_timeframe(video_path, video_start_time, timeframe, clip_dir, config)
-                if success:
-                    success_count += 1
-                else:
-                    failure_count += 1
+
+        # Probe the video once for all timeframes
+        video_total_duration_seconds = get_video_duration(video_path)
+        if video_total_duration_seconds is None:
+            print("Error obtaining video duration for", video_path)
+            result['error'] = "could not obtain video duration"
+            return result
+        video_total_duration = timedelta(seconds=video_total_duration_seconds)
+
+        # Plan all clips at once, so overlapping timeframes are read and cut only once
+        planning_start = time.time()
+        keyframes = get_keyframes(video_path) if config.get('snap_to_keyframes', True) else []
+        plan = plan_clips(video_start_time, timeframes, video_total_duration, config, keyframes)
+        result.update({'plan': plan, 'planning_time': time.time() - planning_start})
+        logging.info(f"Clip plan for {video_path}: {len(timeframes)} timeframes -> {len(plan)} clips, "
+                     f"{plan_duration(plan):.1f} seconds in {result['planning_time']:.3f} seconds")
+        if dry_run:
+            result['processing_time'] = time.time() - start_time
+            return result
+        os.makedirs(clip_dir, exist_ok=True)
+
+        chat_store = None
+        if chat_store_path is None:
+            chat_store_path = os.path.splitext(video_path)[0] + 'chat.sqlite'
+        if config.get('save_chat_messages', False) and os.path.exists(chat_store_path):
+            chat_store = ChatStore(chat_store_path)
+
+        # Cut independent clips in parallel
+        try:
+            success_count, failure_count = process_timeframes_parallel(video_path, plan, timeframes, clip_dir,
+                                                                       config, chat_store)
+        finally:
+            if chat_store:
+                chat_store.close()
 
     processing_time = time.time() - start_time
+    result.update({'success_count': success_count, 'failure_count': failure_count,
+                   'processing_time': processing_time})
     send_tg(f"Processing completed in {processing_time:.2f} seconds", False)
     # Log the success and failure counts
     send_tg(f"Processing results: {success_count} successful, {failure_count} failed", False)
@@ -262,6 +454,7 @@ def make_clips(video_path, timeframes_json, config_path):
             os.remove(video_path)
         except OSError as e:
             print(f"Error deleting original video file: {e}")
+    return result
 
 def construct_segments_json_path(video_path):
     base_dir = "C:\\OpenServer\\twitch\\automatic-twitch-recorder"
@@ -278,15 +471,28 @@ def construct_segments_json_path(video_path):
 
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python videoProcessor.py <video_path> <config_path>")
+    # only when run as a script, the daemon and the cron script configure logging themselves
+    logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+    args = sys.argv[1:]
+    dry_run = '--dry-run' in args
+    if dry_run:
+        args.remove('--dry-run')
+    if len(args) != 2:
+        print("Usage: python videoProcessor.py [--dry-run] <video_path> <config_path>")
         sys.exit(1)
 
-    video_path = sys.argv[1]
+    video_path = args[0]
     timeframes_json = construct_segments_json_path(video_path)
-    config_path = sys.argv[2]
+    config_path = args[1]
 
-    make_clips(video_path, timeframes_json, config_path)
+    result = make_clips(video_path, timeframes_json, config_path, dry_run=dry_run)
+    if result['error']:
+        print(result['error'])
+        sys.exit(1)
+    if dry_run:
+        print(json.dumps(result['plan'], indent=4))
+        print(f"{result['timeframes']} timeframes -> {len(result['plan'])} clips, "
+              f"{plan_duration(result['plan']):.1f} seconds of video, planned in {result['planning_time']:.3f} seconds")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,16 +1,26 @@
 import datetime
+import io
+import threading
+import time
 import streamlink
 import os
-import threading
+import metrics
 from utils import get_valid_filename, StreamQualities
 from chat_downloader import ChatDownloader
-import json
+from chat_sink import ChatSink
+from hls_reader import HLSReader
+from segments import SegmentedOutput, close_manifest, finish_if_complete, set_part_status
 from requests.exceptions import RequestException
-from streamConverter import convert_stream_to_mp4
-from videoProcessing.videoWorker import insert_video
+from streamConverter import convert_stream_to_mp4, LiveRemuxer
+from videoProcessing.videoWorker import insert_video, construct_segments_json_path
+from chatProcessing.hotspots import HotspotDetector
 from tg_bot import send_tg
 
 
+RECORD_CHUNK_SIZE = 256 * 1024  # ~1/4 second of 1080p60 per read
+STALL_SECONDS = 5  # a read waiting longer than this for the stream counts as a stall
+
+
 class Watcher:
     streamer_dict = {}
     streamer = ''
@@ -19,7 +29,9 @@ class Watcher:
     kill = False
     cleanup = False
 
-    def __init__(self, streamer_dict, download_folder):
+    def __init__(self, streamer_dict, download_folder, chunk_size=RECORD_CHUNK_SIZE, live_remux=False,
+                 conversion_queue=None, chat_compression=None, live_hotspots=False, chat_multiplexer=None,
+                 segment_seconds=None, segment_bytes=None, recorder_backend='streamlink', stream_resolver=None):
         self.streamer_dict = streamer_dict
         self.streamer = self.streamer_dict['user_info']['display_name']
         self.streamer_login = self.streamer_dict['user_info']['login']
@@ -31,6 +43,27 @@ class Watcher:
         self.started_at = stream_info.get('started_at', '')
         self.stream_quality = self.streamer_dict['preferred_quality']
         self.download_folder = download_folder
+        self.chunk_size = chunk_size
+        self.live_remux = live_remux
+        self.conversion_queue = conversion_queue
+        self.chat_compression = chat_compression
+        self.live_hotspots = live_hotspots
+        self.chat_multiplexer = chat_multiplexer
+        # rotate the recording into parts that are converted while the stream goes on, live remux is not used then
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        # 'streamlink' reads through stream.open(), 'hls' fetches the segments of the media playlist in parallel
+        self.recorder_backend = recorder_backend
+        self.stream_resolver = stream_resolver  # shared streamlink session, a new one per recording if None
+        self.on_recording_finished = None  # called when the stream is recorded and the conversion starts
+        self.chat_output_file = None
+        self._chat_messages = metrics.CHAT_MESSAGES.labels(self.streamer_login)
+        self._chat_sink = None
+        self._chat_detector = None
+        self._chat_lock = threading.Lock()
+        # recording and chat share one file name stem, so the chat file can be found from the video
+        curr_time = datetime.datetime.now().strftime("%Y-%m-%d %H.%M.%S")
+        self.file_stem = curr_time + " - " + self.streamer + " - " + get_valid_filename(self.stream_title)
 
     def quit(self):
         self.kill = True
@@ -39,15 +72,21 @@ class Watcher:
         self.cleanup = True
 
     def watch(self):
-        curr_time = datetime.datetime.now().strftime("%Y-%m-%d %H.%M.%S")
-        file_name = curr_time + " - " + self.streamer + " - " + get_valid_filename(self.stream_title) + ".ts"
-        directory = self._formatted_download_folder(self.streamer_login) + os.path.sep
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        output_filepath = directory + file_name
+        try:
+            return self._watch()
+        finally:
+            self.stop_chat()
+
+    def _watch(self):
+        output_filepath = self._output_path(".ts")
         self.streamer_dict.update({'output_filepath': output_filepath})
 
-        streams = streamlink.streams('https://www.twitch.tv/' + self.streamer_login)
+        resolve_start = time.time()
+        if self.stream_resolver:
+            streams = self.stream_resolver.streams(self.streamer_login)
+        else:
+            streams = streamlink.streams('https://www.twitch.tv/' + self.streamer_login)
+        self.streamer_dict.update({'resolve_seconds': time.time() - resolve_start})
 
         try:
             stream = streams[self.stream_quality]
@@ -74,10 +113,12 @@ class Watcher:
             print(self.streamer + ' is live. Saving stream in ' +
                   self.stream_quality + ' quality to ' + output_filepath + '.')
 
+            fd = None
+            remuxer = None
             try:
-                with open(output_filepath, "ab") as out_file:  # open for [a]ppending as [b]inary
+                with self._open_output(output_filepath) as out_file:
                     try:
-                        fd = stream.open()
+                        fd = self._open_stream(stream)
                     except RequestException as e:
                         send_tg(f"{self.streamer} HTTP error occurred when opening the stream: {e}")
                         print(f"HTTP error occurred when opening the stream: {e}")
@@ -90,17 +131,13 @@ class Watcher:
                         self.cleanup = True
                         return
 
-                    while not self.kill and not self.cleanup:
-                        data = fd.read(1024)
-
-                        # If data is empty the stream has ended
-                        if not data:
-                            fd.close()
-                            out_file.close()
-                            self.cleanup = True
-                            break
+                    if self.live_remux and not self._segmented():
+                        # the .ts is only kept as a fallback in case the live remux does not finish
+                        remuxer = LiveRemuxer(output_filepath.replace('.ts', '.mp4'))
 
-                        out_file.write(data)
+                    # If the copy stops on its own the stream has ended
+                    if self._record(fd, out_file, remuxer):
+                        self.cleanup = True
             except streamlink.StreamError as err:
                 print('StreamError: {0}'.format(err))  # TODO: test when this happens
             except IOError as err:
@@ -109,44 +146,187 @@ class Watcher:
             finally:
                 if fd:
                     fd.close()
+                    if getattr(fd, 'gaps', None):
+                        send_tg(f"{self.streamer}: {len(fd.gaps)} gap(s) in the recording, see the log.")
+                if remuxer:
+                    self.streamer_dict.update({'remuxed': remuxer.close()})
             self.streamer_dict.update({'kill': self.kill})
             self.streamer_dict.update({'cleanup': self.cleanup})
+            if self.on_recording_finished:
+                self.on_recording_finished()
+            self.stop_chat()  # the chat file is complete before it is queued with the video
             self.handle_stream_conversion()
             return self.streamer_dict
 
+    def _open_stream(self, stream):
+        if self.recorder_backend == 'hls' and hasattr(stream, 'url'):
+            return HLSReader(stream.url)
+        return stream.open()
+
+    def _record(self, fd, out_file, remuxer=None):
+        """Copies the stream into out_file, and into remuxer if given, until the stream ends or the watcher is stopped.
+        Reads go into one preallocated buffer when the stream supports readinto, so no bytes object is allocated per read.
+        Recorded bytes and stalled reads are counted per streamer in metrics.
+
+           Returns:
+           -------
+           bool: True if the stream ended.
+           """
+        buf = bytearray(self.chunk_size)
+        view = memoryview(buf)
+        readinto = getattr(fd, 'readinto', None)
+        first_byte = True
+        recorded_bytes = metrics.RECORDING_BYTES.labels(self.streamer_login)
+        stalls = metrics.RECORDING_STALLS.labels(self.streamer_login)
+        while not self.kill and not self.cleanup:
+            read_started = time.monotonic()
+            if readinto:
+                try:
+                    n = readinto(buf)
+                except (NotImplementedError, io.UnsupportedOperation):
+                    readinto = None
+                    continue
+                data = view[:n] if n else None
+            else:
+                data = fd.read(self.chunk_size)
+            if time.monotonic() - read_started > STALL_SECONDS:
+                stalls.inc()
+            if not data:
+                return True
+            recorded_bytes.inc(len(data))
+            out_file.write(data)
+            if remuxer:
+                remuxer.write(data)
+            if first_byte:
+                first_byte = False
+                self._report_first_byte()
+        return False
+
+    def _report_first_byte(self):
+        """Logs how long it took from the poller seeing the stream go live to the first recorded byte."""
+        if detected_at := self.streamer_dict.get('live_detected_at'):
+            latency = time.time() - detected_at
+            self.streamer_dict.update({'first_byte_latency': latency})
+            print(f"{self.streamer}: first byte {latency:.2f} seconds after going live was detected "
+                  f"(resolving the stream took {self.streamer_dict.get('resolve_seconds', 0):.2f} seconds).")
+
+    def _segmented(self):
+        return bool(self.segment_seconds or self.segment_bytes)
+
+    def _open_output(self, output_filepath):
+        if self._segmented():
+            output = SegmentedOutput(output_filepath[:-len('.ts')], self.segment_seconds, self.segment_bytes,
+                                     self.chunk_size, self._on_part_closed)
+            self.streamer_dict.update({'manifest_path': output.manifest_path})
+            return output
+        # open for [a]ppending as [b]inary, the file buffer matches the chunk size so full chunks bypass it
+        return open(output_filepath, "ab", buffering=self.chunk_size)
+
+    def _on_part_closed(self, part_path):
+        if self.conversion_queue:
+            # converted while the recording goes on, the parts are joined once the last one is done
+            manifest_path = self.streamer_dict['manifest_path']
+            set_part_status(manifest_path, part_path, 'queued')
+            self.conversion_queue.submit(part_path, self.chat_output_file, manifest_path)
+
     def _formatted_download_folder(self, streamer):
         return self.download_folder.replace('#streamer#', streamer)
+
+    def _output_path(self, suffix):
+        directory = self._formatted_download_folder(self.streamer_login) + os.path.sep
+        os.makedirs(directory, exist_ok=True)
+        return directory + self.file_stem + suffix
     
     def download_chat(self):
         send_tg(f"new chat downloading for {self.streamer}")
         chat_url = f'https://www.twitch.tv/{self.streamer_login}'
-        curr_time = datetime.datetime.now().strftime("%Y-%m-%d %H.%M.%S")
-        chat_output_file = self._formatted_download_folder(self.streamer_login) + os.path.sep + curr_time + " - " + self.streamer + " - " + get_valid_filename(self.stream_title) + "chat.json"
 
         chat = ChatDownloader().get_chat(chat_url)
-        with open(chat_output_file, 'w') as f:
+        self._open_chat()
+        try:
             for message in chat:
                 if self.kill or self.cleanup:
                     break  # Exit the loop if the watcher has been signaled to stop
-
-                simplified_message = {
-                    'timestamp': message.get('timestamp'),
-                    'message': message.get('message'),
-                    'message_type': message.get('message_type'),
-                }
-                json.dump(simplified_message, f)
-                f.write('\n')
+                self._on_chat_message(message)
+        finally:
+            self.stop_chat()
 
     def start_chat_download(self):
-        self.download_chat()
+        if self.chat_multiplexer:
+            # shared connection, messages arrive on its reader thread until stop_chat
+            send_tg(f"new chat downloading for {self.streamer}")
+            self._open_chat()
+            self.chat_multiplexer.join(self.streamer_login, self._on_chat_message)
+        else:
+            self.download_chat()
+
+    def _open_chat(self):
+        with self._chat_lock:
+            self._chat_sink = ChatSink(self._output_path("chat.json"), self.chat_compression)
+            self.chat_output_file = self._chat_sink.path
+            if self.live_hotspots:
+                # chat hotspots are written where the chat processing would put them, so clipping can skip that pass
+                self._chat_detector = HotspotDetector(construct_segments_json_path(self._output_path(".mp4")))
+
+    def _on_chat_message(self, message):
+        simplified_message = {
+            'timestamp': message.get('timestamp'),
+            'message': message.get('message'),
+            'message_type': message.get('message_type'),
+        }
+        self._chat_messages.inc()
+        with self._chat_lock:  # uncontended except while stop_chat closes the file
+            if self._chat_sink:
+                self._chat_sink.write(simplified_message)
+            if self._chat_detector:
+                self._chat_detector.add(simplified_message)
+
+    def stop_chat(self):
+        """Stops the chat download and closes the chat file, safe to call more than once."""
+        if self.chat_multiplexer:
+            self.chat_multiplexer.leave(self.streamer_login)
+        with self._chat_lock:
+            sink, self._chat_sink = self._chat_sink, None
+            detector, self._chat_detector = self._chat_detector, None
+        if detector:
+            timeframes = detector.close()
+            send_tg(f"{self.streamer}: {len(timeframes)} chat hotspots found while recording.")
+        if sink:
+            sink.close()
 
     def handle_stream_conversion(self):
-        if ts_file_path := self.streamer_dict.get('output_filepath'):
-            send_tg(f"{self.streamer}'s stream is converting to mp4,")
-            conversion_thread = threading.Thread(target=convert_stream_to_mp4, args=(ts_file_path,))
-            conversion_thread.start()
-            conversion_thread.join()  # Wait for the conversion to finish
+        if manifest_path := self.streamer_dict.get('manifest_path'):
+            self._finish_segments(manifest_path)
+        elif ts_file_path := self.streamer_dict.get('output_filepath'):
+            chat_file_path = self.chat_output_file or ts_file_path.replace('.ts', 'chat.json')
+            if self.streamer_dict.get('remuxed'):
+                # the mp4 was written live, the .ts fallback is not needed anymore
+                send_tg(f"{self.streamer}'s stream was remuxed to mp4 live.")
+                os.remove(ts_file_path)
+            elif self.conversion_queue:
+                # the conversion queue inserts the video record once the mp4 is done
+                job_id = self.conversion_queue.submit(ts_file_path, chat_file_path)
+                send_tg(f"{self.streamer}'s stream is queued for mp4 conversion "
+                        f"(job {job_id}, {self.conversion_queue.depth()} in queue).")
+                self.streamer_dict.update({'output_filepath': None})  # owned by the conversion queue now
+                return
+            else:
+                send_tg(f"{self.streamer}'s stream is converting to mp4,")
+                convert_stream_to_mp4(ts_file_path)
 
             # Insert video record into the database
-            chat_file_path = ts_file_path.replace('.ts', 'chat.json')  # Assuming chat file has same name with 'chat.json' extension
-            insert_video(ts_file_path.replace('.ts', '.mp4'), chat_file_path)
\ No newline at end of file
+            insert_video(ts_file_path.replace('.ts', '.mp4'), chat_file_path)
+
+    def _finish_segments(self, manifest_path):
+        manifest = close_manifest(manifest_path, self.chat_output_file)
+        self.streamer_dict.update({'output_filepath': None})  # the parts are kept and tracked by the manifest
+        parts = [part for part in manifest['parts'] if part['bytes']]
+        if not self.conversion_queue:
+            send_tg(f"{self.streamer}'s stream is converting to mp4 in {len(parts)} parts,")
+            for part in parts:
+                ok = convert_stream_to_mp4(part['ts'])
+                set_part_status(manifest_path, part['ts'], 'converted' if ok else 'failed')
+        # the last converted part joins the recording, this catches parts that were converted before the close
+        if not finish_if_complete(manifest_path):
+            send_tg(f"{self.streamer}'s stream was recorded in {len(parts)} parts, "
+                    f"they are joined once all are converted.")